@@ -0,0 +1 @@
+VERSION="0.0.1dev354db7"
@@ -16,6 +16,7 @@ import matplotlib.pyplot as plt
 import astropy.table
 
 from rvspecfit import fitter_ccf, vel_fit, spec_fit, utils
+from rvspecfit import make_nd, make_ccf, shared_store
 
 
 def make_plot(specdata, res_dict, title, fig_fname):
@@ -139,16 +140,13 @@ def proc_desi(fname, ofname, fig_prefix, config, fit_targetid):
     for c in columns:
         outdict[c] = []
     large_error = 1e9
+    if fit_targetid is not None:
+        xids = [_ for _ in xids if targetid[_] == fit_targetid]
+    specdatas = []
+    allsns = []
     for curid in xids:
         specdata = []
-        curbrick = brick_name[curid]
-        curtargetid = targetid[curid]
-        if fit_targetid is not None and curtargetid != fit_targetid:
-            continue
-
-        fig_fname = fig_prefix + '_%s_%d.png' % (curbrick, curtargetid)
         sns = {}
-        chisqs = {}
         for s in setups:
             spec = fluxes[s][curid]
             curivars = ivars[s][curid]
@@ -159,19 +157,34 @@ def proc_desi(fname, ofname, fig_prefix, config, fit_targetid):
             specdata.append(
                 spec_fit.SpecData(
                     'desi_%s' % s, waves[s], spec, espec, badmask=badmask))
-        t1 = time.time()
-        res = fitter_ccf.fit(specdata, config)
+        specdatas.append(specdata)
+        allsns.append(sns)
+    # the cross-correlations of all the fibers are done at once
+    ccf_results = []
+    if len(specdatas) > 0:
+        ccf_results = fitter_ccf.fit_many(specdatas, config)
+    for curid, specdata, sns, res in zip(xids, specdatas, allsns,
+                                         ccf_results):
+        curbrick = brick_name[curid]
+        curtargetid = targetid[curid]
+        fig_fname = fig_prefix + '_%s_%d.png' % (curbrick, curtargetid)
         t2 = time.time()
         paramDict0 = res['best_par']
         fixParam = []
         if res['best_vsini'] is not None:
             paramDict0['vsini'] = res['best_vsini']
+        vel0 = None
+        if config.get('ccf_polish'):
+            # start from the best of the polished CCF candidates
+            paramDict0, vel0, _ = vel_fit.polish_candidates(
+                specdata, res['candidates'], options=options, config=config)
         res1 = vel_fit.process(
             specdata,
             paramDict0,
             fixParam=fixParam,
             config=config,
-            options=options)
+            options=options,
+            vel0=vel0)
         t3 = time.time()
         chisq_cont_array = spec_fit.get_chisq_continuum(
             specdata, options=options)
@@ -211,13 +224,35 @@ def proc_desi_wrapper(*args, **kwargs):
 proc_desi_wrapper.__doc__ = proc_desi.__doc__
 
 
+def get_library_files(config):
+    """
+    Return the list of the files of the template library
+
+    Parameters:
+    -----------
+    config: dict
+        The configuration dictionary
+
+    Returns:
+    --------
+    fnames: list of strings
+    """
+    fnames = []
+    for mask in (make_nd.INTERPOL_LIB_NAME, make_nd.INTERPOL_DAT_NAME,
+                 make_nd.INTERPOL_BASIS_NAME, make_ccf.CCF_LIB_NAME,
+                 make_ccf.CCF_DAT_NAME, make_ccf.CCF_MOD_NAME):
+        fnames.extend(sorted(glob.glob(config['template_lib'] + mask % '*')))
+    return fnames
+
+
 def proc_many(files,
               oprefix,
               fig_prefix,
               config=None,
               nthreads=1,
               overwrite=True,
-              targetid=None):
+              targetid=None,
+              shared_library=False):
     """
     Process many spectral files
 
@@ -231,6 +266,9 @@ def proc_many(files,
         The prfix where the figures will be stored
     targetid: integer
         The targetid to fit (the rest will be ignored)
+    shared_library: bool
+        If true, the template library is loaded once in the shared memory
+        and the worker processes attach to it
     """
     config = utils.read_config(config)
 
@@ -240,7 +278,18 @@ def proc_many(files,
         parallel = False
 
     if parallel:
-        poolEx = concurrent.futures.ProcessPoolExecutor(nthreads)
+        # the workers share the segments of the template store through
+        # the token of this run (see shared_store.run_token)
+        shared_store.run_token()
+        if shared_library:
+            fnames = get_library_files(config)
+            prefix, keys = shared_store.publish_library(fnames)
+            poolEx = concurrent.futures.ProcessPoolExecutor(
+                nthreads,
+                initializer=shared_store.attach_library,
+                initargs=(prefix, keys))
+        else:
+            poolEx = concurrent.futures.ProcessPoolExecutor(nthreads)
     res = []
     for f in files:
         fname = f.split('/')[-1]
@@ -333,6 +382,13 @@ def main(args):
         action='store_true',
         default=False)
 
+    parser.add_argument(
+        '--shared_library',
+        help='Load the template library once in the shared memory '
+        'and share it between the worker processes',
+        action='store_true',
+        default=False)
+
     args = parser.parse_args(args)
     input_files = args.input_files
     input_file_from = args.input_file_from
@@ -365,7 +421,8 @@ def main(args):
         nthreads=nthreads,
         overwrite=args.overwrite,
         config=config,
-        targetid=targetid)
+        targetid=targetid,
+        shared_library=args.shared_library)
 
 
 if __name__ == '__main__':
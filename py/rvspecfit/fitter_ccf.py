@@ -1,24 +1,25 @@
 import sys
 import os
-import pickle
 import time
 import numpy as np
 import scipy.optimize
 import scipy.interpolate
 import matplotlib.pyplot as plt
 from rvspecfit import make_ccf
+from rvspecfit import lrucache
 
 
 class CCFCache:
     """ Singleton caching CCF information """
-    ccf_info = {}
-    ccfs = {}
-    ccf_models = {}
+    ccf_info = lrucache.Cache('ccf_info')
+    ccfs = lrucache.Cache('ccf_dats')
+    ccf_models = lrucache.Cache('ccf_models')
+    ccf_trees = lrucache.Cache('ccf_trees')
 
 
 def get_ccf_info(spec_setup, config):
     """
-    Returns the CCF info from the pickled file for a given spectroscopic spec_setup
+    Returns the CCF info from the library files for a given spectroscopic spec_setup
 
     Parameters:
     -----------
@@ -34,17 +35,105 @@ def get_ccf_info(spec_setup, config):
 
     """
     if spec_setup not in CCFCache.ccfs:
-        prefix = config['template_lib']
-        ccf_info_fname = prefix + make_ccf.CCF_PKL_NAME % spec_setup
-        ccf_dat_fname = prefix + make_ccf.CCF_DAT_NAME % spec_setup
-        ccf_mod_fname = prefix + make_ccf.CCF_MOD_NAME % spec_setup
-        CCFCache.ccf_info[spec_setup] = pickle.load(open(ccf_info_fname, 'rb'))
-        CCFCache.ccfs[spec_setup] = np.load(ccf_dat_fname, mmap_mode='r')
-        CCFCache.ccf_models[spec_setup] = np.load(ccf_mod_fname, mmap_mode='r')
+        (CCFCache.ccfs[spec_setup], CCFCache.ccf_models[spec_setup],
+         CCFCache.ccf_info[spec_setup]) = make_ccf.read_ccf(
+             config['template_lib'], spec_setup)
     return CCFCache.ccfs[spec_setup], CCFCache.ccf_models[
         spec_setup], CCFCache.ccf_info[spec_setup]
 
 
+def get_ccf_tree(setups, config):
+    """
+    Returns the tree of templates for the hierarchical search over
+    several spectroscopic setups (see make_ccf.build_ccf_tree).
+    If the trees stored for the setups differ, the single tree
+    of the templates clustered by their spectra in all the setups is built
+    (with the branching factor of the stored trees)
+
+    Parameters:
+    -----------
+    setups: list of strings
+        The spectroscopic setups
+    config: dict
+        The dictionary with the config
+
+    Returns:
+    --------
+    tree: dict
+        The tree of templates or None if there are no trees
+        in the CCF library
+    """
+    key = tuple(setups)
+    if key in CCFCache.ccf_trees:
+        return CCFCache.ccf_trees[key]
+    infos = [get_ccf_info(_, config) for _ in setups]
+    trees = [_[2]['tree'] for _ in infos]
+    tree = trees[0]
+    if all([_ is None for _ in trees]):
+        tree = None
+    elif len(set([len(_[0]) for _ in infos])) > 1:
+        print('WARNING the setups have different numbers of CCF templates; '
+              'falling back to the full CCF search')
+        tree = None
+    elif any([
+            _ is None or len(_['tree_rep']) != len(tree['tree_rep'])
+            or (_['tree_rep'] != tree['tree_rep']).any() for _ in trees
+    ]):
+        print('WARNING the trees of CCF templates differ between the setups '
+              '%s; building the joint tree' % (', '.join(setups)))
+        branching = max([
+            np.diff(_['tree_child_ptr']).max() for _ in trees
+            if _ is not None
+        ])
+        tree = make_ccf.build_ccf_tree([_[0] for _ in infos],
+                                       branching=branching,
+                                       leafsize=branching)
+    CCFCache.ccf_trees[key] = tree
+    return tree
+
+
+@lrucache.memoize('ccf_resamplers', maxbytes=100e6)
+def get_ccf_resampler(velstep, nfft, maxvel, nvelgrid):
+    """
+    Return the linear operator that resamples the CCF from the FFT lags
+    onto the uniform velocity grid. It is equivalent to evaluating the
+    interpolating cubic spline through the CCF values at the lags within
+    maxvel.
+
+    Parameters:
+    -----------
+    velstep: float
+        The velocity step of one lag
+    nfft: integer
+        The length of the FFT
+    maxvel: float
+        The maximum velocity of the grid
+    nvelgrid: integer
+        The number of points in the velocity grid
+
+    Returns:
+    --------
+    lagind: numpy
+        The indices of the lags used (in the order of increasing velocity)
+    resampler: numpy (Nlag, Nvelgrid)
+        The matrix that converts the CCF values at those lags into the CCF
+        on the velocity grid
+    vel_grid: numpy
+        The velocity grid
+    """
+    off = nfft // 2
+    # the lag i corresponds to the velocity -i * velstep
+    vels = -((np.arange(nfft) + off) % nfft - off) * velstep
+    lagind = np.nonzero(np.abs(vels) < maxvel)[0]
+    lagind = lagind[np.argsort(vels[lagind])]
+    vel_grid = np.linspace(-maxvel, maxvel, nvelgrid)
+    # the not-a-knot cubic spline is the same as the interpolating
+    # spline of UnivariateSpline with s=0
+    resampler = scipy.interpolate.make_interp_spline(
+        vels[lagind], np.eye(len(lagind)), k=3)(vel_grid).T
+    return lagind, np.ascontiguousarray(resampler), vel_grid
+
+
 def fit(specdata, config):
     """
     Process the data by doing cross-correlation with templates
@@ -60,7 +149,42 @@ def fit(specdata, config):
     Returns:
     results: dict
         The dictionary with results such as best template parameters, best velocity
-        best vsini.
+        best vsini. The candidates item is the list of dictionaries with
+        the parameters (best_par), the velocities refined to a fraction of
+        the grid step (best_vel), vsini (best_vsini) and the heights of the
+        CCF peaks (ccf_height) of the templates with the highest CCF peaks
+        (their number is given by the ccf_ncandidates config option)
+    """
+    return fit_many([specdata], config)[0]
+
+
+def fit_many(specdatas, config):
+    """
+    Process many spectra (i.e. all the fibers of a frame) by doing
+    cross-correlation with templates. The cross-correlations of blocks of
+    spectra with blocks of templates are computed at once, so the
+    templates are only read once for a block of spectra.
+    If the CCF library has the tree of templates (see make_ccf
+    --tree_branching), only the cluster representatives are correlated
+    at first and the search descends into the ccf_beam best branches,
+    unless ccf_search is set to 'full' in the configuration.
+    If the CCF library has the basis of templates (see make_ccf
+    --basis_tol), the data are only correlated with the basis vectors
+    and the CCFs of the templates are their linear combinations,
+    unless ccf_basis is set to False.
+
+    Parameters:
+    -----------
+    specdatas: list of lists of SpecData objects
+        The list of datasets, each one is the list of data from
+        different spectral setups (as accepted by fit). All the datasets
+        must have the same setups in the same order.
+    config: dict
+        The configuration dictionary
+
+    Returns:
+    results: list of dicts
+        The list of dictionaries with results (see fit)
     """
     # configuration parameters
 
@@ -69,93 +193,264 @@ def fit(specdata, config):
     nvelgrid = 2000
     # number of points on the ccf in the specified velocity range
 
-    loglam = {}
+    # the number of cross-correlations computed at once
+    block_size = config.get('ccf_block_size') or 256
+    # the number of best templates returned as candidates
+    ncandidates = config.get('ccf_ncandidates') or 5
+    # the number of branches explored at each level of the tree of templates
+    beam = config.get('ccf_beam') or 4
+
+    nspec = len(specdatas)
+    setups = [_.name for _ in specdatas[0]]
+    for specdata in specdatas:
+        if [_.name for _ in specdata] != setups:
+            raise ValueError('All the datasets must have the same setups')
     velstep = {}
+    nfft = {}
     spec_fftconj = {}
-    vels = {}
-    off = {}
-    subind = {}
     ccf_dats = {}
     ccf_infos = {}
     ccf_mods = {}
-    proc_specs = {}
-    setups = []
-    for cursd in specdata:
-        spec_setup = cursd.name
-        setups.append(spec_setup)
-        lam = cursd.lam
-        spec = cursd.spec
-        espec = cursd.espec
+    proc_specs = [{} for _ in range(nspec)]
+    resamplers = {}
+    for spec_setup in setups:
         ccf_dats[spec_setup], ccf_mods[spec_setup], ccf_infos[
             spec_setup] = get_ccf_info(spec_setup, config)
         ccfconf = ccf_infos[spec_setup]['ccfconf']
         logl0 = ccfconf.logl0
         logl1 = ccfconf.logl1
         npoints = ccfconf.npoints
-        proc_spec = make_ccf.preprocess_data(
-            lam, spec, espec, badmask=cursd.badmask, ccfconf=ccfconf)
-        proc_spec_std = proc_spec.std()
-        if proc_spec_std == 0:
-            proc_spec_std = 1
-            print('WARNING spectrum looks like a constant...')
-        proc_spec /= proc_spec_std
-        proc_specs[spec_setup] = proc_spec
-        spec_fft = np.fft.fft(proc_spec)
-        spec_fftconj[spec_setup] = spec_fft.conj()
+        nfft[spec_setup] = ccf_infos[spec_setup]['nfft']
         velstep[spec_setup] = (np.exp((logl1 - logl0) / npoints) - 1) * 3e5
-        l = len(spec_fft)
-        off[spec_setup] = l // 2
-        vels[spec_setup] = ((np.arange(l) + off[spec_setup]) % l -
-                            off[spec_setup]) * velstep[spec_setup]
-        vels[spec_setup] = -np.roll(vels[spec_setup], off[spec_setup])
-        subind[spec_setup] = np.abs(vels[spec_setup]) < maxvel
-
-    maxv = -1e20
-    best_id = -90
-    best_v = -777
-
-    nfft = ccf_dats[spec_setup].shape[0]
+        resamplers[spec_setup] = get_ccf_resampler(
+            velstep[spec_setup], nfft[spec_setup], maxvel, nvelgrid)
+    # the spectra on the same wavelength grid are preprocessed together
+    groups = {}
+    for j, specdata in enumerate(specdatas):
+        for cursd in specdata:
+            key = (cursd.name, cursd.lamgrid.fingerprint)
+            groups.setdefault(key, []).append((j, cursd))
+    for (spec_setup, _), group in groups.items():
+        ccfconf = ccf_infos[spec_setup]['ccfconf']
+        cur_proc_specs = make_ccf.preprocess_data_many(
+            group[0][1].lam, [_[1].spec for _ in group],
+            [_[1].espec for _ in group],
+            badmasks=[_[1].badmask for _ in group],
+            ccfconf=ccfconf)
+        for (j, cursd), proc_spec in zip(group, cur_proc_specs):
+            proc_spec_std = proc_spec.std()
+            if proc_spec_std == 0:
+                proc_spec_std = 1
+                print('WARNING spectrum looks like a constant...')
+            proc_spec /= proc_spec_std
+            proc_specs[j][spec_setup] = proc_spec
+    for spec_setup in setups:
+        # the templates may only have the lowest frequency modes
+        nmodes = ccf_dats[spec_setup].shape[1]
+        spec_fft = np.fft.rfft(
+            np.array([_[spec_setup] for _ in proc_specs]), axis=1)[:, :nmodes]
+        spec_fftconj[spec_setup] = spec_fft.conj()
+
+    ntempl = ccf_dats[setups[0]].shape[0]
     vel_grid = np.linspace(-maxvel, maxvel, nvelgrid)
-    best_ccf = vel_grid * 0
-    for id in range(nfft):
-        curccf = {}
+    use_basis = config.get('ccf_basis', True) and all(
+        [ccf_infos[_].get('basis') is not None for _ in setups])
+    # the CCFs of the basis vectors for the last requested spectra
+    basis_ccfs = {}
+
+    def get_basis_ccfs(spec_setup, specind):
+        key = repr(specind)
+        if spec_setup not in basis_ccfs or basis_ccfs[spec_setup][0] != key:
+            lagind, resampler, _ = resamplers[spec_setup]
+            basis = ccf_infos[spec_setup]['basis'][0]
+            specind = np.arange(nspec)[specind]
+            # at most block_size cross-correlations are computed at once
+            step = max(block_size // len(basis), 1)
+            ccfs = []
+            for j0 in range(0, len(specind), step):
+                ccf = np.fft.irfft(
+                    spec_fftconj[spec_setup][specind[j0:j0 + step], None, :] *
+                    basis[None, :, :],
+                    n=nfft[spec_setup],
+                    axis=2)
+                ccfs.append(np.dot(ccf[:, :, lagind], resampler))
+            basis_ccfs[spec_setup] = (key, np.concatenate(ccfs, axis=0))
+        return basis_ccfs[spec_setup][1]
+
+    def get_ccfs(specind, templind):
+        # the products of the CCFs from all the setups on the velocity grid
+        # for given spectra and templates
+        allccf = 1
         for spec_setup in setups:
-            curf = ccf_dats[spec_setup][id, :]
-            ccf = np.fft.ifft(spec_fftconj[spec_setup] * curf).real
-            ccf = np.roll(ccf, off[spec_setup])
-            curccf[spec_setup] = ccf[subind[spec_setup]]
-            curccf[spec_setup] = scipy.interpolate.UnivariateSpline(
-                vels[spec_setup][subind[spec_setup]][::-1],
-                curccf[spec_setup][::-1],
-                s=0)(vel_grid)
-            # plot(vel_grid, curccf[spec_setup],xr=[-1000,1000])#np.roll(np.fft.ifft(curf*curf.conj()),off[spec_setup]))
-            #plt.draw(); plt.pause(0.1)
-
-        allccf = np.array([curccf[_] for _ in setups]).prod(axis=0)
-        if allccf.max() > maxv:
-            maxv = allccf.max()
-            best_id = id
-            best_v = vel_grid[np.argmax(allccf)]
-            best_model = {}
-            for spec_setup in setups:
-                best_model[spec_setup] = np.roll(
-                    ccf_mods[spec_setup][id],
-                    int(best_v / velstep[spec_setup]))
-            best_ccf = allccf
-    try:
-        assert (best_id >= 0)
-    except:
+            if use_basis:
+                # the CCFs are the linear combinations of the CCFs of
+                # the basis vectors
+                coeffs = ccf_infos[spec_setup]['basis'][1][templind]
+                allccf = allccf * np.matmul(
+                    coeffs[None, :, :], get_basis_ccfs(spec_setup, specind))
+                continue
+            lagind, resampler, _ = resamplers[spec_setup]
+            ccf = np.fft.irfft(
+                spec_fftconj[spec_setup][specind, None, :] *
+                ccf_dats[spec_setup][None, templind, :],
+                n=nfft[spec_setup],
+                axis=2)
+            allccf = allccf * np.dot(ccf[:, :, lagind], resampler)
+        return allccf
+
+    # the heights and the positions of the CCF peaks for every spectrum
+    # and template (-inf for the templates that were not tried)
+    peaks = np.zeros((nspec, ntempl)) - np.inf
+    peak_pos = np.zeros((nspec, ntempl), dtype=int)
+    tree = None
+    if config.get('ccf_search') != 'full':
+        tree = get_ccf_tree(setups, config)
+    if tree is not None:
+        for j in range(nspec):
+
+            def evaluate(templind):
+                templind = np.unique(templind)
+                templind = templind[~np.isfinite(peaks[j, templind])]
+                if len(templind) == 0:
+                    return
+                allccf = get_ccfs([j], templind)[0]
+                peak_pos[j, templind] = np.argmax(allccf, axis=1)
+                peaks[j, templind] = allccf[np.arange(len(templind)),
+                                            peak_pos[j, templind]]
+
+            search_tree(tree, evaluate, peaks[j], beam)
+    else:
+        sblock = min(nspec, block_size)
+        if use_basis:
+            # the CCFs of the basis vectors are kept for the whole block
+            # of spectra
+            sblock = min(
+                nspec,
+                max(
+                    block_size //
+                    max([len(ccf_infos[_]['basis'][0]) for _ in setups]),
+                    1))
+        tblock = max(block_size // sblock, 1)
+        for j0 in range(0, nspec, sblock):
+            j1 = min(j0 + sblock, nspec)
+            for i0 in range(0, ntempl, tblock):
+                i1 = min(i0 + tblock, ntempl)
+                allccf = get_ccfs(slice(j0, j1), slice(i0, i1))
+                peak_pos[j0:j1, i0:i1] = np.argmax(allccf, axis=2)
+                peaks[j0:j1, i0:i1] = np.take_along_axis(
+                    allccf, peak_pos[j0:j1, i0:i1, None], axis=2)[:, :, 0]
+    if np.isnan(peaks).any() or not np.isfinite(peaks.max(axis=1)).all():
         raise Exception('Cross-correlation step failed')
-    best_par = ccf_infos[setups[0]]['params'][best_id]
-    best_par = dict(zip(ccf_infos[setups[0]]['parnames'], best_par))
-
-    best_vsini = ccf_infos[setups[0]]['vsinis'][best_id]
-
-    result = {}
-    result['best_par'] = best_par
-    result['best_vel'] = best_v
-    result['best_ccf'] = best_ccf
-    result['best_vsini'] = best_vsini
-    result['best_model'] = best_model
-    result['proc_spec'] = proc_specs
-    return result
+
+    results = []
+    for j in range(nspec):
+        # the templates with the highest peaks (in the order of templates
+        # for equal peaks)
+        cand_ids = np.argsort(-peaks[j], kind='stable')[:ncandidates]
+        cand_ids = cand_ids[np.isfinite(peaks[j, cand_ids])]
+        best_id = cand_ids[0]
+        best_v = vel_grid[peak_pos[j, best_id]]
+        cand_ccfs = get_ccfs([j], np.sort(cand_ids))[0]
+        cand_ccfs = dict(zip(np.sort(cand_ids), cand_ccfs))
+        best_model = {}
+        for spec_setup in setups:
+            best_model[spec_setup] = np.roll(
+                ccf_mods[spec_setup][best_id],
+                int(best_v / velstep[spec_setup]))
+        candidates = []
+        for curid in cand_ids:
+            curpos = peak_pos[j, curid]
+            curvel, curheight = refine_peak(vel_grid, cand_ccfs[curid],
+                                            curpos)
+            candidates.append(
+                dict(best_par=dict(
+                    zip(ccf_infos[setups[0]]['parnames'],
+                        ccf_infos[setups[0]]['params'][curid])),
+                     best_vel=curvel,
+                     best_vsini=ccf_infos[setups[0]]['vsinis'][curid],
+                     ccf_height=curheight,
+                     template_id=int(curid)))
+        best_par = ccf_infos[setups[0]]['params'][best_id]
+        best_par = dict(zip(ccf_infos[setups[0]]['parnames'], best_par))
+
+        best_vsini = ccf_infos[setups[0]]['vsinis'][best_id]
+
+        result = {}
+        result['best_par'] = best_par
+        result['best_vel'] = best_v
+        result['best_ccf'] = cand_ccfs[best_id]
+        result['best_vsini'] = best_vsini
+        result['best_model'] = best_model
+        result['proc_spec'] = proc_specs[j]
+        result['candidates'] = candidates
+        results.append(result)
+    return results
+
+
+def search_tree(tree, evaluate, peaks, beam):
+    """
+    Search the tree of templates (see make_ccf.build_ccf_tree) descending
+    into the branches whose representative templates have the highest CCF
+    peaks
+
+    Parameters:
+    -----------
+    tree: dict
+        The tree of templates
+    evaluate: function
+        The function that computes the CCF peaks for given templates and
+        fills the peaks array
+    peaks: numpy array
+        The CCF peak heights of the templates
+    beam: integer
+        The number of branches explored at each level
+    """
+    rep = tree['tree_rep']
+    child_ptr, child_ind = tree['tree_child_ptr'], tree['tree_child_ind']
+    leaf_ptr, leaf_ind = tree['tree_leaf_ptr'], tree['tree_leaf_ind']
+    frontier = [0]
+    while len(frontier) > 0:
+        children = np.concatenate(
+            [child_ind[child_ptr[_]:child_ptr[_ + 1]] for _ in frontier])
+        members = np.concatenate(
+            [leaf_ind[leaf_ptr[_]:leaf_ptr[_ + 1]] for _ in frontier])
+        children = children.astype(int)
+        evaluate(np.concatenate((rep[children], members)).astype(int))
+        if len(children) == 0:
+            break
+        # the best branches
+        order = np.argsort(-peaks[rep[children]], kind='stable')
+        frontier = children[order[:beam]]
+
+
+def refine_peak(vel_grid, ccf, pos):
+    """
+    Refine the position of the CCF peak by fitting the parabola through
+    the peak and its neighbours
+
+    Parameters:
+    -----------
+    vel_grid: numpy array
+        The uniform velocity grid
+    ccf: numpy array
+        The CCF on the velocity grid
+    pos: integer
+        The index of the maximum of the CCF
+
+    Returns:
+    --------
+    vel: float
+        The velocity of the peak
+    height: float
+        The height of the peak
+    """
+    if pos == 0 or pos == len(ccf) - 1:
+        return vel_grid[pos], ccf[pos]
+    y0, y1, y2 = ccf[pos - 1], ccf[pos], ccf[pos + 1]
+    denom = y0 - 2 * y1 + y2
+    if denom >= 0:
+        return vel_grid[pos], ccf[pos]
+    shift = 0.5 * (y0 - y2) / denom
+    step = vel_grid[1] - vel_grid[0]
+    return (vel_grid[pos] + shift * step,
+            y1 - 0.25 * (y0 - y2) * shift)
@@ -0,0 +1,140 @@
+import os
+import mmap
+import json
+import importlib
+import numpy as np
+
+# The file starts with the magic string, the format version and the length
+# of the JSON header. The header describes the arrays that follow it
+MAGIC = b'RVSLIB\n\x00'
+VERSION = 1
+_preamble = len(MAGIC) + 4 + 8
+_align = 64
+
+
+def _roundup(x):
+    return ((x + _align - 1) // _align) * _align
+
+
+def write(fname, arrays, meta):
+    """
+    Write the arrays and the metadata into the library file
+
+    Parameters:
+    -----------
+    fname: string
+        The filename
+    arrays: dict
+        The dictionary of numpy arrays
+    meta: dict
+        The dictionary with the metadata. It must be serializable to JSON
+    """
+    header = []
+    offset = 0
+    prepared = []
+    for name, arr in arrays.items():
+        arr = np.asarray(arr)
+        if not arr.flags.f_contiguous or arr.ndim < 2:
+            # unlike ascontiguousarray, this keeps the 0-d arrays 0-d
+            arr = np.require(arr, requirements='C')
+        order = 'C' if arr.flags.c_contiguous else 'F'
+        header.append(
+            dict(name=name,
+                 dtype=arr.dtype.str,
+                 shape=list(arr.shape),
+                 offset=offset,
+                 order=order))
+        prepared.append((offset, arr))
+        offset = _roundup(offset + arr.nbytes)
+    header = json.dumps(dict(arrays=header, meta=meta)).encode()
+    start = _roundup(_preamble + len(header))
+    # write into the temporary file first, so that the readers
+    # never see the incomplete file
+    tmpname = fname + '.tmp'
+    with open(tmpname, 'wb') as fp:
+        fp.write(MAGIC)
+        fp.write(np.uint32(VERSION).tobytes())
+        fp.write(np.uint64(len(header)).tobytes())
+        fp.write(header)
+        for curoff, arr in prepared:
+            fp.seek(start + curoff)
+            # the bytes of the Fortran ordered array are the
+            # bytes of its C ordered transpose
+            (arr if arr.flags.c_contiguous else arr.T).tofile(fp)
+        fp.truncate(start + offset)
+    os.replace(tmpname, fname)
+
+
+def read(fname):
+    """
+    Read the library file. The arrays are memory-mapped read-only, so only
+    the parts that are used are actually read from the disk
+
+    Parameters:
+    -----------
+    fname: string
+        The filename
+
+    Returns:
+    --------
+    arrays: dict
+        The dictionary of arrays
+    meta: dict
+        The dictionary with the metadata
+    """
+    with open(fname, 'rb') as fp:
+        preamble = fp.read(_preamble)
+        if len(preamble) != _preamble or preamble[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not an rvspecfit library file' % fname)
+        version = int(np.frombuffer(preamble[len(MAGIC):len(MAGIC) + 4],
+                                    dtype=np.uint32)[0])
+        if version > VERSION:
+            raise ValueError(
+                'The library file %s has version %d, while only versions up '
+                'to %d are supported' % (fname, version, VERSION))
+        hlen = int(np.frombuffer(preamble[len(MAGIC) + 4:],
+                                 dtype=np.uint64)[0])
+        header = json.loads(fp.read(hlen).decode())
+        start = _roundup(_preamble + hlen)
+        if len(header['arrays']) > 0:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    arrays = {}
+    for curarr in header['arrays']:
+        arrays[curarr['name']] = np.ndarray(tuple(curarr['shape']),
+                                            dtype=curarr['dtype'],
+                                            buffer=buf,
+                                            offset=start + curarr['offset'],
+                                            order=curarr['order'])
+    return arrays, header['meta']
+
+
+def mapper_to_meta(mapper):
+    """
+    Return the JSON-serializable description of the parameter mapper object
+    """
+    state = {}
+    for k, v in mapper.__dict__.items():
+        if isinstance(v, np.ndarray):
+            v = v.tolist()
+        state[k] = v
+    return dict(cls='%s.%s' % (type(mapper).__module__,
+                               type(mapper).__name__),
+                state=state)
+
+
+def mapper_from_meta(meta):
+    """
+    Create the parameter mapper object from its description
+    (see mapper_to_meta). Only the classes of rvspecfit are accepted, so
+    the library file cannot make us import arbitrary modules
+    """
+    modname, clsname = meta['cls'].rsplit('.', 1)
+    if modname.split('.')[0] != 'rvspecfit':
+        raise ValueError('The mapper class %s is not a part of rvspecfit' %
+                         meta['cls'])
+    cls = getattr(importlib.import_module(modname), clsname)
+    if not isinstance(cls, type):
+        raise ValueError('The mapper %s is not a class' % meta['cls'])
+    mapper = cls.__new__(cls)
+    mapper.__dict__.update(meta['state'])
+    return mapper
@@ -0,0 +1,189 @@
+import sys
+import collections
+import functools
+import numpy as np
+
+
+class Cache:
+    """
+    LRU dictionary with the limit on the approximate memory footprint of the
+    stored values (and optionally on the number of entries). It keeps the
+    statistics of hits, misses and evictions.
+
+    The caches that are registered (the default) can be inspected with
+    cache_info(). A cache that lives in a module is shared by all the
+    calls in a given process (i.e. it is per worker), while a cache created
+    for a given object (i.e. per star) is dropped together with it.
+    """
+
+    def __init__(self, name, maxbytes=None, maxsize=None, register=True):
+        """
+        Parameters:
+        -----------
+        name: string
+            The name of the cache
+        maxbytes: integer (optional)
+            The maximum total size of stored values in bytes
+        maxsize: integer (optional)
+            The maximum number of entries
+        register: boolean (optional)
+            If true the cache is added to the registry of caches
+        """
+        self.name = name
+        self.maxbytes = maxbytes
+        self.maxsize = maxsize
+        self.D = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if register:
+            CacheRegistry.caches[name] = self
+
+    def __contains__(self, key):
+        return key in self.D
+
+    def __len__(self):
+        return len(self.D)
+
+    def __getitem__(self, key):
+        try:
+            ret = self.D[key][0]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        self.D.move_to_end(key, last=True)
+        return ret
+
+    def get(self, key, default=None):
+        """ Return the cached value or default if it is not there """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def put(self, key, value, nbytes=None):
+        """
+        Store the value. If nbytes is not given, the size is estimated with
+        get_nbytes()
+        """
+        if nbytes is None:
+            nbytes = get_nbytes(value)
+        if key in self.D:
+            self.nbytes -= self.D.pop(key)[1]
+        self.D[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while len(self.D) > 1 and (
+            (self.maxbytes is not None and self.nbytes > self.maxbytes) or
+            (self.maxsize is not None and len(self.D) > self.maxsize)):
+            self.nbytes -= self.D.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def clear(self):
+        """ Remove all the entries """
+        self.D.clear()
+        self.nbytes = 0
+
+    def info(self):
+        """ Return the dictionary with the statistics of the cache """
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self.D),
+            nbytes=self.nbytes,
+            maxbytes=self.maxbytes,
+            maxsize=self.maxsize)
+
+    def __str__(self):
+        return '%s: %s' % (self.name, self.info())
+
+
+class CacheRegistry:
+    """ Singleton with all the registered caches """
+    caches = collections.OrderedDict()
+
+
+def get_cache(name, maxbytes=None, maxsize=None):
+    """
+    Return the registered cache with a given name, creating it if
+    necessary.
+    """
+    if name not in CacheRegistry.caches:
+        Cache(name, maxbytes=maxbytes, maxsize=maxsize)
+    return CacheRegistry.caches[name]
+
+
+def cache_info():
+    """
+    Return the statistics of all the registered caches
+
+    Returns:
+    --------
+    ret: dict
+        The dictionary of statistics of each cache keyed by the cache name
+    """
+    return collections.OrderedDict([(k, v.info())
+                                    for k, v in CacheRegistry.caches.items()])
+
+
+def get_nbytes(obj, depth=2):
+    """
+    Estimate the memory footprint of an object. The numpy arrays are counted
+    fully, the containers and attributes of objects are followed to a given
+    depth.
+
+    Parameters:
+    -----------
+    obj: object
+        Any python object
+    depth: integer (optional)
+        How deep to follow the containers
+
+    Returns:
+    --------
+    nbytes: integer
+        The size in bytes
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    ret = sys.getsizeof(obj)
+    if depth == 0:
+        return ret
+    if isinstance(obj, (tuple, list)):
+        ret += sum([get_nbytes(_, depth - 1) for _ in obj])
+    elif isinstance(obj, dict):
+        ret += sum([get_nbytes(_, depth - 1) for _ in obj.values()])
+    elif hasattr(obj, '__dict__'):
+        ret += sum([get_nbytes(_, depth - 1) for _ in vars(obj).values()])
+    return ret
+
+
+def memoize(name, maxbytes=None, maxsize=None):
+    """
+    Decorator that caches the results of the function (like
+    functools.lru_cache) in a registered Cache. All the arguments must be
+    hashable.
+    """
+
+    def decorator(func):
+        curcache = get_cache(name, maxbytes=maxbytes, maxsize=maxsize)
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            try:
+                return curcache[args]
+            except KeyError:
+                pass
+            ret = func(*args)
+            curcache[args] = ret
+            return ret
+
+        wrapper.cache = curcache
+        return wrapper
+
+    return decorator
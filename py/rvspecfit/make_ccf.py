@@ -1,21 +1,29 @@
 from __future__ import print_function
 import pickle
 import argparse
+import json
+import shutil
+import hashlib
 import multiprocessing as mp
 import numpy as np
 import scipy.interpolate
 import scipy.stats
 import sys
+import os
 
 from rvspecfit import spec_fit
 from rvspecfit import make_interpol
 from rvspecfit import utils
+from rvspecfit import libfile
+from rvspecfit import shared_store
+from rvspecfit import lrucache
 from rvspecfit import _version
 git_rev = _version.VERSION
 
 CCF_PKL_NAME = 'ccf_%s.pkl'
 CCF_DAT_NAME = 'ccfdat_%s.npy'
 CCF_MOD_NAME = 'ccfmod_%s.npy'
+CCF_LIB_NAME = 'ccf_%s.rvslib'
 
 
 class CCFConfig:
@@ -53,7 +61,49 @@ class CCFConfig:
             splinestep, 3e5 * (np.exp((logl1 - logl0) / self.maxcontpts) - 1))
 
 
-def get_continuum(lam0, spec0, espec0, ccfconf=None, bin=11):
+def get_continuum_design(lam, splinestep):
+    """
+    Return the nodes of the continuum spline and the design matrix that
+    evaluates the spline (see fit_loss) with given values at the nodes on
+    a given wavelength grid. The matrices are cached for each wavelength
+    grid.
+
+    Parameters:
+    -----------
+    lam: numpy array
+        The wavelength vector
+    splinestep: float
+        The step between the nodes in km/s
+
+    Returns:
+    --------
+    nodes: numpy array
+        The wavelengths of the nodes
+    design: numpy array (Nwave, Nnodes)
+        The design matrix
+    """
+    lamgrid = spec_fit.get_lamgrid(lam)
+    key = (lamgrid.fingerprint, splinestep)
+    cache = lrucache.get_cache('continuum_design', maxbytes=100e6)
+    ret = cache.get(key)
+    if ret is None:
+        lam = lamgrid.lam
+        lammin = lam.min()
+        N = np.log(lam.max() / lammin) / np.log(1 + splinestep / 3e5)
+        N = int(np.ceil(N))
+        nodes = lammin * np.exp(np.arange(N) * np.log(1 + splinestep / 3e5))
+        # the interpolating spline is linear in the values at the nodes
+        design = np.array([
+            scipy.interpolate.UnivariateSpline(nodes, _, s=0, k=2)(lam)
+            for _ in np.eye(N)
+        ]).T
+        design.setflags(write=False)
+        ret = nodes, design
+        cache.put(key, ret, design.nbytes)
+    return ret
+
+
+def get_continuum(lam0, spec0, espec0, ccfconf=None, bin=11, method='irls'):
     """
     Determine the continuum of the spectrum by fitting a spline
 
@@ -63,54 +113,148 @@ def get_continuum(lam0, spec0, espec0, ccfconf=None, bin=11):
     lam0: numpy array
         The wavelength vector
     spec0: numpy array
-        The spectral vector
+        The spectral vector or the 2D array of spectra on the same
+        wavelength grid
     espec0: numpy array
-        The vector of spectral uncertainties
+        The vector (or 2D array) of spectral uncertainties
     ccfconf: CCFConfig object
         The CCF configuration object
     bin: integer, optional
         The input spectrum will be binned by median filter by this number before
         the fit
+    method: string, optional
+        'irls' (default) minimizes the L1 norm of the residuals by
+        iteratively reweighted least squares (see fit_continuum_irls),
+        'bfgs' directly minimizes the L1 norm with BFGS (slow)
 
     Returns:
     --------
     cont: numpy array
-        The continuum vector
-    """
-
-    lammin = lam0.min()
-    N = np.log(lam0.max() / lammin) / np.log(1 + ccfconf.splinestep / 3e5)
-    N = int(np.ceil(N))
-    # Determine the nodes of the spline used for the continuum fit
-    nodes = lammin * np.exp(
-        np.arange(N) * np.log(1 + ccfconf.splinestep / 3e5))
-    nodesedges = lammin * np.exp(
-        (-0.5 + np.arange(N + 1)) * np.log(1 + ccfconf.splinestep / 3e5))
-    medspec = np.median(spec0)
-    if medspec <= 0:
+        The continuum vector (or 2D array)
+    """
+    spec0 = np.asarray(spec0, dtype=np.float64)
+    espec0 = np.asarray(espec0, dtype=np.float64)
+    ndim = spec0.ndim
+    spec0 = np.atleast_2d(spec0)
+    espec0 = np.atleast_2d(espec0)
+
+    nodes, design = get_continuum_design(lam0, ccfconf.splinestep)
+    nodesedges = lam0.min() * np.exp(
+        (-0.5 + np.arange(len(nodes) + 1)) *
+        np.log(1 + ccfconf.splinestep / 3e5))
+    medspec = np.median(spec0, axis=1)
+    if (medspec <= 0).any():
         medspec = np.abs(medspec)
-        if medspec == 0:
-            medspec = 1
+        medspec[medspec == 0] = 1
         print('WARNING the spectrum has a median that is non-positive...')
 
-    BS = scipy.stats.binned_statistic(lam0, spec0, 'median', bins=nodesedges)
-    p0 = np.log(np.maximum(BS.statistic, 1e-3 * medspec))
-    p0[~np.isfinite(p0)] = np.log(medspec)
-
-    lam, spec, espec = (lam0[::bin], scipy.signal.medfilt(spec0, bin)[::bin],
-                        scipy.signal.medfilt(espec0, bin)[::bin])
-
-    res = scipy.optimize.minimize(
-        fit_loss,
-        p0,
-        args=(spec, espec, nodes, lam),
-        jac=False,
-        # method='Nelder-Mead'
-        method='BFGS')['x']
-    cont = fit_loss(res, spec0, espec0, nodes, lam0, getModel=True)
+    BS = scipy.stats.binned_statistic(lam0,
+                                      list(spec0),
+                                      'median',
+                                      bins=nodesedges)
+    p0 = np.log(np.maximum(BS.statistic, 1e-3 * medspec[:, None]))
+    p0 = np.where(np.isfinite(p0), p0, np.log(medspec)[:, None])
+
+    spec = scipy.signal.medfilt(spec0, [1, bin])[:, ::bin]
+    espec = scipy.signal.medfilt(espec0, [1, bin])[:, ::bin]
+    if method == 'irls':
+        res = fit_continuum_irls(design[::bin], spec, espec, p0)
+        cont = np.exp(np.dot(res, design.T))
+    elif method == 'bfgs':
+        cont = []
+        for curp0, curspec, curespec, curspec0, curespec0 in zip(
+                p0, spec, espec, spec0, espec0):
+            res = scipy.optimize.minimize(
+                fit_loss,
+                curp0,
+                args=(curspec, curespec, nodes, lam0[::bin]),
+                jac=False,
+                method='BFGS')['x']
+            cont.append(
+                fit_loss(res, curspec0, curespec0, nodes, lam0,
+                         getModel=True))
+        cont = np.array(cont)
+    else:
+        raise ValueError('Unknown continuum fitting method %s' % method)
+    if ndim == 1:
+        cont = cont[0]
     return cont
 
 
+def fit_continuum_irls(design, spec, espec, p0, maxiter=100, tol=1e-6,
+                       delta=1e-3):
+    """
+    Fit the continuum model exp(design * p) to the spectra minimizing the
+    L1 norm of the normalized residuals. The L1 norm is approximated by the
+    Huber loss with a small threshold, which is minimized by iteratively
+    reweighted Gauss-Newton least squares steps. All the spectra are fitted
+    at once.
+
+    Parameters:
+    -----------
+    design: numpy array (Nwave, Nnodes)
+        The design matrix of the spline (see get_continuum_design)
+    spec: numpy array (Nspec, Nwave)
+        The spectra
+    espec: numpy array (Nspec, Nwave)
+        The uncertainties
+    p0: numpy array (Nspec, Nnodes)
+        The starting values of the logarithm of the continuum at the nodes
+    maxiter: integer, optional
+        The maximum number of iterations
+    tol: float, optional
+        The tolerance on the change of the parameters
+    delta: float, optional
+        The threshold (in units of the uncertainty) below which the
+        residuals are penalized quadratically
+
+    Returns:
+    --------
+    p: numpy array (Nspec, Nnodes)
+        The best fit parameters
+    """
+    p = np.array(p0, dtype=np.float64)
+    nspec, nnodes = p.shape
+    damp = np.zeros(nspec) + 1e-3
+    eye = np.eye(nnodes)
+
+    def get_loss(p):
+        model = np.exp(np.dot(p, design.T))
+        resid = np.abs(spec - model) / espec
+        loss = np.where(resid < delta, 0.5 * resid**2 / delta + 0.5 * delta,
+                        resid).sum(axis=1)
+        loss[~np.isfinite(loss)] = np.inf
+        return model, loss
+
+    model, loss = get_loss(p)
+    active = np.ones(nspec, dtype=bool)
+    for i in range(maxiter):
+        resid = (spec - model) / espec
+        weights = 1. / (espec**2 * np.maximum(np.abs(resid), delta))
+        jac = model[:, :, None] * design[None, :, :]
+        matrix = np.einsum('ijk,ij,ijl->ikl', jac, weights, jac)
+        vector = np.einsum('ijk,ij->ik', jac, weights * (spec - model))
+        # Levenberg-Marquardt damping
+        diag = np.diagonal(matrix, axis1=1, axis2=2)[:, None, :] * eye
+        step = np.linalg.solve(matrix + damp[:, None, None] * diag,
+                               vector[:, :, None])[:, :, 0]
+        step[~active] = 0
+        newp = p + step
+        newmodel, newloss = get_loss(newp)
+        better = newloss <= loss
+        p[better] = newp[better]
+        model[better] = newmodel[better]
+        loss[better] = newloss[better]
+        damp = np.where(better, damp / 3, damp * 10)
+        # the fit has converged if the successful step is small
+        # or the damping grew too large
+        active = active & ~((better & (np.abs(step).max(axis=1) < tol)) |
+                            (damp > 1e10))
+        if not active.any():
+            break
+    return p
+
+
 def fit_loss(p, spec=None, espec=None, nodes=None, lam=None, getModel=False):
     """
     Return the loss function (L1 norm) of the continuum fit_loss
@@ -261,50 +405,184 @@ def preprocess_model(logl,
     return xlogl, cpa_model
 
 
-def preprocess_model_list(lammodels, models, params, ccfconf, vsinis=None):
+def _get_chunks(nmodels, nvsinis, chunk_size):
+    """
+    Split the list of models times vsinis into chunks.
+    Return the list of the ranges of the model indices and of the indices
+    of the resulting (model, vsini) pairs
+    """
+    chunk_size = max(chunk_size // nvsinis, 1)
+    ret = []
+    for i0 in range(0, nmodels, chunk_size):
+        i1 = min(i0 + chunk_size, nmodels)
+        ret.append(((i0, i1), (i0 * nvsinis, i1 * nvsinis)))
+    return ret
+
+
+def _preprocess_chunk(lammodels, models, params, ccfconf, vsinis):
+    """
+    Preprocess the chunk of models with all the vsinis and return the
+    2D array of processed models
     """
-    Apply preprocessing to the array of models
+    logl = np.linspace(ccfconf.logl0, ccfconf.logl1, ccfconf.npoints)
+    res = []
+    for m0, curparam in zip(models, params):
+        for vsini in vsinis:
+            xlogl, cpa_model = preprocess_model(logl, lammodels, m0, vsini,
+                                                ccfconf, curparam)
+            res.append(cpa_model)
+    return np.array(res)
+
+
+def _preprocess_chunk_to_file(workdir, ichunk, taskrange, lammodels, models,
+                              params, ccfconf, vsinis):
+    """
+    Preprocess and Fourier transform the chunk of models, write the results
+    into the memory-mapped output in the workdir and mark the chunk as
+    completed
+    """
+    res = _preprocess_chunk(lammodels, models, params, ccfconf, vsinis)
+    j0, j1 = taskrange
+    for name, curarr in [('models', res),
+                         ('ffts', np.fft.rfft(res, axis=1))]:
+        out = np.load('%s/%s.npy' % (workdir, name), mmap_mode='r+')
+        out[j0:j1] = curarr
+        out.flush()
+        del out
+    # the empty file marks the completed chunk
+    open(_chunk_marker(workdir, ichunk), 'w').close()
+    return ichunk
+
+
+def _chunk_marker(workdir, ichunk):
+    return '%s/chunk_%06d.done' % (workdir, ichunk)
+
+
+def build_ccf_models(lammodels,
+                     models,
+                     params,
+                     ccfconf,
+                     workdir,
+                     vsinis=None,
+                     nthreads=16,
+                     chunk_size=64):
+    """
+    Preprocess and Fourier transform the array of models in parallel.
+    The workers write the results directly into the memory-mapped arrays
+    in the working directory and every completed chunk is recorded there,
+    so the interrupted build is resumed when it is restarted with the same
+    inputs.
 
     Parameters:
+    -----------
     lammodels: numpy array
-        The array of wavelengths of the models (assumed to be the same for all models)
+        The array of wavelengths of the models
     models: numpy array
-        The 2D array of modell with the shape [number_of_models, len_of_model]
+        The 2D array of models with the shape [number_of_models, len_of_model]
     params: numpy array
-        The 2D array of template parameters (i.e. stellar atmospheric parameters
-        ) with the shape [number_of_models,length_of_parameter_vector]
+        The 2D array of template parameters with the shape
+        [number_of_models,length_of_parameter_vector]
     ccfconf: CCFConfig object
         CCF configuration
-    vsinis: list of floats
+    workdir: string
+        The working directory with the output arrays and checkpoints
+    vsinis: list of floats, optional
         The list of possible Vsini values to convolve model spectra with
-        Could be None
+    nthreads: integer, optional
+        The number of worker processes
+    chunk_size: integer, optional
+        The number of processed models computed by one task
+
+    Returns:
+    --------
+    xlogl: numpy array
+        The log-wavelength grid of the processed models
+    ret_models: numpy array
+        The memory-mapped array of processed models
+    ffts: numpy array
+        The memory-mapped array of their real Fourier transforms
+    retparams: list
+        The list of template parameters of the processed models
+    vsinisList: list
+        The list of vsinis of the processed models
     """
-    nthreads = 16
     logl = np.linspace(ccfconf.logl0, ccfconf.logl1, ccfconf.npoints)
-    res = []
-    retparams = []
-    norms = []
+    xlogl = pad(logl, np.zeros(len(logl)))[0]
+    nfft = len(xlogl)
     if vsinis is None:
         vsinis = [None]
+    params = np.asarray(params)
+    retparams = []
     vsinisList = []
-    pool = mp.Pool(nthreads)
-    q = []
-    for imodel, m0 in enumerate(models):
+    for imodel in range(len(models)):
         for vsini in vsinis:
             retparams.append(params[imodel])
-            q.append(
-                pool.apply_async(preprocess_model,
-                                 (logl, lammodels, m0, vsini, ccfconf,
-                                  (params[imodel]))))
             vsinisList.append(vsini)
-
-    for ii, curx in enumerate(q):
-        print(ii, '/', len(q))
-        xlogl, cpa_model = curx.get()
-        res.append(cpa_model)
-    pool.close()
-    pool.join()
-    return xlogl, res, retparams, vsinisList
+    ntot = len(retparams)
+    chunks = _get_chunks(len(models), len(vsinis), chunk_size)
+
+    # the description of the build that must match to resume it
+    state = dict(
+        ccfconf=ccfconf.__dict__,
+        vsinis=list(vsinis),
+        shape=list(models.shape),
+        chunk_size=chunk_size,
+        nfft=nfft,
+        lammodels=hashlib.sha1(
+            np.ascontiguousarray(lammodels, dtype=np.float64)).hexdigest(),
+        params=hashlib.sha1(np.ascontiguousarray(
+            params, dtype=np.float64)).hexdigest(),
+        models=hashlib.sha1(np.ascontiguousarray(models)).hexdigest(),
+        git_rev=git_rev)
+    state = json.loads(json.dumps(state))
+    statefile = '%s/state.json' % workdir
+    resume = False
+    if os.path.exists(statefile):
+        with open(statefile) as fp:
+            resume = json.load(fp) == state
+        if not resume:
+            print('The inputs of the build in %s changed, restarting' %
+                  workdir)
+            shutil.rmtree(workdir)
+    if not resume:
+        os.makedirs(workdir, exist_ok=True)
+        for name, dtype, width in [('models', np.float32, nfft),
+                                   ('ffts', np.complex64, nfft // 2 + 1)]:
+            out = np.lib.format.open_memmap('%s/%s.npy' % (workdir, name),
+                                            mode='w+',
+                                            dtype=dtype,
+                                            shape=(ntot, width))
+            del out
+        # the state is written last, so the partially initialized working
+        # directory is never resumed
+        with open(statefile, 'w') as fp:
+            json.dump(state, fp)
+
+    todo = [
+        _ for _ in range(len(chunks))
+        if not os.path.exists(_chunk_marker(workdir, _))
+    ]
+    if len(todo) < len(chunks):
+        print('Resuming the build, %d of %d chunks are completed' %
+              (len(chunks) - len(todo), len(chunks)))
+    if len(todo) > 0:
+        pool = mp.Pool(nthreads)
+        q = []
+        for ichunk in todo:
+            (i0, i1), taskrange = chunks[ichunk]
+            q.append(
+                pool.apply_async(_preprocess_chunk_to_file,
+                                 (workdir, ichunk, taskrange, lammodels,
+                                  models[i0:i1], params[i0:i1], ccfconf,
+                                  vsinis)))
+        for ii, curx in enumerate(q):
+            curx.get()
+            print('Chunk %d / %d' % (ii + 1, len(q)))
+        pool.close()
+        pool.join()
+    ret_models = np.load('%s/models.npy' % workdir, mmap_mode='r')
+    ffts = np.load('%s/ffts.npy' % workdir, mmap_mode='r')
+    return xlogl, ret_models, ffts, retparams, vsinisList
 
 
 def interp_masker(lam, spec, badmask):
@@ -368,30 +646,335 @@ def preprocess_data(lam, spec0, espec, ccfconf=None, badmask=None):
         The processed apodized/normalized/padded spectrum
 
     """
-    logl = np.linspace(ccfconf.logl0, ccfconf.logl1, ccfconf.npoints)
-    curespec = espec.copy()
-    curspec = spec0.copy()
     if badmask is not None:
-        curespec[badmask] = curespec[badmask] * 0 + 1e9
-        curspec = interp_masker(lam, curspec, badmask)
-    cont = get_continuum(lam, curspec, curespec, ccfconf=ccfconf)
-    medv = np.median(curspec)
-    if medv > 0:
-        cont = np.maximum(1e-2 * medv, cont)
-    else:
-        medv1 = np.median(curspec[curspec > 0])
-        cont = np.maximum(1e-2 * medv1, cont)
+        badmask = [badmask]
+    return preprocess_data_many(
+        lam, [spec0], [espec], ccfconf=ccfconf, badmasks=badmask)[0]
 
-    c_spec = spec0 / cont
-    c_spec = c_spec - np.median(c_spec)
-    ca_spec = apodize(c_spec)
-    if badmask is not None:
-        ca_spec[badmask] = 0
-    ca_spec = scipy.interpolate.interp1d(
-        np.log(lam), ca_spec, bounds_error=False, fill_value=0,
-        kind='linear')(logl)
-    lam1, cap_spec = pad(logl, ca_spec)
-    return cap_spec
+
+def preprocess_data_many(lam, specs, especs, ccfconf=None, badmasks=None):
+    """
+    Preprocess many spectra on the same wavelength grid
+    (see preprocess_data). The continua of all the spectra are fitted
+    at once.
+
+    Parameters:
+    -----------
+    lam: numpy array
+        The wavelength vector
+    specs: list of numpy arrays
+        The input spectra
+    especs: list of numpy arrays
+        The error-vectors of the spectra
+    ccfconf: CCFConfig object
+        The CCF configuration
+    badmasks: list of numpy arrays(boolean), optional
+        The optional masks for the CCF
+
+    Returns:
+    cap_specs: list of numpy arrays
+        The processed apodized/normalized/padded spectra
+
+    """
+    logl = np.linspace(ccfconf.logl0, ccfconf.logl1, ccfconf.npoints)
+    if badmasks is None:
+        badmasks = [None] * len(specs)
+    curspecs = []
+    curespecs = []
+    for spec0, espec, badmask in zip(specs, especs, badmasks):
+        curespec = espec.copy()
+        curspec = spec0.copy()
+        if badmask is not None:
+            curespec[badmask] = curespec[badmask] * 0 + 1e9
+            curspec = interp_masker(lam, curspec, badmask)
+        curspecs.append(curspec)
+        curespecs.append(curespec)
+    conts = get_continuum(lam,
+                          np.array(curspecs),
+                          np.array(curespecs),
+                          ccfconf=ccfconf)
+    ret = []
+    for spec0, curspec, cont, badmask in zip(specs, curspecs, conts,
+                                             badmasks):
+        medv = np.median(curspec)
+        if medv > 0:
+            cont = np.maximum(1e-2 * medv, cont)
+        else:
+            medv1 = np.median(curspec[curspec > 0])
+            cont = np.maximum(1e-2 * medv1, cont)
+
+        c_spec = spec0 / cont
+        c_spec = c_spec - np.median(c_spec)
+        ca_spec = apodize(c_spec)
+        if badmask is not None:
+            ca_spec[badmask] = 0
+        ca_spec = scipy.interpolate.interp1d(
+            np.log(lam), ca_spec, bounds_error=False, fill_value=0,
+            kind='linear')(logl)
+        lam1, cap_spec = pad(logl, ca_spec)
+        ret.append(cap_spec)
+    return ret
+
+
+def get_band_limit(ffts, band_tol=None):
+    """
+    Determine the number of the lowest frequency Fourier modes that carry
+    the signal of the templates
+
+    Parameters:
+    -----------
+    ffts: numpy array (Ntempl, Nmodes)
+        The real Fourier transforms of the templates
+    band_tol: float, optional
+        The highest frequency modes are discarded as long as their combined
+        power is below band_tol times the total power of the templates.
+        If None, all the modes are kept
+
+    Returns:
+    --------
+    nmodes: integer
+        The number of modes to keep
+    """
+    nmodes = ffts.shape[1]
+    if band_tol is None:
+        return nmodes
+    power = (np.abs(ffts)**2).sum(axis=0)
+    # the power of all the modes starting from a given one
+    tail = np.cumsum(power[::-1])[::-1]
+    xind = np.nonzero(tail <= band_tol * tail[0])[0]
+    if len(xind) > 0:
+        nmodes = max(xind[0], 1)
+    return nmodes
+
+
+def get_ccf_basis(ffts, basis_tol=1e-4):
+    """
+    Compute the orthonormal basis of the Fourier transformed templates by
+    the singular value decomposition, so that the CCF of every template is
+    a linear combination of the CCFs of the basis vectors.
+    The real and imaginary parts are decomposed together, so the
+    coefficients of the templates are real.
+
+    Parameters:
+    -----------
+    ffts: numpy array (Ntempl, Nmodes)
+        The real Fourier transforms of the templates
+    basis_tol: float, optional
+        The basis vectors are discarded as long as their combined
+        power is below basis_tol times the total power of the templates
+
+    Returns:
+    --------
+    basis: numpy array (Nbasis, Nmodes)
+        The Fourier transforms of the basis vectors
+    coeffs: numpy array (Ntempl, Nbasis)
+        The coefficients of the templates, i.e. ffts ~ coeffs @ basis
+    """
+    nmodes = ffts.shape[1]
+    stacked = np.hstack((ffts.real, ffts.imag)).astype(np.float64)
+    u, sv, vh = np.linalg.svd(stacked, full_matrices=False)
+    # the power of all the basis vectors starting from a given one
+    tail = np.cumsum((sv**2)[::-1])[::-1]
+    xind = np.nonzero(tail <= basis_tol * tail[0])[0]
+    nbasis = len(sv)
+    if len(xind) > 0:
+        nbasis = max(xind[0], 1)
+    basis = vh[:nbasis, :nmodes] + 1j * vh[:nbasis, nmodes:]
+    coeffs = u[:, :nbasis] * sv[None, :nbasis]
+    return basis, coeffs
+
+
+def check_ccf_storage(models,
+                      ffts,
+                      nfft,
+                      ntest=100,
+                      seed=1,
+                      block_size=256):
+    """
+    Check that the compressed Fourier transforms of the templates give the
+    same best template and CCF peak as the full precision ones. Randomly
+    chosen templates shifted by random lags with added noise are used as the
+    test spectra. The templates are processed in blocks, so only the CCFs
+    of block_size templates are kept in memory.
+
+    Parameters:
+    -----------
+    models: numpy array (Ntempl, Nfft)
+        The processed templates
+    ffts: numpy array (Ntempl, Nmodes)
+        The compressed real Fourier transforms of the templates
+    nfft: integer
+        The length of the templates
+    ntest: integer, optional
+        The number of test spectra
+    seed: integer, optional
+        The random seed
+    block_size: integer, optional
+        The number of templates processed at once
+
+    Returns:
+    --------
+    frac: float
+        The fraction of test spectra for which the best template and the
+        peak lag are unchanged
+    """
+    rng = np.random.RandomState(seed)
+    ntempl = len(models)
+    nmodes = ffts.shape[1]
+    spec_fftconjs = []
+    for i in range(ntest):
+        curid = rng.randint(ntempl)
+        spec = np.roll(models[curid], rng.randint(-nfft // 20, nfft // 20))
+        spec = spec + rng.normal(size=nfft) * np.abs(spec).max() * 0.1
+        spec_fftconjs.append(np.fft.rfft(spec).conj())
+    # the highest CCF peaks so far and their template and lag
+    # with the full and the compressed Fourier transforms
+    best_peak = np.zeros((2, ntest)) - np.inf
+    best_pos = np.zeros((2, ntest, 2), dtype=int)
+    for i0 in range(0, ntempl, block_size):
+        i1 = min(i0 + block_size, ntempl)
+        ffts_full = np.fft.rfft(models[i0:i1], axis=1)
+        for j, spec_fftconj in enumerate(spec_fftconjs):
+            for k, (curffts, curspec) in enumerate([
+                (ffts_full, spec_fftconj),
+                (ffts[i0:i1], spec_fftconj[:nmodes])
+            ]):
+                ccf = np.fft.irfft(curspec[None, :] * curffts,
+                                   n=nfft,
+                                   axis=1)
+                pos = np.unravel_index(np.argmax(ccf), ccf.shape)
+                if ccf[pos] > best_peak[k, j]:
+                    best_peak[k, j] = ccf[pos]
+                    best_pos[k, j] = (i0 + pos[0], pos[1])
+    nsame = (best_pos[0] == best_pos[1]).all(axis=1).sum()
+    return nsame * 1. / ntest
+
+
+def kmeans(data, k, niter=50, seed=1):
+    """
+    Cluster the vectors by the k-means algorithm with the k-means++
+    initialization
+
+    Parameters:
+    -----------
+    data: numpy array (N, Ndim)
+        The vectors
+    k: integer
+        The number of clusters
+    niter: integer, optional
+        The maximum number of iterations
+    seed: integer, optional
+        The random seed
+
+    Returns:
+    --------
+    labels: numpy array (N)
+        The cluster of each vector
+    """
+    rng = np.random.RandomState(seed)
+    norms = (data**2).sum(axis=1)
+
+    def get_dist(centers):
+        # the squared distances between the vectors and the centers
+        # without the (N, k, Ndim) temporary array
+        return np.maximum(
+            norms[:, None] - 2 * data.dot(centers.T) +
+            (centers**2).sum(axis=1)[None, :], 0)
+
+    centers = [data[rng.randint(len(data))]]
+    dist = get_dist(np.array(centers))[:, 0]
+    for i in range(1, k):
+        if dist.sum() == 0:
+            break
+        centers.append(data[rng.choice(len(data), p=dist / dist.sum())])
+        dist = np.minimum(dist, get_dist(centers[-1][None, :])[:, 0])
+    centers = np.array(centers)
+    labels = None
+    for i in range(niter):
+        dist = get_dist(centers)
+        newlabels = np.argmin(dist, axis=1)
+        if labels is not None and (newlabels == labels).all():
+            break
+        labels = newlabels
+        for j in range(len(centers)):
+            if (labels == j).any():
+                centers[j] = data[labels == j].mean(axis=0)
+    # remove the empty clusters
+    return np.unique(labels, return_inverse=True)[1]
+
+
+def build_ccf_tree(ffts, branching=8, leafsize=8):
+    """
+    Build the tree of templates clustered by the similarity of their spectra
+    for the hierarchical CCF search (see fitter_ccf.fit_many).
+    The templates are clustered by their normalized Fourier amplitudes,
+    which do not depend on the velocity shift. Each node of the tree is
+    represented by the template closest to the center of its cluster.
+    The leaves contain at most leafsize templates.
+
+    Parameters:
+    -----------
+    ffts: numpy array (Ntempl, Nmodes) or list of numpy arrays
+        The Fourier transforms of the templates. If the list of the
+        Fourier transforms of the same templates in several spectral setups
+        is given, the templates are clustered by the amplitudes from all the
+        setups with equal weights
+    branching: integer, optional
+        The number of children of each node
+    leafsize: integer, optional
+        The maximum number of templates in the leaf
+
+    Returns:
+    --------
+    tree: dict
+        The dictionary with the arrays describing the tree: the
+        representative template of each node (tree_rep), the
+        children of each node (tree_child_ind[tree_child_ptr[i]:
+        tree_child_ptr[i+1]] for node i) and the templates in the leaves
+        (tree_leaf_ind[tree_leaf_ptr[i]:tree_leaf_ptr[i+1]]). The node 0 is
+        the root.
+    """
+    if not isinstance(ffts, (list, tuple)):
+        ffts = [ffts]
+    feats = []
+    for curffts in ffts:
+        curfeats = np.abs(curffts)
+        curfeats = curfeats / np.maximum(
+            np.sqrt((curfeats**2).sum(axis=1))[:, None], 1e-300)
+        feats.append(curfeats / np.sqrt(len(ffts)))
+    feats = np.hstack(feats)
+    reps = []
+    children = []
+    leaves = []
+
+    def add_node(members):
+        curnode = len(reps)
+        center = feats[members].mean(axis=0)
+        reps.append(
+            members[np.argmin(((feats[members] - center)**2).sum(axis=1))])
+        children.append([])
+        leaves.append([])
+        labels = None
+        if len(members) > leafsize:
+            labels = kmeans(feats[members], min(branching, len(members)))
+            if labels.max() == 0:
+                # the templates are indistinguishable
+                labels = None
+        if labels is None:
+            leaves[curnode] = list(members)
+        else:
+            for i in range(labels.max() + 1):
+                children[curnode].append(add_node(members[labels == i]))
+        return curnode
+
+    add_node(np.arange(len(feats)))
+    tree = {}
+    tree['tree_rep'] = np.array(reps)
+    tree['tree_child_ptr'] = np.cumsum([0] + [len(_) for _ in children])
+    tree['tree_child_ind'] = np.array(sum(children, []), dtype=int)
+    tree['tree_leaf_ptr'] = np.cumsum([0] + [len(_) for _ in leaves])
+    tree['tree_leaf_ind'] = np.array(sum(leaves, []), dtype=int)
+    return tree
 
 
 def ccf_executor(spec_setup,
@@ -399,7 +982,12 @@ def ccf_executor(spec_setup,
                  prefix=None,
                  oprefix=None,
                  every=10,
-                 vsinis=None):
+                 vsinis=None,
+                 band_tol=None,
+                 tree_branching=None,
+                 basis_tol=None,
+                 nthreads=16,
+                 chunk_size=64):
     """
     Prepare the FFT transformations for the CCF
 
@@ -418,18 +1006,30 @@ def ccf_executor(spec_setup,
     vsinis: list (optional)
         Produce FFTS of the templates  with Vsini from the list.
         Could be None (it means no rotation will be added)
+    band_tol: float (optional)
+        If specified, only the low frequency Fourier modes are stored
+        (see get_band_limit)
+    tree_branching: integer (optional)
+        If specified, the tree of templates for the hierarchical search with
+        this number of children of each node is stored (see build_ccf_tree)
+    basis_tol: float (optional)
+        If specified, the orthonormal basis of the templates is stored
+        for the eigen-template CCF (see get_ccf_basis)
+    nthreads: integer (optional)
+        The number of worker processes
+    chunk_size: integer (optional)
+        The number of templates processed by one task. The interrupted
+        build is resumed from the last completed chunks
+        (see build_ccf_models)
 
     Returns:
     --------
     Nothing
     """
 
-    with open(('%s/' + make_interpol.SPEC_PKL_NAME) % (prefix, spec_setup),
-              'rb') as fp:
-        D = pickle.load(fp)
-        vec, specs, lam, parnames = D['vec'], D['specs'], D['lam'], D[
-            'parnames']
-        del D
+    D = make_interpol.read_specs(prefix, spec_setup)
+    vec, specs, lam, parnames = D['vec'], D['specs'], D['lam'], D['parnames']
+    del D
 
     ndim = len(vec[:, 0])
 
@@ -437,23 +1037,132 @@ def ccf_executor(spec_setup,
     vec = vec.T[::every, :]
     nspec, lenspec = specs.shape
 
-    xlogl, models, params, vsinis = preprocess_model_list(
-        lam, np.exp(specs), vec, ccfconf, vsinis=vsinis)
-    ffts = np.array([np.fft.fft(x) for x in models])
-    savefile = ('%s/' + CCF_PKL_NAME) % (oprefix, spec_setup)
-    datsavefile = ('%s/' + CCF_DAT_NAME) % (oprefix, spec_setup)
-    modsavefile = ('%s/' + CCF_MOD_NAME) % (oprefix, spec_setup)
-    dHash = {}
-    dHash['params'] = params
-    dHash['ccfconf'] = ccfconf
-    dHash['loglambda'] = xlogl
-    dHash['vsinis'] = vsinis
-    dHash['parnames'] = parnames
-
-    with open(savefile, 'wb') as fp:
-        pickle.dump(dHash, fp)
-    np.save(datsavefile, np.array(ffts))
-    np.save(modsavefile, np.array(models))
+    savefile = ('%s/' + CCF_LIB_NAME) % (oprefix, spec_setup)
+    workdir = savefile + '.build'
+    # the templates are real, so only the half of the Fourier transform
+    # is stored and the single precision is enough for the CCF
+    xlogl, models, ffts, params, vsinis = build_ccf_models(
+        lam,
+        np.exp(specs),
+        vec,
+        ccfconf,
+        workdir,
+        vsinis=vsinis,
+        nthreads=nthreads,
+        chunk_size=chunk_size)
+    nfft = models.shape[1]
+    nmodes = get_band_limit(ffts, band_tol)
+    ffts = np.array(ffts[:, :nmodes])
+    frac = check_ccf_storage(models, ffts, nfft)
+    print('Storing %d of %d Fourier modes; the best template and '
+          'velocity are unchanged for %.1f%% of test spectra' %
+          (nmodes, nfft // 2 + 1, frac * 100))
+    if frac < 1:
+        print('WARNING the compression of the CCF templates changes '
+              'the results; consider decreasing band_tol')
+    if basis_tol is not None:
+        basis, coeffs = get_ccf_basis(ffts, basis_tol)
+        basis = basis.astype(np.complex64)
+        coeffs = coeffs.astype(np.float32)
+        frac = check_ccf_storage(models, np.dot(coeffs, basis), nfft)
+        print('Storing %d basis vectors; the best template and velocity are '
+              'unchanged for %.1f%% of test spectra' %
+              (len(basis), frac * 100))
+        if frac < 1:
+            print('WARNING the basis of the CCF templates changes '
+                  'the results; consider decreasing basis_tol')
+    arrays = {}
+    arrays['params'] = np.asarray(params)
+    arrays['loglambda'] = xlogl
+    # no rotation is stored as NaN
+    arrays['vsinis'] = np.array([np.nan if _ is None else _ for _ in vsinis])
+    arrays['ffts'] = ffts
+    arrays['models'] = models
+    if tree_branching is not None:
+        arrays.update(
+            build_ccf_tree(ffts,
+                           branching=tree_branching,
+                           leafsize=tree_branching))
+    if basis_tol is not None:
+        arrays['basis'] = basis
+        arrays['basis_coeffs'] = coeffs
+    meta = {}
+    meta['nfft'] = nfft
+    meta['ccfconf'] = ccfconf.__dict__
+    meta['parnames'] = list(parnames)
+    meta['git_rev'] = git_rev
+    libfile.write(savefile, arrays, meta)
+    shutil.rmtree(workdir)
+
+
+def read_ccf(prefix, spec_setup):
+    """
+    Read the CCF templates produced by ccf_executor
+
+    Parameters:
+    -----------
+    prefix: string
+        The location of the files
+    spec_setup: string
+        The name of the spectroscopic setup
+
+    Returns:
+    --------
+    ffts: numpy array
+        The real Fourier transforms of the templates (possibly
+        only the lowest frequency modes)
+    models: numpy array
+        The templates
+    info: dict
+        The dictionary with the CCF configuration (ccfconf), template
+        parameters (params), parameter names (parnames), the vsini values
+        (vsinis), the log-wavelength grid (loglambda), the length of
+        the templates (nfft), the tree of templates (tree, see
+        build_ccf_tree) or None and the tuple of the basis and the
+        coefficients of the templates (basis, see get_ccf_basis) or None
+    """
+    fname = ('%s/' + CCF_LIB_NAME) % (prefix, spec_setup)
+    if os.path.exists(fname):
+        arrays, meta = libfile.read(fname)
+        arrays = shared_store.get_library_arrays(fname, arrays)
+        info = {}
+        info['params'] = arrays['params']
+        info['loglambda'] = arrays['loglambda']
+        info['vsinis'] = [
+            None if np.isnan(_) else float(_) for _ in arrays['vsinis']
+        ]
+        info['parnames'] = tuple(meta['parnames'])
+        info['ccfconf'] = CCFConfig(**meta['ccfconf'])
+        info['tree'] = None
+        if 'tree_rep' in arrays:
+            info['tree'] = dict([(_, arrays[_]) for _ in arrays
+                                 if _.startswith('tree_')])
+        info['basis'] = None
+        if 'basis' in arrays:
+            info['basis'] = (arrays['basis'], arrays['basis_coeffs'])
+        ffts = arrays['ffts']
+        if 'nfft' in meta:
+            info['nfft'] = meta['nfft']
+        else:
+            # full complex Fourier transforms
+            info['nfft'] = ffts.shape[1]
+            ffts = ffts[:, :info['nfft'] // 2 + 1]
+        return ffts, arrays['models'], info
+    # the legacy pickle and npy files
+    with open(('%s/' + CCF_PKL_NAME) % (prefix, spec_setup), 'rb') as fp:
+        info = pickle.load(fp)
+    ret = []
+    for curname in [CCF_DAT_NAME, CCF_MOD_NAME]:
+        curfname = ('%s/' + curname) % (prefix, spec_setup)
+        curdat = shared_store.get_library_array(curfname)
+        if curdat is None:
+            curdat = np.load(curfname, mmap_mode='r')
+        ret.append(curdat)
+    # the full complex Fourier transforms
+    info['nfft'] = ret[0].shape[1]
+    info['tree'] = None
+    info['basis'] = None
+    return ret[0][:, :info['nfft'] // 2 + 1], ret[1], info
 
 
 def main(args):
@@ -476,6 +1185,36 @@ def main(args):
         type=str,
         default=None,
         help='Comma separated list of vsini values to include in the ccf set')
+    parser.add_argument(
+        '--band_tol',
+        type=float,
+        default=None,
+        help='Only store the low frequency Fourier modes, discarding the '
+        'modes with this fraction of the total power')
+    parser.add_argument(
+        '--tree_branching',
+        type=int,
+        default=None,
+        help='Store the tree of templates with this branching factor for '
+        'the hierarchical CCF search')
+    parser.add_argument(
+        '--basis_tol',
+        type=float,
+        default=None,
+        help='Store the orthonormal basis of the templates, discarding the '
+        'basis vectors with this fraction of the total power, for the '
+        'eigen-template CCF')
+    parser.add_argument(
+        '--nthreads',
+        type=int,
+        default=16,
+        help='The number of worker processes')
+    parser.add_argument(
+        '--chunk_size',
+        type=int,
+        default=64,
+        help='The number of templates processed by one task; the '
+        'interrupted build is resumed from the completed chunks')
     parser.add_argument(
         '--every',
         type=int,
@@ -495,7 +1234,12 @@ def main(args):
     else:
         vsinis = None
     ccf_executor(args.setup, ccfconf, args.prefix, args.oprefix, args.every,
-                 vsinis)
+                 vsinis,
+                 band_tol=args.band_tol,
+                 tree_branching=args.tree_branching,
+                 basis_tol=args.basis_tol,
+                 nthreads=args.nthreads,
+                 chunk_size=args.chunk_size)
 
 
 if __name__ == '__main__':
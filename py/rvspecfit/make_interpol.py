@@ -11,10 +11,12 @@ import numpy as np
 import sqlite3
 from rvspecfit import read_grid
 from rvspecfit import utils
+from rvspecfit import libfile
 from rvspecfit import _version
 git_rev = _version.VERSION
 
 SPEC_PKL_NAME = 'specs_%s.pkl'
+SPEC_LIB_NAME = 'specs_%s.rvslib'
 
 
 def get_line_continuum(lam, spec):
@@ -154,15 +156,42 @@ def process_all(setupInfo,
     pool.close()
     pool.join()
     specs = np.array(specs)
-    with open(('%s/' + SPEC_PKL_NAME) % (oprefix, HR), 'wb') as fp:
-        pickle.dump(
-            dict(
-                specs=specs,
-                vec=vec,
-                lam=lam,
-                parnames=parnames,
-                git_rev=git_rev,
-                mapper=mapper), fp)
+    libfile.write(('%s/' + SPEC_LIB_NAME) % (oprefix, HR),
+                  dict(specs=specs, vec=vec, lam=lam),
+                  dict(parnames=list(parnames),
+                       git_rev=git_rev,
+                       mapper=libfile.mapper_to_meta(mapper)))
+
+
+def read_specs(prefix, spec_setup):
+    """
+    Read the set of spectra produced by process_all
+
+    Parameters:
+    -----------
+    prefix: string
+        The location of the files
+    spec_setup: string
+        The name of the spectroscopic setup
+
+    Returns:
+    --------
+    ret: dict
+        The dictionary with the spectra (specs), their parameters (vec),
+        wavelength (lam), the parameter names (parnames) and the
+        parameter mapper (mapper)
+    """
+    fname = ('%s/' + SPEC_LIB_NAME) % (prefix, spec_setup)
+    if os.path.exists(fname):
+        arrays, meta = libfile.read(fname)
+        return dict(specs=arrays['specs'],
+                    vec=arrays['vec'],
+                    lam=arrays['lam'],
+                    parnames=tuple(meta['parnames']),
+                    mapper=libfile.mapper_from_meta(meta['mapper']))
+    # the legacy pickle
+    with open(('%s/' + SPEC_PKL_NAME) % (prefix, spec_setup), 'rb') as fp:
+        return pickle.load(fp)
 
 
 def main(args):
@@ -1,16 +1,25 @@
-import pickle
 import argparse
 import numpy as np
 import numpy.random
 import scipy.spatial
+import scipy.linalg
 
 from rvspecfit import utils
 from rvspecfit import make_interpol
+from rvspecfit import libfile
 from rvspecfit import _version
 git_rev = _version.VERSION
 
 INTERPOL_PKL_NAME = 'interp_%s.pkl'
 INTERPOL_DAT_NAME = 'interpdat_%s.npy'
+INTERPOL_BASIS_NAME = 'interpbasis_%s.npy'
+INTERPOL_LIB_NAME = 'interp_%s.rvslib'
+
+# pad each dimension by this amount (relative to the dimension width)
+EDGE_PAD = 0.2
+# the minimum fraction of the nodes of the rectilinear grid that must
+# have spectra for the grid to be treated as rectilinear
+RECT_MIN_FILL = 0.5
 
 
 def getedgevertices(vec):
@@ -30,7 +39,7 @@ def getedgevertices(vec):
         The returned array of surrounding points
     """
 
-    pad = 0.2  # pad each dimension by this amount (relative to the dimension width)
+    pad = EDGE_PAD
     ndim = len(vec[:, 0])
     span = vec.ptp(axis=1)
     lspans = vec.min(axis=1) - pad * span
@@ -49,7 +58,137 @@ def getedgevertices(vec):
     return positions
 
 
-def execute(spec_setup, prefix=None, perturb=True):
+def get_rect_grid(vec, min_fill=RECT_MIN_FILL):
+    """
+    Check if the set of n-dimensional points forms a rectilinear (possibly
+    ragged, i.e. with some nodes missing) grid
+
+    Parameters:
+    -----------
+    vec: numpy (Ndim, Npts)
+        The array of input points
+    min_fill: float
+        The minimum fraction of grid nodes that must be present
+
+    Returns:
+    --------
+    ret: tuple or None
+        None if the points do not form a rectilinear grid, otherwise the
+        tuple of the list of grid axes and the integer array of the shape
+        of the grid with the indices of the points in each node (-1 for
+        missing nodes)
+    """
+    ndim, npts = vec.shape
+    axes = []
+    positions = []
+    for i in range(ndim):
+        x = vec[i]
+        tol = 1e-6 * max(np.ptp(x), 1e-10)
+        xs = np.unique(x)
+        # values within tolerance are considered the same node
+        axis = xs[np.r_[True, np.diff(xs) > tol]]
+        if len(axis) < 2:
+            return None
+        pos = np.searchsorted(axis, x + tol, side='right') - 1
+        if np.any(np.abs(axis[pos] - x) > tol):
+            return None
+        axes.append(axis)
+        positions.append(pos)
+    shape = tuple([len(_) for _ in axes])
+    if np.prod(shape) * min_fill > npts:
+        return None
+    node_index = np.zeros(shape, dtype=int) - 1
+    node_index[tuple(positions)] = np.arange(npts)
+    if (node_index >= 0).sum() != npts:
+        # duplicated points
+        return None
+    return axes, node_index
+
+
+def get_pca(specs, npca):
+    """
+    Compute the truncated PCA decomposition of the set of spectra
+
+    Parameters:
+    -----------
+    specs: numpy (Nspec, Npix)
+        The array of spectra
+    npca: integer
+        The number of principal components
+
+    Returns:
+    --------
+    basis: numpy (npca+1, Npix)
+        The basis, where the first vector is the mean spectrum
+        and the rest are principal components
+    """
+    mean = specs.mean(axis=0)
+    npca = min(npca, specs.shape[0] - 1, specs.shape[1] - 1)
+    u, s, vt = scipy.linalg.svd(specs - mean[None, :], full_matrices=False)
+    return np.vstack((mean[None, :], vt[:npca]))
+
+
+def save_library(spec_setup, prefix, ret_dict, specs, nspec, npca=None):
+    """
+    Save the interpolation object and the spectra of the grid nodes
+    in the library file. If requested the spectra are stored as the
+    coefficients of the PCA basis.
+
+    Parameters:
+    -----------
+    spec_setup: string
+        The spectroscopic configuration
+    prefix: string
+        The location where the files are stored
+    ret_dict: dict
+        The interpolation object
+    specs: numpy (Nnodes, Npix)
+        The spectra of the nodes
+    nspec: integer
+        The number of the real spectra (they come first)
+    npca: integer or None
+        The number of PCA components
+    """
+    specs = specs.astype(np.float64)
+    arrays = {}
+    meta = {}
+    meta['interp_type'] = ret_dict['interp_type']
+    meta['parnames'] = list(ret_dict['parnames'])
+    meta['mapper'] = libfile.mapper_to_meta(ret_dict['mapper'])
+    meta['git_rev'] = git_rev
+    meta['npca'] = npca
+    for k in ['lam', 'vec', 'extraflags']:
+        arrays[k] = ret_dict[k]
+    if meta['interp_type'] == 'delaunay':
+        triang = ret_dict['triang']
+        arrays['points'] = triang.points
+        arrays['simplices'] = triang.simplices
+        arrays['transform'] = triang.transform
+        arrays['neighbors'] = triang.neighbors
+    else:
+        meta['ndim'] = len(ret_dict['axes'])
+        for i, axis in enumerate(ret_dict['axes']):
+            arrays['axis%d' % i] = axis
+        arrays['node_index'] = ret_dict['node_index']
+    if npca is not None:
+        basis = get_pca(specs[:nspec], npca)
+        # the coefficient of the mean spectrum is always one, so the mixture
+        # of coefficients with the weights summing to one gives the
+        # coefficients of the mixed spectrum
+        coeffs = (specs - basis[0][None, :]).dot(basis[1:].T)
+        coeffs = np.hstack((np.ones((len(specs), 1)), coeffs))
+        resid = coeffs[:nspec].dot(basis) - specs[:nspec]
+        meta['pca_error'] = (np.sqrt((resid**2).mean()), np.abs(resid).max())
+        print('PCA with %d components: reconstruction error rms=%g max=%g' %
+              ((len(basis) - 1, ) + tuple(meta['pca_error'])))
+        arrays['basis'] = basis
+        specs = coeffs
+    arrays['dats'] = np.asfortranarray(specs)
+    libfile.write(('%s/' + INTERPOL_LIB_NAME) % (prefix, spec_setup), arrays,
+                  meta)
+
+
+def execute(spec_setup, prefix=None, perturb=True, rect=True, npca=None):
     """
     Prepare the triangulation objects for the set of spectral data for a given
     spec_setup.
@@ -66,6 +205,12 @@ def execute(spec_setup, prefix=None, perturb=True):
         triangulation. This prevents issues with degenerate vertices and stability
         of triangulation. Without perturbation find_simplex for example may revert
         to brute force search.
+    rect: boolean
+        If true and the spectra form a rectilinear grid, the multilinear
+        interpolation on the grid is used instead of the triangulation
+    npca: integer or None
+        If set, the spectra are stored compressed as the coefficients of the
+        given number of principal components
 
     Returns:
     --------
@@ -74,16 +219,47 @@ def execute(spec_setup, prefix=None, perturb=True):
     perturbation_amplitude = 1e-6
 
     postf = ''
-    with open(('%s/' + make_interpol.SPEC_PKL_NAME) % (prefix, spec_setup),
-              'rb') as fp:
-        D = pickle.load(fp)
-        vec, specs, lam, parnames, mapper = D['vec'], D['specs'], D['lam'], D[
-            'parnames'], D['mapper']
-        del D
+    D = make_interpol.read_specs(prefix, spec_setup)
+    vec, specs, lam, parnames, mapper = D['vec'], D['specs'], D['lam'], D[
+        'parnames'], D['mapper']
+    del D
 
     vec = vec.astype(float)
     vec = mapper.forward(vec)
     ndim = len(vec[:, 0])
+    nspec, lenspec = specs.shape
+    fakespec = np.ones(lenspec)
+
+    rect_grid = None
+    if rect:
+        rect_grid = get_rect_grid(vec)
+    if rect_grid is not None:
+        axes, node_index = rect_grid
+        # pad the grid by one node in each direction, and map the padding
+        # nodes and the missing nodes to the constant spectrum with the
+        # outside flag set
+        axes = [
+            np.r_[_[0] - EDGE_PAD * np.ptp(_), _, _[-1] + EDGE_PAD * np.ptp(_)]
+            for _ in axes
+        ]
+        node_index = np.pad(node_index, 1, mode='constant', constant_values=-1)
+        node_index[node_index < 0] = nspec
+        specs = np.append(specs, fakespec[None, :], axis=0)
+        extraflags = np.concatenate((np.zeros(nspec), np.ones(1)))
+        print('Using the rectilinear grid of shape %s with %d missing nodes' %
+              (str(node_index.shape), (node_index == nspec).sum()))
+
+        ret_dict = {}
+        ret_dict['interp_type'] = 'rect'
+        ret_dict['lam'] = lam
+        ret_dict['axes'] = axes
+        ret_dict['node_index'] = node_index
+        ret_dict['extraflags'] = extraflags.astype(np.float64)[:, None]
+        ret_dict['vec'] = vec
+        ret_dict['parnames'] = parnames
+        ret_dict['mapper'] = mapper
+        save_library(spec_setup, prefix, ret_dict, specs, nspec, npca=npca)
+        return
 
     # It turn's out that Delaunay is sometimes unstable when dealing with uniform
     # grids, so perturb points
@@ -99,8 +275,6 @@ def execute(spec_setup, prefix=None, perturb=True):
     edgepositions = getedgevertices(vec)
     vec = np.hstack((vec, edgepositions))
 
-    nspec, lenspec = specs.shape
-    fakespec = np.ones(lenspec)
     # add constant spectra to the grid at the edge locations
     specs = np.append(specs, np.tile(fakespec, (2**ndim, 1)), axis=0)
 
@@ -115,19 +289,15 @@ def execute(spec_setup, prefix=None, perturb=True):
 
     triang = scipy.spatial.Delaunay(vec.T)
 
-    savefile = ('%s/' + INTERPOL_PKL_NAME) % (prefix, spec_setup)
     ret_dict = {}
+    ret_dict['interp_type'] = 'delaunay'
     ret_dict['lam'] = lam
     ret_dict['triang'] = triang
     ret_dict['extraflags'] = extraflags
     ret_dict['vec'] = vec
     ret_dict['parnames'] = parnames
     ret_dict['mapper'] = mapper
-
-    with open(savefile, 'wb') as fp:
-        pickle.dump(ret_dict, fp)
-    np.save(('%s/' + INTERPOL_DAT_NAME) % (prefix, spec_setup),
-            np.asfortranarray(specs))
+    save_library(spec_setup, prefix, ret_dict, specs, nspec, npca=npca)
 
 
 def main(args):
@@ -139,8 +309,20 @@ def main(args):
         help='Location of the interpolated and convolved input spectra')
     parser.add_argument(
         '--setup', type=str, help='Name of the spectral configuration')
+    parser.add_argument(
+        '--delaunay',
+        action='store_true',
+        default=False,
+        help='Always use the Delaunay triangulation even if the spectra '
+        'form a rectilinear grid')
+    parser.add_argument(
+        '--npca',
+        type=int,
+        default=None,
+        help='Store the spectra compressed using this number of principal '
+        'components')
     args = parser.parse_args(args)
-    execute(args.setup, args.prefix)
+    execute(args.setup, args.prefix, rect=not args.delaunay, npca=args.npca)
 
 
 if __name__ == '__main__':
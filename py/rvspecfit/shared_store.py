@@ -0,0 +1,413 @@
+import os
+import time
+import json
+import binascii
+import resource
+import hashlib
+import collections
+import multiprocessing.util
+import numpy as np
+from rvspecfit import libfile
+try:
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+except ImportError:
+    # python < 3.8 or not posix
+    shared_memory = None
+    resource_tracker = None
+
+
+class SharedStore:
+    """
+    Store of tuples of numpy arrays in named shared memory segments, so that
+    different processes on the same node (i.e. workers of a pool) can reuse
+    each other's results. The entries are identified by hashable keys and
+    are never modified after they are written.
+
+    Every process owns the segments it created. It keeps their names (not
+    open handles) and evicts the least recently used ones when their total
+    size exceeds the byte budget. The remaining segments are removed when
+    the process exits.
+
+    The segments start with the JSON header describing the arrays (like
+    the library files, see libfile). The segments of other users and the
+    segments with malformed headers are ignored.
+    """
+    # the size of the leading part of the segment with the ready flag
+    # and the length of the header
+    _preamble = 9
+    _align = 64
+
+    def __init__(self, prefix, maxbytes=None):
+        """
+        Parameters:
+        -----------
+        prefix: string
+            The prefix of the segment names. Only the processes using the
+            same prefix share the entries.
+        maxbytes: integer (optional)
+            The maximum total size of the segments created by this process
+        """
+        if shared_memory is None:
+            raise Exception('The shared memory store requires python>=3.8')
+        self.prefix = prefix
+        self.maxbytes = maxbytes
+        # the names and sizes of segments created by this process
+        # in the order of their last use
+        self.segments = collections.OrderedDict()
+        self.nbytes = 0
+        # the segments created by other processes that we attached to
+        self.attached = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        multiprocessing.util.Finalize(self, self.cleanup, exitpriority=10)
+
+    def _segname(self, key):
+        return self.prefix + hashlib.sha1(repr(key).encode()).hexdigest()[:20]
+
+    def get(self, key):
+        """
+        Return the copy of the arrays stored under a given key or None if
+        they are not there (yet)
+        """
+        name = self._segname(key)
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        _untrack(shm)
+        if name in self.segments:
+            self.segments.move_to_end(name, last=True)
+        try:
+            views = self._views(shm)
+            ret = None
+            if views is not None:
+                ret = tuple([_.copy() for _ in views])
+            del views
+        finally:
+            shm.close()
+        if ret is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return ret
+
+    def attach(self, key):
+        """
+        Return the read-only arrays stored under a given key without copying
+        them or None if they are not there (yet). The segment stays
+        attached until the process exits.
+        """
+        if key in self.attached:
+            self.hits += 1
+            return self.attached[key][1]
+        try:
+            shm = shared_memory.SharedMemory(name=self._segname(key))
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        _untrack(shm)
+        ret = self._views(shm)
+        if ret is None:
+            shm.close()
+            self.misses += 1
+            return None
+        for curarr in ret:
+            curarr.flags.writeable = False
+        self.attached[key] = (shm, ret)
+        self.hits += 1
+        return ret
+
+    def _views(self, shm):
+        """ Return the arrays in the segment or None if the segment is
+        not complete or not valid """
+        if os.fstat(shm._fd).st_uid != os.getuid():
+            return None
+        buf = shm.buf
+        if len(buf) < self._preamble or buf[0] != 1:
+            # the writer has not finished
+            return None
+        hlen = int.from_bytes(bytes(buf[1:self._preamble]), 'little')
+        try:
+            header = json.loads(
+                bytes(buf[self._preamble:self._preamble + hlen]).decode())
+            ret = []
+            for curarr in header:
+                dtype = np.dtype(curarr['dtype'])
+                if dtype.hasobject:
+                    raise ValueError('Object arrays are not supported')
+                ret.append(
+                    np.ndarray(tuple(curarr['shape']),
+                               dtype=dtype,
+                               buffer=buf,
+                               offset=curarr['offset'],
+                               order=curarr['order']))
+        except (ValueError, TypeError, KeyError):
+            return None
+        return tuple(ret)
+
+    def put(self, key, arrays):
+        """
+        Store the tuple of arrays under a given key. If the key is already
+        present, nothing is done.
+        """
+        arrays = [
+            _ if _.flags.f_contiguous else np.ascontiguousarray(_)
+            for _ in arrays
+        ]
+        orders = [
+            'C' if _.flags.c_contiguous else 'F' for _ in arrays
+        ]
+        # the header needs the offsets of arrays and the offsets depend
+        # on the header length, so use a generous upper limit on the latter
+        header0 = json.dumps([
+            dict(dtype=_.dtype.str,
+                 shape=list(_.shape),
+                 offset=2**62,
+                 order='C') for _ in arrays
+        ]).encode()
+        offset = self._roundup(self._preamble + len(header0))
+        header = []
+        for curarr, order in zip(arrays, orders):
+            header.append(
+                dict(dtype=curarr.dtype.str,
+                     shape=list(curarr.shape),
+                     offset=offset,
+                     order=order))
+            offset = self._roundup(offset + curarr.nbytes)
+        header_bytes = json.dumps(header).encode()
+        name = self._segname(key)
+        try:
+            shm = shared_memory.SharedMemory(
+                name=name, create=True, size=max(offset, 1))
+        except FileExistsError:
+            return
+        _untrack(shm)
+        buf = shm.buf
+        buf[1:self._preamble] = len(header_bytes).to_bytes(
+            self._preamble - 1, 'little')
+        buf[self._preamble:self._preamble + len(header_bytes)] = header_bytes
+        for curhead, curarr in zip(header, arrays):
+            view = np.ndarray(curarr.shape,
+                              dtype=curarr.dtype,
+                              buffer=buf,
+                              offset=curhead['offset'],
+                              order=curhead['order'])
+            view[...] = curarr
+            del view
+        buf[0] = 1
+        del buf
+        # the segment is reopened by get() when needed, so we do not keep
+        # its file descriptor and mapping
+        size = shm.size
+        shm.close()
+        self.segments[name] = size
+        self.nbytes += size
+        while len(self.segments) > 1 and (self.maxbytes is not None
+                                          and self.nbytes > self.maxbytes):
+            oldname, oldsize = self.segments.popitem(last=False)
+            self.nbytes -= oldsize
+            self.evictions += 1
+            _unlink(oldname)
+
+    def _roundup(self, x):
+        return ((x + self._align - 1) // self._align) * self._align
+
+    def cleanup(self):
+        """ Remove all the segments created by this process """
+        for name in self.segments.keys():
+            _unlink(name)
+        self.segments.clear()
+        self.nbytes = 0
+
+    def info(self):
+        """ Return the dictionary with the statistics of the store """
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            segments=len(self.segments),
+            nbytes=self.nbytes,
+            maxbytes=self.maxbytes,
+            attached=len(self.attached),
+            attached_nbytes=sum([_[0].size for _ in self.attached.values()]))
+
+
+def _untrack(shm):
+    """
+    Remove the segment from the resource tracker. Otherwise the tracker
+    destroys the segment (and complains about it) when the process that
+    created or attached to it exits, while the lifetime of segments is
+    managed by the store itself.
+    """
+    if resource_tracker is not None:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+
+
+def _unlink(name):
+    """ Remove the segment with a given name if it still exists """
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    # opening the segment registers it with the resource tracker and
+    # unlink() unregisters it
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        _untrack(shm)
+
+
+# the environment variable with the random token of the run
+RUN_TOKEN_ENV = 'RVSPECFIT_SHM_TOKEN'
+
+
+def run_token():
+    """
+    Return the random token identifying this run in the segment names.
+    The first call creates it and puts it in the environment, so the
+    processes started after that (i.e. the workers of a pool) inherit it
+    and share the segments, while unrelated runs do not.
+    """
+    token = os.environ.get(RUN_TOKEN_ENV)
+    if token is None:
+        token = binascii.hexlify(os.urandom(8)).decode()
+        os.environ[RUN_TOKEN_ENV] = token
+    return token
+
+
+def default_prefix():
+    """
+    The default prefix of the segment names. It is the same for all the
+    worker processes started after the parent process called run_token().
+    """
+    return 'rvs%s_' % run_token()
+
+
+class LibraryStore:
+    """ Singleton with the shared memory store of the template library """
+    store = None
+
+
+def publish_library(fnames, prefix=None):
+    """
+    Load the arrays of the template library into the shared memory, so that
+    the worker processes can attach to them (see attach_library)
+    instead of reading their own copies. The segments are removed when
+    the calling process exits.
+
+    Parameters:
+    -----------
+    fnames: list of strings
+        The list of the library files (.npy or library containers)
+    prefix: string
+        The prefix of the segment names. By default it is based on the
+        random token of the run (see run_token)
+
+    Returns:
+    --------
+    prefix: string
+        The prefix of the segment names
+    keys: list
+        The keys of the published arrays
+    """
+    if prefix is None:
+        prefix = 'rvslib%s_' % run_token()
+    t0 = time.time()
+    store = SharedStore(prefix)
+    keys = []
+    for fname in fnames:
+        if fname.endswith('.npy'):
+            arrays = {None: np.load(fname, mmap_mode='r')}
+        else:
+            arrays = libfile.read(fname)[0]
+        for name, curarr in arrays.items():
+            key = _library_key(fname, name)
+            store.put(key, (curarr, ))
+            keys.append(key)
+    LibraryStore.store = store
+    print('Published %d library arrays (%.1f MB) in %.2f s' %
+          (len(keys), store.info()['nbytes'] / 1024.**2, time.time() - t0))
+    return prefix, keys
+
+
+def _library_key(fname, name=None):
+    fname = os.path.abspath(fname)
+    if name is None:
+        return fname
+    return '%s:%s' % (fname, name)
+
+
+def attach_library(prefix, keys=()):
+    """
+    Attach to the template library published by publish_library.
+    This is meant to be used as the initializer of the worker processes.
+
+    Parameters:
+    -----------
+    prefix: string
+        The prefix of the segment names
+    keys: list
+        The keys of the arrays to attach to immediately
+        (as returned by publish_library)
+    """
+    t0 = time.time()
+    store = SharedStore(prefix)
+    LibraryStore.store = store
+    for key in keys:
+        store.attach(key)
+    print('Process %d attached %d library arrays (%.1f MB) in %.3f s, '
+          'max RSS %.1f MB' %
+          (os.getpid(), len(store.attached),
+           store.info()['attached_nbytes'] / 1024.**2, time.time() - t0,
+           resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
+
+
+def get_library_array(fname, name=None):
+    """
+    Return the array of the template library from the shared memory or None
+    if the library is not shared or the array is not published
+
+    Parameters:
+    -----------
+    fname: string
+        The filename of the .npy file or of the library container
+    name: string
+        The name of the array in the container
+
+    Returns:
+    --------
+    ret: numpy array or None
+    """
+    if LibraryStore.store is None:
+        return None
+    ret = LibraryStore.store.attach(_library_key(fname, name))
+    if ret is None:
+        return None
+    return ret[0]
+
+
+def get_library_arrays(fname, arrays):
+    """
+    Replace the arrays read from the library container by their shared
+    memory copies if they are published
+
+    Parameters:
+    -----------
+    fname: string
+        The filename of the library container
+    arrays: dict
+        The arrays read from the container
+
+    Returns:
+    --------
+    arrays: dict
+    """
+    ret = {}
+    for name, curarr in arrays.items():
+        shared = get_library_array(fname, name)
+        ret[name] = curarr if shared is None else shared
+    return ret
@@ -1,10 +1,6 @@
-import sys
-if (sys.version_info < (3, 0)):
-    import functools32 as functools 
-else:
-    import functools
 import random
 import pickle
+import hashlib
 import numpy as np
 import numpy.random
 import scipy
@@ -12,37 +8,14 @@ import scipy.interpolate
 from scipy.constants.constants import speed_of_light
 import scipy.sparse
 import scipy.signal
-import collections
+import scipy.ndimage
+import scipy.fftpack
 
 from rvspecfit import frozendict
 from rvspecfit import utils
 from rvspecfit import spec_inter
-
-
-class LRUDict:
-    """ Simple implementation of LRU dictionary """
-    def __init__(self, N):
-        self.N = N
-        self.D = collections.OrderedDict()
-
-    def __contains__(self, x):
-        return x in self.D
-
-    def __setitem__(self, x, y):
-        inside = x in self.D
-        if len(self.D) == self.N and not inside:
-            del self.D[next(iter(self.D.keys()))]
-        if inside:
-            self.D.move_to_end(x,last=True)
-        self.D[x] = y
-
-    def __getitem__(self,x):
-        ret = self.D[x]
-        self.D.move_to_end(x, last=True)
-        return ret
-
-    def __str__(self):
-        return self.D.__str__()
+from rvspecfit import shared_store
+from rvspecfit import lrucache
 
 
 # resolution matrix
@@ -61,6 +34,138 @@ class ResolMatrix:
         return self.fd['mat']
 
 
+class LamGrid:
+    '''
+    Wavelength grid that can be shared between many spectroscopic datasets.
+    It holds the quantities that depend only on the wavelength vector, such
+    as the continuum polynomials.
+    '''
+
+    def __init__(self, lam, fingerprint):
+        self.lam = lam
+        self.fingerprint = fingerprint
+        self.polys = {}
+        self.poly_products = {}
+        self.scatters = {}
+
+    def get_polys(self, npoly):
+        '''
+        Get the Chebyshev polynomials for the continuum on this grid
+
+        Parameters:
+        -----------
+        npoly: integer
+            The degree of polynomial to use
+
+        Returns:
+        --------
+        polys: numpy array(npolys, Nwave)
+            The array of continuum polynomials
+        '''
+        if npoly not in self.polys:
+            lam = self.lam
+            # get polynomials for continuum
+            polys = np.zeros((npoly, len(lam)))
+            coeffs = {}
+            for i in range(npoly):
+                coeffs[i] = np.zeros(npoly)
+                coeffs[i][i] = 1
+            normlam = (lam - lam[0]) / (lam[-1] - lam[0]) * 2 - 1
+            # -1..1
+            for i in range(npoly):
+                polys[i, :] = np.polynomial.Chebyshev(coeffs[i])(normlam)
+            polys.setflags(write=False)
+            self.polys[npoly] = polys
+        return self.polys[npoly]
+
+    def get_poly_products(self, npoly):
+        '''
+        Get the pairwise products of the continuum polynomials, which are
+        needed to construct the M^T M matrices
+
+        Parameters:
+        -----------
+        npoly: integer
+            The degree of polynomial to use
+
+        Returns:
+        --------
+        polys2: numpy array(npolys**2, Nwave)
+            The array of products of polynomials
+        '''
+        if npoly not in self.poly_products:
+            polys = self.get_polys(npoly)
+            polys2 = (polys[:, None, :] * polys[None, :, :]).reshape(
+                npoly**2, -1)
+            polys2.setflags(write=False)
+            self.poly_products[npoly] = polys2
+        return self.poly_products[npoly]
+
+    def get_scatter(self, step):
+        '''
+        Get the sparse matrix that spreads the values defined at the pixels
+        onto the regular log-wavelength grid with a given step, such that
+        sum(x * f(log(lam))) = sum((scatter * x) * f(grid)) for smooth f.
+        The weights are the ones of cubic Lagrange interpolation.
+
+        Parameters:
+        -----------
+        step: float
+            The step of the log-wavelength grid
+
+        Returns:
+        --------
+        i0: integer
+            The first node of the grid is at log(lambda) = i0 * step
+        ngrid: integer
+            The number of nodes in the grid
+        scatter: scipy.sparse matrix (ngrid, Nwave)
+            The scattering matrix
+        '''
+        if step not in self.scatters:
+            xs = np.log(self.lam) / step
+            i0 = int(np.floor(xs.min())) - 1
+            pos = np.floor(xs - i0).astype(int)
+            t = xs - i0 - pos
+            weights = np.array([
+                -t * (t - 1) * (t - 2) / 6, (t + 1) * (t - 1) * (t - 2) / 2,
+                -(t + 1) * t * (t - 2) / 2, (t + 1) * t * (t - 1) / 6
+            ])
+            rows = pos[None, :] + np.arange(-1, 3)[:, None]
+            cols = np.tile(np.arange(len(xs)), (4, 1))
+            ngrid = int(rows.max()) + 1
+            scatter = scipy.sparse.csr_matrix(
+                (weights.ravel(), (rows.ravel(), cols.ravel())),
+                shape=(ngrid, len(xs)))
+            self.scatters[step] = i0, ngrid, scatter
+        return self.scatters[step]
+
+
+def get_lamgrid(lam):
+    '''
+    Return the wavelength grid object for a given wavelength vector.
+    Datasets with identical wavelength vectors share the same object.
+
+    Parameters:
+    -----------
+    lam: numpy array
+        Wavelength vector
+
+    Returns:
+    --------
+    lamgrid: LamGrid object
+        The wavelength grid
+    '''
+    lam = np.ascontiguousarray(lam, dtype=np.float64)
+    fingerprint = hashlib.sha1(lam.tobytes()).hexdigest()
+    grids = lrucache.get_cache('lamgrids', maxsize=20)
+    ret = grids.get(fingerprint)
+    if ret is None:
+        ret = LamGrid(lam, fingerprint)
+        grids[fingerprint] = ret
+    return ret
+
+
 class SpecData:
     '''
     Class describing a single spectrocopic dataset
@@ -92,6 +197,8 @@ class SpecData:
             badmask = np.zeros(len(spec), dtype=bool)
         self.fd['badmask'] = badmask
         self.fd = utils.freezeDict(self.fd)
+        # the wavelength grid shared with other datasets
+        self.lamgrid = get_lamgrid(lam)
         # id of the object to ensure that I can cache calls on a given data
         self.id = random.getrandbits(128)
 
@@ -119,7 +226,6 @@ class SpecData:
         return self.id
 
 
-@functools.lru_cache(100)
 def get_polys(specdata, npoly):
     '''
     Get the precomputed polynomials for the continuum for a given specdata
@@ -136,18 +242,34 @@ def get_polys(specdata, npoly):
     polys: numpy array(npolys, Nwave)
         The array of continuum polynomials
     '''
-    lam = specdata.lam
-    # get polynomials for continuum
-    polys = np.zeros((npoly, len(lam)))
-    coeffs = {}
-    for i in range(npoly):
-        coeffs[i] = np.zeros(npoly)
-        coeffs[i][i] = 1
-    normlam = (lam - lam[0]) / (lam[-1] - lam[0]) * 2 - 1
-    # -1..1
-    for i in range(npoly):
-        polys[i, :] = np.polynomial.Chebyshev(coeffs[i])(normlam)
-    return polys
+    return specdata.lamgrid.get_polys(npoly)
+
+
+@lrucache.memoize('weighted_polys', maxbytes=200e6)
+def get_weighted_polys(specdata, npoly):
+    '''
+    Get the continuum polynomials and their products weighted by the inverse
+    variances of a given specdata. These are the pieces needed to construct
+    M^T S and M^T M for any template.
+
+    Parameters:
+    -----------
+    specdata: SpecData objects
+        The spectroscopic dataset objects
+    npoly: integer
+        The degree of polynomial to use
+
+    Returns:
+    --------
+    wpolys: numpy array(npolys, Nwave)
+        The polynomials multiplied by spec/espec^2
+    wpolys2: numpy array(npolys**2, Nwave)
+        The products of polynomials divided by espec^2
+    '''
+    ivar = 1. / specdata.espec**2
+    wpolys = get_polys(specdata, npoly) * (specdata.spec * ivar)[None, :]
+    wpolys2 = specdata.lamgrid.get_poly_products(npoly) * ivar[None, :]
+    return wpolys, wpolys2
 
 
 def get_chisq0(spec, templ, polys, get_coeffs=False, espec=None):
@@ -185,32 +307,193 @@ def get_chisq0(spec, templ, polys, get_coeffs=False, espec=None):
         normspec = spec
         normtempl = templ
 
-    npoly = polys.shape[0]
-    matrix1 = np.matrix(np.zeros((npoly, npoly)), copy=False)
-    #vector1 = np.matrix(np.zeros((npoly, 1)), copy=False)
-    polys1 = np.zeros((npoly, len(spec)))
-
-    polys1[:, :] = normtempl[None, :] * polys
+    polys1 = normtempl[None, :] * polys
     # M
-    vector1 = np.matrix(np.dot(polys1, normspec)).T
+    vector1 = np.dot(polys1, normspec)
     # M^T S
-    u, s, v = scipy.linalg.svd(polys1, full_matrices=False, check_finite=False)
-    u = np.matrix(u, copy=False)
-    matrix1 = u * np.matrix(np.diag(s**2)) * u.T
-    det = np.prod(s)**2
-    # matrix1 is the M^T M matrix
-    v2 = scipy.linalg.solve(matrix1, vector1, check_finite=False)
-
-    chisq = -vector1.getT() * v2 + \
-        0.5 * np.log(det)
+    matrix1 = np.dot(polys1, polys1.T)
+    # M^T M
+    return solve_normal(matrix1, vector1, get_coeffs=get_coeffs)
+
+
+def solve_normal(matrix, vector, get_coeffs=False):
+    '''
+    Solve the normal equations of the continuum fit and return the
+    continuum-marginalized chi-square. The Gram matrices are Cholesky
+    decomposed, which gives both the solution and the log-determinant.
+    If some of the matrices are not numerically positive definite, the
+    eigen-decomposition with clipped eigenvalues is used instead.
+
+    Parameters:
+    -----------
+    matrix: numpy (..., npoly, npoly)
+        The M^T M matrix or a stack of those
+    vector: numpy (..., npoly)
+        The M^T S vector or a stack of those
+    get_coeffs: boolean (optional)
+        If true return the coefficients of polynomials
+
+    Returns:
+    --------
+    chisq: real or numpy (...)
+        -S^T M (M^T M)^-1 M^T S + 0.5 * log(det(M^T M))
+    coeffs: numpy (..., npoly)
+        The polynomial coefficients (optional)
+    '''
+    try:
+        L = np.linalg.cholesky(matrix)
+    except np.linalg.LinAlgError:
+        L = None
+    if L is not None:
+        y = np.linalg.solve(L, vector[..., None])[..., 0]
+        logdet = 2 * np.log(np.diagonal(L, axis1=-2, axis2=-1)).sum(axis=-1)
+        chisq = -(y**2).sum(axis=-1) + 0.5 * logdet
+        if get_coeffs:
+            coeffs = np.linalg.solve(
+                np.swapaxes(L, -1, -2), y[..., None])[..., 0]
+    else:
+        # ill-conditioned case
+        w, V = np.linalg.eigh(matrix)
+        w = np.maximum(w, 1e-15 * np.abs(w).max(axis=-1)[..., None])
+        y = (V * vector[..., None]).sum(axis=-2)
+        logdet = np.log(w).sum(axis=-1)
+        chisq = -(y**2 / w).sum(axis=-1) + 0.5 * logdet
+        if get_coeffs:
+            coeffs = (V * (y / w)[..., None, :]).sum(axis=-1)
     if get_coeffs:
-        coeffs = v2.flatten()
         return chisq, coeffs
     else:
         return chisq
 
 
-@functools.lru_cache(100)
+def get_chisq0_grad(spec, templ, polys, espec):
+    '''
+    Get the continuum-marginalized chi-square (see get_chisq0) together with
+    its derivative with respect to the template values
+
+    Parameters:
+    -----------
+    spec: numpy
+        Spectrum array
+    templ: numpy
+        The template
+    polys: numpy
+        The continuum polynomials
+    espec: numpy
+        The error vector
+
+    Returns:
+    --------
+    chisq: real
+        Chi-square
+    grad: numpy
+        The derivative of the chi-square with respect to every pixel of
+        the template
+    '''
+    normspec = spec / espec
+    normtempl = templ / espec
+    polys1 = normtempl[None, :] * polys
+    vector1 = np.dot(polys1, normspec)
+    matrix1 = np.dot(polys1, polys1.T)
+    chisq, coeffs = solve_normal(matrix1, vector1, get_coeffs=True)
+    # the derivative of -S^T M (M^T M)^-1 M^T S is -2 * residual * continuum
+    # and the derivative of 0.5 * log(det(M^T M)) is the template
+    # times the leverage of the pixel
+    cont = np.dot(coeffs, polys)
+    resid = normspec - normtempl * cont
+    leverage = (np.linalg.solve(matrix1, polys) * polys).sum(axis=0)
+    grad = (-2 * resid * cont + normtempl * leverage) / espec
+    return chisq, grad
+
+
+def get_chisq0_many(templs, wpolys, wpolys2):
+    '''
+    Get the chi-square values for a stack of templates after marginalizing
+    over continuum. This is the vectorized version of get_chisq0, where
+    the normal equations for all the templates are constructed and solved
+    at once.
+
+    Parameters:
+    -----------
+    templs: numpy (Ntempl, Npix)
+        The stack of templates (i.e. one template shifted to many velocities)
+    wpolys: numpy
+        The continuum polynomials multiplied by spec/espec^2
+    wpolys2: numpy
+        The products of continuum polynomials divided by espec^2
+        (see get_weighted_polys)
+
+    Returns:
+    --------
+    chisq: numpy (Ntempl)
+        Chi-squares for each template
+    '''
+    ntempl = templs.shape[0]
+    npoly = wpolys.shape[0]
+    # M^T S for every template
+    vector1 = np.dot(templs, wpolys.T)
+    # M^T M for every template
+    matrix1 = np.dot(templs**2, wpolys2.T).reshape(ntempl, npoly, npoly)
+    return solve_normal(matrix1, vector1)
+
+
+class TemplCache:
+    """ Singleton holding the shared memory store of templates """
+    shared = None
+    initialized = False
+
+
+def get_templ_caches(config):
+    """
+    Return the template cache and the shared memory store of templates
+    (None unless enabled by the templ_cache_shared config option).
+    The shared store holds both the templates and their interpolators, so
+    every process may keep up to templ_cache_bytes + rv_interp_cache_bytes
+    there.
+    """
+    if not TemplCache.initialized:
+        if config.get('templ_cache_shared'):
+            TemplCache.shared = shared_store.SharedStore(
+                shared_store.default_prefix(),
+                maxbytes=(config.get('templ_cache_bytes') or 200e6) +
+                (config.get('rv_interp_cache_bytes') or 100e6))
+        TemplCache.initialized = True
+    return (lrucache.get_cache(
+        'templates', maxbytes=config.get('templ_cache_bytes') or 200e6),
+            TemplCache.shared)
+
+
+def templ_cache_info():
+    """ Return the statistics of the template caches """
+    ret = {}
+    ret['local'] = lrucache.get_cache('templates').info()
+    if TemplCache.shared is not None:
+        ret['shared'] = TemplCache.shared.info()
+    return ret
+
+
+def quantize(x, ndigits=10):
+    """ Round the number to a given number of significant digits """
+    return float('%.*g' % (ndigits, x))
+
+
+def get_templ_key(spec_setup, atm_param, rot_params, config):
+    """
+    Return the key identifying the template with given parameters.
+    The parameters are rounded to templ_key_digits significant digits
+    (10 by default), so the parameter vectors differing only by the
+    floating point noise share the same key. The cached template was
+    computed for the first parameter vector with the key, so the coarser
+    rounding trades the accuracy of templates for the cache hits and must
+    stay finer than the finite difference steps of the optimizer.
+    """
+    ndigits = config.get('templ_key_digits') or 10
+    if rot_params is not None:
+        rot_params = tuple([quantize(_, ndigits) for _ in rot_params])
+    return (config['template_lib'], spec_setup,
+            tuple([quantize(_, ndigits) for _ in atm_param]), rot_params)
+
+
 def getCurTempl(spec_setup, atm_param, rot_params, config):
     """
     Get the spectrum in the given setup with given atmospheric parameters and
@@ -224,28 +507,47 @@ def getCurTempl(spec_setup, atm_param, rot_params, config):
         The atmospheric parameters
     rot_params: tuple
         The parameters of stellar rotation models (could be None)
-    resol_params: object
-        The object that descibe the resolution convolution (could be None)
     config: dict
         The configuration dictionary
 
     Returns:
+    outside: float
+        The flag showing how far outside the template grid we are
+    lam: numpy
+        The wavelength vector of the template
     templ: numpy
         The template vector
+    templ_tag: tuple
+        The key identifying the template (see get_templ_key)
     """
+    templ_tag = get_templ_key(spec_setup, atm_param, rot_params, config)
+    cache, shared = get_templ_caches(config)
+    ret = cache.get(templ_tag)
+    if ret is not None:
+        return ret
     curInterp = spec_inter.getInterpolator(spec_setup, config)
-    outside = float(curInterp.outsideFlag(atm_param))
-    spec = curInterp.eval(atm_param)
-    if not np.isfinite(outside):
-        # The spectrum may be completely crap
-        pass
+    stored = None
+    if shared is not None:
+        stored = shared.get(templ_tag)
+    if stored is not None:
+        outside, spec = float(stored[0]), stored[1]
     else:
-        # take into account the rotation of the star
-        if rot_params is not None:
-            spec = convolve_vsini(curInterp.lam, spec, *rot_params)
-
-    templ_tag = random.getrandbits(128)
-    return outside, curInterp.lam, spec, templ_tag
+        # the template is evaluated at the rounded parameters
+        atm_param, rot_params = templ_tag[2], templ_tag[3]
+        spec, outside = curInterp.eval_flag(atm_param)
+        if not np.isfinite(outside):
+            # The spectrum may be completely crap
+            pass
+        else:
+            # take into account the rotation of the star
+            if rot_params is not None:
+                spec = convolve_vsini(curInterp.lam, spec, *rot_params)
+        spec = np.asarray(spec)
+        if shared is not None:
+            shared.put(templ_tag, (np.array(outside), spec))
+    ret = outside, curInterp.lam, spec, templ_tag
+    cache.put(templ_tag, ret, spec.nbytes)
+    return ret
 
 
 def construct_resol_mat(lam, resol=None, width=None):
@@ -364,7 +666,90 @@ def convolve_vsini(lam_templ, templ, vsini):
     return templ1
 
 
-def getRVInterpol(lam_templ, templ):
+class LogLamInterpol:
+    """
+    Cubic B-spline interpolator of the template defined on a logarithmically
+    spaced wavelength grid. Because the Doppler shift is just a shift of
+    the index on such a grid, the B-spline coefficients are computed once
+    and the template is evaluated at any (shifted) wavelength by simple
+    index arithmetic. This reproduces the interpolating spline of
+    getRVInterpol to a relative accuracy of ~1e-5 for templates sampled at
+    the instrument resolution.
+    """
+
+    def __init__(self, lam_templ, templ):
+        """
+        Parameters:
+        -----------
+        lam_templ: numpy
+            Wavelength array (MUST be spaced logarithmically)
+        templ: numpy
+            Spectral array
+        """
+        self.logl0 = np.log(lam_templ[0])
+        self.logstep = np.log(lam_templ[1] / lam_templ[0])
+        self.npix = len(lam_templ)
+        if not np.allclose(
+                np.diff(np.log(lam_templ)), self.logstep, rtol=1e-6,
+                atol=0):
+            raise Exception(
+                'The template wavelength grid is not logarithmically spaced')
+        self.coeffs = scipy.ndimage.spline_filter1d(
+            np.asarray(templ, dtype=np.float64), order=3, mode='mirror')
+
+    @classmethod
+    def from_coeffs(cls, logl0, logstep, coeffs):
+        """ Construct the interpolator from precomputed B-spline
+        coefficients """
+        self = cls.__new__(cls)
+        self.logl0 = logl0
+        self.logstep = logstep
+        self.npix = len(coeffs)
+        self.coeffs = coeffs
+        return self
+
+    # the tolerance (in pixels) of the check that the wavelengths are
+    # within the template, which allows for the rounding errors of the
+    # logarithms at the ends of the template
+    edge_tol = 1e-9
+
+    def _get_index(self, lams):
+        """ Return the fractional pixel indices of given wavelengths """
+        xs = (np.log(lams) - self.logl0) / self.logstep
+        if (xs.min() < -self.edge_tol
+                or xs.max() > self.npix - 1 + self.edge_tol):
+            raise ValueError('The wavelengths are outside the template range')
+        return np.clip(xs, 0, self.npix - 1)
+
+    def __call__(self, lams):
+        """ Evaluate the template at given wavelengths """
+        lams = np.asarray(lams)
+        xs = self._get_index(lams)
+        return scipy.ndimage.map_coordinates(
+            self.coeffs,
+            xs.reshape(1, -1),
+            order=3,
+            mode='mirror',
+            prefilter=False).reshape(xs.shape)
+
+    def derivative(self, lams):
+        """ Evaluate the derivative of the template with respect to the
+        wavelength at given wavelengths """
+        lams = np.asarray(lams)
+        xs = self._get_index(lams)
+        # the derivative of the cubic B-spline is the quadratic B-spline
+        # with the coefficients given by the differences of the original
+        # coefficients and shifted by half a pixel
+        dcoeffs = np.diff(np.r_[self.coeffs[1], self.coeffs])
+        deriv = scipy.ndimage.map_coordinates(
+            dcoeffs, (xs + 0.5).reshape(1, -1),
+            order=2,
+            mode='mirror',
+            prefilter=False).reshape(xs.shape)
+        return deriv / (lams * self.logstep)
+
+
+def getRVInterpol(lam_templ, templ, kind='spline'):
     """
     Produce the spectrum interpolator to evaluate the spectrum at arbitrary
     wavelengths
@@ -375,18 +760,52 @@ def getRVInterpol(lam_templ, templ):
         Wavelength array
     templ: numpy
         Spectral array
+    kind: string (optional)
+        The type of the interpolator. 'spline' is the interpolating spline in
+        wavelength, 'loglam' is the B-spline on the logarithmic wavelength
+        grid (see LogLamInterpol)
 
     Returns:
     --------
     interpol: scipy.interpolate object
         The object that can be used to evaluate template at any wavelength
     """
-
-    interpol = scipy.interpolate.UnivariateSpline(
-        lam_templ, templ, s=0, k=3, ext=2)
+    if kind == 'spline':
+        interpol = scipy.interpolate.UnivariateSpline(
+            lam_templ, templ, s=0, k=3, ext=2)
+    elif kind == 'loglam':
+        interpol = LogLamInterpol(lam_templ, templ)
+    else:
+        raise ValueError('Unknown template interpolation type %s' % kind)
     return interpol
 
 
+def rv_interpol_to_arrays(interpol):
+    """
+    Return the tuple of arrays that fully describe the template interpolator
+    (the inverse of rv_interpol_from_arrays)
+    """
+    if isinstance(interpol, LogLamInterpol):
+        return (np.array([interpol.logl0, interpol.logstep]), interpol.coeffs)
+    else:
+        t, c, k = interpol._eval_args
+        return (np.asarray(t), np.asarray(c), np.array(k))
+
+
+def rv_interpol_from_arrays(kind, arrays):
+    """
+    Construct the template interpolator of a given kind (see getRVInterpol)
+    from the arrays returned by rv_interpol_to_arrays
+    """
+    if kind == 'loglam':
+        (logl0, logstep), coeffs = arrays
+        return LogLamInterpol.from_coeffs(logl0, logstep, coeffs)
+    else:
+        t, c, k = arrays
+        return scipy.interpolate.UnivariateSpline._from_tck((t, c, int(k)),
+                                                            ext=2)
+
+
 def evalRV(interpol, vel, lams):
     """
     Evaluate the spectrum interpolator at a given velocity and given wavelengths
@@ -408,6 +827,99 @@ def evalRV(interpol, vel, lams):
     return interpol(lams / (1 + vel * 1000. / speed_of_light))
 
 
+def evalRVderiv(interpol, vel, lams):
+    """
+    Evaluate the derivative of the spectrum interpolator with respect to
+    the radial velocity at given wavelengths
+
+    Parameters:
+    -----------
+    interpol: scipy.intepolate object
+        Template interpolator
+    vel: real
+        Radial velocity
+    lams: numpy
+        Wavelength array
+
+    Returns:
+    --------
+    deriv: numpy
+        The derivative of the evaluated spectrum
+    """
+    factor = 1 + vel * 1000. / speed_of_light
+    lams1 = lams / factor
+    if isinstance(interpol, LogLamInterpol):
+        deriv = interpol.derivative(lams1)
+    else:
+        deriv = interpol(lams1, nu=1)
+    return -deriv * lams1 / factor * 1000. / speed_of_light
+
+
+def evalRVmany(interpol, vels, lams):
+    """
+    Evaluate the spectrum interpolator at a grid of velocities
+
+    Parameters:
+    -----------
+    interpol: scipy.intepolate object
+        Template interpolator
+    vels: numpy
+        Array of radial velocities
+    lams: numpy
+        Wavelength array
+
+    Returns:
+    --------
+    specs: numpy (Nvels, Nwave)
+        Evaluated spectra, one row per velocity
+    """
+    vels = np.asarray(vels, dtype=float)
+    return interpol(
+        lams[None, :] / (1 + vels[:, None] * 1000. / speed_of_light))
+
+
+def evalRVspecs(templ_lam, specs, vel, lams, kind='spline'):
+    """
+    Evaluate several spectra defined on the template wavelength grid at a
+    given velocity and given wavelengths. This is the same as evaluating
+    getRVInterpol(templ_lam, spec, kind) for each spectrum, but the
+    interpolating splines of all the spectra are constructed at once
+
+    Parameters:
+    -----------
+    templ_lam: numpy
+        The wavelength array of the template
+    specs: numpy (Nspec, Npix)
+        The spectra
+    vel: real
+        Radial velocity
+    lams: numpy
+        Wavelength array
+    kind: string (optional)
+        The type of the interpolator (see getRVInterpol)
+
+    Returns:
+    --------
+    specs: numpy (Nspec, Nwave)
+        Evaluated spectra
+    """
+    specs = np.atleast_2d(specs)
+    lams1 = lams / (1 + vel * 1000. / speed_of_light)
+    if kind == 'spline':
+        # the not-a-knot interpolating spline, the same as the
+        # UnivariateSpline with s=0
+        return scipy.interpolate.make_interp_spline(templ_lam, specs.T,
+                                                    k=3)(lams1).T
+    return np.array(
+        [getRVInterpol(templ_lam, _, kind=kind)(lams1) for _ in specs])
+
+
+def get_rv_interp_kind(config):
+    """ Return the type of the template interpolator requested in the config
+    (see getRVInterpol) """
+    return config.get('rv_interp') or 'spline'
+
+
 def param_dict_to_tuple(paramDict, setup, config):
     # convert the dictionary with spectral parameters
     # to a tuple
@@ -446,6 +958,89 @@ def get_chisq_continuum(specdata, options=None):
     return ret
 
 
+def get_templ_interpol(curdata, atm_params, rot_params, config, cache=None):
+    """
+    Get the template interpolator for a given dataset, atmospheric and
+    rotation parameters
+
+    Parameters:
+    -----------
+    curdata: SpecData object
+        The spectroscopic dataset
+    atm_params: tuple
+        The atmospheric parameters
+    rot_params: tuple
+        The parameters of stellar rotation models (could be None)
+    config: dict
+        The configuration dictionary
+    cache: lrucache.Cache (optional)
+        The cache of template interpolators. If not specified, the cache
+        shared by all the calls in this process is used.
+
+    Returns:
+    --------
+    outside: float
+        The flag showing how far outside the template grid we are (NaN if
+        we are completely outside, in which case the interpolator is None)
+    templ_lam: numpy
+        The wavelength vector of the template
+    interpol: object
+        The object that can be used to evaluate template at any wavelength
+    """
+    outside, templ_lam, templ_spec, templ_tag = getCurTempl(
+        curdata.name, atm_params, rot_params, config)
+    if not np.isfinite(outside):
+        return outside, templ_lam, None
+
+    if (curdata.lam[0] < templ_lam[0] or curdata.lam[0] > templ_lam[-1]
+            or curdata.lam[-1] < templ_lam[0]
+            or curdata.lam[-1] > templ_lam[-1]):
+        raise Exception("The template library doesn't cover this wavelength")
+
+    # current template interpolator object
+    kind = get_rv_interp_kind(config)
+    interp_tag = (templ_tag, kind)
+    if cache is None:
+        cache = get_rv_interpol_cache(config)
+    curtemplI = cache.get(interp_tag)
+    if curtemplI is None:
+        shared = get_templ_caches(config)[1]
+        stored = None
+        if shared is not None:
+            stored = shared.get(interp_tag)
+        if stored is not None:
+            curtemplI = rv_interpol_from_arrays(kind, stored)
+        else:
+            curtemplI = getRVInterpol(templ_lam, templ_spec, kind=kind)
+            if shared is not None:
+                shared.put(interp_tag, rv_interpol_to_arrays(curtemplI))
+        cache.put(interp_tag, curtemplI,
+                  sum([_.nbytes for _ in rv_interpol_to_arrays(curtemplI)]))
+    return outside, templ_lam, curtemplI
+
+
+def get_rv_interpol_cache(config):
+    """
+    Return the cache of template interpolators shared by all the calls in
+    this process
+    """
+    return lrucache.get_cache(
+        'rv_interpol', maxbytes=config.get('rv_interp_cache_bytes') or 100e6)
+
+
+def make_rv_interpol_cache(config):
+    """
+    Create a new cache of template interpolators (i.e. to be used for one
+    star, see the rv_interp_cache_scope config option), that can be passed to
+    get_chisq or find_best. The cache is not registered, so it is dropped
+    together with the last reference to it
+    """
+    return lrucache.Cache(
+        'rv_interpol_star',
+        maxbytes=config.get('rv_interp_cache_bytes') or 100e6,
+        register=False)
+
+
 def get_chisq(specdata,
               vel,
               atm_params,
@@ -476,8 +1071,8 @@ def get_chisq(specdata,
     for curdata in specdata:
         name = curdata.name
 
-        outside, templ_lam, templ_spec, templ_tag = getCurTempl(
-            name, atm_params, rot_params, config)
+        outside, templ_lam, curtemplI = get_templ_interpol(
+            curdata, atm_params, rot_params, config, cache=cache)
 
         # if the current point is outside the template grid
         # add bad value and bail out
@@ -489,20 +1084,6 @@ def get_chisq(specdata,
         else:
             chisq += outside
 
-        if (curdata.lam[0] < templ_lam[0] or curdata.lam[0] > templ_lam[-1]
-                or curdata.lam[-1] < templ_lam[0]
-                or curdata.lam[-1] > templ_lam[-1]):
-            raise Exception(
-                "The template library doesn't cover this wavelength")
-
-        # current template interpolator object
-        if cache is None or templ_tag not in cache:
-            curtemplI = getRVInterpol(templ_lam, templ_spec)
-            if cache is not None:
-                cache[templ_tag] = curtemplI
-        else:
-            curtemplI = cache[templ_tag]
-
         evalTempl = evalRV(curtemplI, vel, curdata.lam)
 
         # take into account the resolution
@@ -539,27 +1120,591 @@ def get_chisq(specdata,
     return ret
 
 
+def get_chisq_grad(specdata,
+                   vel,
+                   atm_params,
+                   rot_params,
+                   resol_params,
+                   options=None,
+                   config=None,
+                   cache=None,
+                   atm_free=None,
+                   rot_free=False):
+    """ Find the chi-square of the dataset at a given velocity, atmospheric
+    parameters, rotation parameters and resolution parameters together with
+    its gradient. The derivative with respect to the template is analytic,
+    the derivative of the template with respect to the velocity is
+    obtained from the template interpolator and the derivatives with
+    respect to the atmospheric parameters are the exact derivatives of the
+    piecewise linear interpolant (see SpecInterpolator.eval_grad), so only
+    one template is evaluated. The derivatives with respect to the
+    rotation parameters are finite differences of the rotational
+    convolution of that template (the step is given by the grad_step
+    option).
+
+    Parameters:
+    -----------
+    specdata: list of SpecData
+        The spectroscopic datasets
+    vel: real
+        Radial velocity
+    atm_params: tuple
+        The atmospheric parameters
+    rot_params: tuple
+        The parameters of stellar rotation models (could be None)
+    resol_params: dict
+        The resolution matrices (could be None)
+    options: dict
+        Dictionary of options
+    config: dict
+        The configuration dictionary
+    cache: lrucache.Cache (optional)
+        The cache of template interpolators (see get_templ_interpol)
+    atm_free: list of integers (optional)
+        The indices of the atmospheric parameters to differentiate over.
+        By default all of them are used
+    rot_free: boolean (optional)
+        If true, also differentiate over the rotation parameters
+
+    Returns:
+    --------
+    chisq: real
+        The chi-square (same as returned by get_chisq)
+    grad: numpy
+        The derivatives of the chi-square with respect to the velocity,
+        the rotation parameters (if rot_free) and the free atmospheric
+        parameters in that order
+
+    Raises:
+    -------
+    ValueError
+        If the atmospheric parameters are outside the template grid, where
+        the gradient is not defined (see SpecInterpolator.param_bounds)
+    """
+    npoly = options.get('npoly') or 5
+    rel_step = options.get('grad_step') or 1e-3
+    kind = get_rv_interp_kind(config)
+    if rot_params is not None:
+        rot_params = tuple(rot_params)
+    if resol_params is not None:
+        resol_params = frozendict.frozendict(resol_params)
+    atm_params = tuple(atm_params)
+    if atm_free is None:
+        atm_free = range(len(atm_params))
+    nrot = len(rot_params) if rot_free else 0
+
+    chisq = 0
+    grad = np.zeros(1 + nrot + len(atm_free))
+    for curdata in specdata:
+        name = curdata.name
+
+        outside, templ_lam, curtemplI = get_templ_interpol(
+            curdata, atm_params, rot_params, config, cache=cache)
+        if not np.isfinite(outside):
+            raise ValueError(
+                'The gradient is undefined outside the template grid '
+                '(parameters %s)' % str(atm_params))
+        chisq += outside
+
+        evalTempl = evalRV(curtemplI, vel, curdata.lam)
+        if resol_params is not None:
+            evalTempl = convolve_resol(evalTempl, resol_params[name])
+        polys = get_polys(curdata, npoly)
+        curchisq, dchisq = get_chisq0_grad(curdata.spec, evalTempl, polys,
+                                           curdata.espec)
+        chisq += float(curchisq)
+
+        # the derivatives of the template on its own wavelength grid
+        spec0, _, dspec0, dflag0 = spec_inter.getInterpolator(
+            name, config).eval_grad(atm_params)
+        dtempls = []
+        douts = []
+        if rot_free:
+            templ_rot = convolve_vsini(templ_lam, spec0, *rot_params)
+            for i in range(nrot):
+                step = rel_step * max(abs(rot_params[i]), 1)
+                cur = list(rot_params)
+                cur[i] += step
+                dtempls.append(
+                    (convolve_vsini(templ_lam, spec0, *cur) - templ_rot) /
+                    step)
+                douts.append(0)
+        for i in atm_free:
+            deriv = dspec0[i]
+            if rot_params is not None:
+                deriv = convolve_vsini(templ_lam, deriv, *rot_params)
+            dtempls.append(deriv)
+            douts.append(dflag0[i])
+
+        derivs = evalRVderiv(curtemplI, vel, curdata.lam)[None, :]
+        if len(dtempls) > 0:
+            derivs = np.vstack((derivs,
+                                evalRVspecs(templ_lam,
+                                            np.array(dtempls),
+                                            vel,
+                                            curdata.lam,
+                                            kind=kind)))
+        if resol_params is not None:
+            derivs = convolve_resol(derivs.T, resol_params[name]).T
+        grad += np.dot(derivs, dchisq) + np.r_[0, douts]
+    return chisq, grad
+
+
+def get_fisher_matrix(specdata,
+                      vel,
+                      atm_params,
+                      rot_params,
+                      resol_params,
+                      options=None,
+                      config=None,
+                      cache=None):
+    """
+    Compute the Fisher matrix of the atmospheric parameters, i.e. the
+    Gauss-Newton approximation of the Hessian of 0.5 * chi-square with the
+    continuum marginalized. The derivatives of the templates are computed
+    by central differences from the spectra interpolated at all the
+    stencil points at once (the relative step is given by the fisher_step
+    option).
+
+    Parameters:
+    -----------
+    specdata: list of SpecData
+        The spectroscopic datasets
+    vel: real
+        Radial velocity
+    atm_params: tuple
+        The atmospheric parameters (typically the best-fit ones)
+    rot_params: tuple
+        The parameters of stellar rotation models (could be None)
+    resol_params: dict
+        The resolution matrices (could be None)
+    options: dict
+        Dictionary of options
+    config: dict
+        The configuration dictionary
+    cache: lrucache.Cache (optional)
+        The cache of template interpolators (see get_templ_interpol)
+
+    Returns:
+    --------
+    fisher: numpy (Ndim, Ndim)
+        The Fisher matrix. Its inverse is the covariance matrix
+        of the atmospheric parameters
+    """
+    npoly = options.get('npoly') or 5
+    rel_step = options.get('fisher_step') or 1e-4
+    kind = get_rv_interp_kind(config)
+    atm_params = np.asarray(atm_params, dtype=np.float64)
+    ndim = len(atm_params)
+    steps = rel_step * np.maximum(np.abs(atm_params), 1)
+    # the stencil: the point itself, then positive and negative steps
+    stencil = np.tile(atm_params, (2 * ndim + 1, 1))
+    stencil[1:ndim + 1] += np.diag(steps)
+    stencil[ndim + 1:] -= np.diag(steps)
+    fisher = np.zeros((ndim, ndim))
+    for curdata in specdata:
+        name = curdata.name
+        outside, templ_lam, curtemplI = get_templ_interpol(
+            curdata, atm_params, rot_params, config, cache=cache)
+        if not np.isfinite(outside):
+            continue
+        curInterp = spec_inter.getInterpolator(name, config)
+        specs, flags = curInterp.eval_many(stencil)
+        good = np.isfinite(flags)
+        derivs = []
+        for i in range(ndim):
+            ip, im = i + 1, i + 1 + ndim
+            if good[ip] and good[im]:
+                deriv = (specs[ip] - specs[im]) / (2 * steps[i])
+            elif good[ip]:
+                deriv = (specs[ip] - specs[0]) / steps[i]
+            elif good[im]:
+                deriv = (specs[0] - specs[im]) / steps[i]
+            else:
+                deriv = np.zeros(len(templ_lam))
+            if rot_params is not None:
+                deriv = convolve_vsini(templ_lam, deriv, *rot_params)
+            deriv = evalRV(getRVInterpol(templ_lam, deriv, kind=kind), vel,
+                           curdata.lam)
+            if resol_params is not None:
+                deriv = convolve_resol(deriv, resol_params[name])
+            derivs.append(deriv)
+        evalTempl = evalRV(curtemplI, vel, curdata.lam)
+        if resol_params is not None:
+            evalTempl = convolve_resol(evalTempl, resol_params[name])
+        polys = get_polys(curdata, npoly)
+        coeffs = get_chisq0(
+            curdata.spec,
+            evalTempl,
+            polys,
+            get_coeffs=True,
+            espec=curdata.espec)[1]
+        cont = np.dot(coeffs, polys)
+        # the jacobian of the model with respect to the parameters
+        # and to the continuum coefficients
+        jac = np.array(derivs) * (cont / curdata.espec)[None, :]
+        jac_cont = polys * (evalTempl / curdata.espec)[None, :]
+        # marginalizing over continuum is the projection of the jacobian
+        # onto the space orthogonal to the continuum
+        cross = np.dot(jac, jac_cont.T)
+        fisher += np.dot(jac, jac.T) - np.dot(
+            cross, np.linalg.solve(np.dot(jac_cont, jac_cont.T), cross.T))
+    return fisher
+
+
+def get_chisq_vels(specdata,
+                   vel_grid,
+                   atm_params,
+                   rot_params,
+                   resol_params,
+                   options=None,
+                   config=None,
+                   cache=None):
+    """ Find the chi-squares of the dataset on a grid of velocities
+    for given atmospheric parameters, rotation parameters and resolution
+    parameters. This gives the same result as calling get_chisq for every
+    velocity, but the templates for all the velocities are evaluated and
+    fitted at once.
+
+    Returns:
+    --------
+    chisq: numpy
+        The array of chi-squares for each velocity in vel_grid
+    """
+    npoly = options.get('npoly') or 5
+    vel_grid = np.asarray(vel_grid, dtype=float)
+    chisq = np.zeros(len(vel_grid))
+    badchi = 1e6
+    if rot_params is not None:
+        rot_params = tuple(rot_params)
+    if resol_params is not None:
+        resol_params = frozendict.frozendict(resol_params)
+    atm_params = tuple(atm_params)
+
+    # iterate over multiple datasets
+    for curdata in specdata:
+        name = curdata.name
+
+        outside, templ_lam, curtemplI = get_templ_interpol(
+            curdata, atm_params, rot_params, config, cache=cache)
+
+        # if the current point is outside the template grid
+        # add bad value and bail out
+
+        if not np.isfinite(outside):
+            chisq += badchi
+            continue
+        else:
+            chisq += outside
+
+        evalTempls = evalRVmany(curtemplI, vel_grid, curdata.lam)
+
+        # take into account the resolution
+        if resol_params is not None:
+            evalTempls = convolve_resol(evalTempls.T, resol_params[name]).T
+
+        curchisq = get_chisq0_many(evalTempls,
+                                   *get_weighted_polys(curdata, npoly))
+        assert (np.isfinite(curchisq).all())
+        chisq += curchisq
+    return chisq
+
+
+@lrucache.memoize('fft_weights', maxbytes=200e6)
+def get_fft_weights(specdata, npoly, step, nfft):
+    '''
+    Get the Fourier transforms of the data-dependent pieces of the
+    continuum-marginalized chi-square (spec * P_i / espec^2 and
+    P_i * P_j / espec^2) placed on the logarithmic wavelength grid with a
+    given step (see LamGrid.get_scatter)
+
+    Parameters:
+    -----------
+    specdata: SpecData objects
+        The spectroscopic dataset objects
+    npoly: integer
+        The degree of polynomial to use
+    step: float
+        The step of the log-wavelength grid
+    nfft: integer
+        The length of the FFT
+
+    Returns:
+    --------
+    i0: integer
+        The first node of the grid is at log(lambda) = i0 * step
+    ngrid: integer
+        The number of nodes in the grid
+    fvec: numpy (npoly, nfft//2+1)
+        The conjugated FFTs of the pieces of M^T S
+    fmat: numpy (npoly*(npoly+1)/2, nfft//2+1)
+        The conjugated FFTs of the pieces of the upper triangle of M^T M
+    '''
+    i0, ngrid, scatter = specdata.lamgrid.get_scatter(step)
+    wpolys, wpolys2 = get_weighted_polys(specdata, npoly)
+    iu = np.triu_indices(npoly)
+    vec = scatter.dot(wpolys.T).T
+    mat = scatter.dot(wpolys2[iu[0] * npoly + iu[1]].T).T
+    fvec = np.fft.rfft(vec, nfft).conj()
+    fmat = np.fft.rfft(mat, nfft).conj()
+    return i0, ngrid, fvec, fmat
+
+
+def get_chisq_fft_arm(curdata,
+                      curtemplI,
+                      templ_lam,
+                      vel_grid,
+                      npoly,
+                      tol=1e-4,
+                      maxrefine=3,
+                      ncheck=3):
+    '''
+    Compute the continuum-marginalized chi-square curve as a function of
+    velocity for one dataset using FFT correlations.
+
+    Both the terms of M^T S = sum(spec * T(v) * P_i / espec^2) and
+    M^T M = sum(T(v)^2 * P_i * P_j / espec^2) are correlations of the
+    template (or its square) with the data-dependent vectors, once the
+    data are placed on the log-wavelength grid. The chi-square is computed
+    on the velocity grid with the step of that grid (the lag grid)
+    and is then interpolated onto vel_grid by a cubic spline.
+
+    The result has two sources of error. The template between the nodes of
+    the log-wavelength grid is approximated by the cubic interpolation
+    (see LamGrid.get_scatter), so the chi-squares at the lags are
+    approximate. This error is measured by comparing them with the direct
+    evaluation at the lag of the minimum and at ncheck - 1 other lags.
+    The error of the interpolation between the lags is estimated from the
+    differences between the chi-squares at the odd lags and the spline
+    through the even lags. The error of that spline is at least twice
+    (and for a well sampled curve up to 2^4 times) larger than the error of
+    the spline through all the lags, so half of the largest difference is
+    a conservative estimate.
+    While either error exceeds tol times the chi-square of the zero model
+    (sum((spec/espec)^2)), the lag grid is made twice finer (at most
+    maxrefine times).
+
+    Parameters:
+    -----------
+    curdata: SpecData
+        The spectroscopic dataset
+    curtemplI: object
+        The template interpolator (see get_templ_interpol)
+    templ_lam: numpy
+        The wavelength vector of the template
+    vel_grid: numpy
+        The velocities
+    npoly: integer
+        The degree of polynomial to use
+    tol: float (optional)
+        The maximum allowed error of the chi-square relative to the
+        chi-square of the zero model
+    maxrefine: integer (optional)
+        The maximum number of refinements of the lag grid
+    ncheck: integer (optional)
+        The number of lags where the chi-square is compared with the
+        direct evaluation
+
+    Returns:
+    --------
+    chisq: numpy
+        The array of chi-squares for each velocity in vel_grid or None if
+        the direct evaluation (get_chisq_vels) is expected to be cheaper
+        than the FFT evaluation with the error below tol
+    '''
+    oversample = 2  # how many grid nodes per template pixel
+    vel_step = np.diff(np.sort(vel_grid)).min()
+    if not vel_step > 0:
+        return None
+    logstep = np.log(templ_lam[1] / templ_lam[0])
+    step = min(vel_step * 1000. / speed_of_light, logstep / oversample)
+    us = np.log1p(vel_grid * 1000. / speed_of_light)
+    abstol = tol * ((curdata.spec / curdata.espec)**2).sum()
+    # The costs are in the units of one multiply-add and are calibrated on
+    # the timings of both methods.
+    # The direct evaluation computes the shifted template at every pixel
+    # for every velocity (which costs ~500 operations for the spline
+    # interpolator) and multiplies it by npoly + npoly^2 weighted
+    # polynomials (see get_chisq0_many)
+    templ_eval_cost = 500
+    point_cost = len(curdata.lam) * (templ_eval_cost + npoly * (npoly + 1))
+    direct_cost = len(vel_grid) * point_cost
+    # The FFT evaluation needs two forward transforms of the template and
+    # of its square and the inverse ones for npoly terms of M^T S and
+    # npoly*(npoly+1)/2 terms of M^T M. The forward transforms of these
+    # terms are cached (see get_fft_weights), but if they are not there
+    # yet, they must be computed as well
+    ntransforms = 2 + npoly + npoly * (npoly + 1) // 2
+    fft_cost_factor = 6
+    # the cost of the FFT passes so far; the FFT evaluation is abandoned
+    # when it is not going to be cheaper than the direct one
+    spent_cost = 0
+    for i in range(maxrefine + 1):
+        # the range of lags (with a margin for the interpolation)
+        j_lo = int(np.floor(us.min() / step)) - 2
+        j_hi = int(np.ceil(us.max() / step)) + 2
+        nlag = j_hi - j_lo + 1
+        ngrid = curdata.lamgrid.get_scatter(step)[1]
+        nfft = scipy.fftpack.next_fast_len(ngrid + nlag - 1)
+        curntransforms = ntransforms
+        if (curdata, npoly, step, nfft) not in get_fft_weights.cache:
+            curntransforms += ntransforms - 2
+        pass_cost = (fft_cost_factor * curntransforms * nfft * np.log2(nfft)
+                     + ncheck * point_cost)
+        if spent_cost + pass_cost > direct_cost:
+            return None
+        spent_cost += pass_cost
+        vels, chisq = _get_chisq_fft_lags(curdata, curtemplI, templ_lam,
+                                          npoly, step, j_lo, j_hi, nfft)
+        # the error of the chi-squares at the lags
+        check = np.unique(
+            np.r_[np.argmin(chisq),
+                  np.linspace(0, nlag - 1, ncheck - 1).astype(int)])
+        chisq_direct = get_chisq0_many(
+            evalRVmany(curtemplI, vels[check], curdata.lam),
+            *get_weighted_polys(curdata, npoly))
+        lag_err = np.abs(chisq_direct - chisq[check]).max()
+        # the error estimate of the interpolation at the lags within
+        # the range of vel_grid (the margins are the last lags)
+        odd = np.arange(1, nlag - 1, 2)
+        odd = odd[(odd >= 2) & (odd <= nlag - 3)]
+        if len(odd) == 0 or nlag < 7:
+            interp_err = 0
+        else:
+            chisq_even = scipy.interpolate.CubicSpline(
+                vels[::2], chisq[::2])(vels[odd])
+            interp_err = np.abs(chisq_even - chisq[odd]).max() / 2.
+        if max(lag_err, interp_err) <= abstol:
+            return scipy.interpolate.CubicSpline(vels, chisq)(vel_grid)
+        step = step / 2
+    return None
+
+
+def _get_chisq_fft_lags(curdata, curtemplI, templ_lam, npoly, step, j_lo,
+                        j_hi, nfft):
+    '''
+    Compute the chi-squares at the velocities corresponding to the lags
+    j_lo..j_hi of the log-wavelength grid with a given step (see
+    get_chisq_fft_arm)
+
+    Returns:
+    --------
+    vels: numpy
+        The velocities of the lags
+    chisq: numpy
+        The chi-squares
+    '''
+    nlag = j_hi - j_lo + 1
+    i0, ngrid, fvec, fmat = get_fft_weights(curdata, npoly, step, nfft)
+
+    # evaluate the template on the shifted log-wavelength grid
+    lam_shift = np.exp((i0 - j_hi + np.arange(ngrid + nlag - 1)) * step)
+    templ = curtemplI(np.clip(lam_shift, templ_lam[0], templ_lam[-1]))
+    ftempl = np.fft.rfft(templ, nfft)
+    ftempl2 = np.fft.rfft(templ**2, nfft)
+    # the correlation at lag n corresponds to velocity step j_hi - n
+    vector1 = np.fft.irfft(fvec * ftempl, nfft)[:, :nlag][:, ::-1].T
+    mat = np.fft.irfft(fmat * ftempl2, nfft)[:, :nlag][:, ::-1].T
+    matrix1 = np.zeros((nlag, npoly, npoly))
+    iu = np.triu_indices(npoly)
+    matrix1[:, iu[0], iu[1]] = mat
+    matrix1[:, iu[1], iu[0]] = mat
+    chisq = solve_normal(matrix1, vector1)
+    vels = np.expm1(np.arange(j_lo, j_hi + 1) * step) * speed_of_light / 1e3
+    return vels, chisq
+
+
+def get_chisq_fft(specdata,
+                  vel_grid,
+                  atm_params,
+                  rot_params,
+                  resol_params,
+                  options=None,
+                  config=None,
+                  cache=None):
+    """ Find the chi-squares of the dataset on a grid of velocities
+    for given atmospheric parameters, rotation parameters and resolution
+    parameters using FFTs (see get_chisq_fft_arm). This gives the same
+    curve as get_chisq_vels up to the error controlled by
+    get_chisq_fft_arm, but in O(N log N) operations.
+    If the resolution matrices are given, or the direct evaluation is
+    expected to be cheaper, get_chisq_vels is used instead.
+
+    Returns:
+    --------
+    chisq: numpy
+        The array of chi-squares for each velocity in vel_grid
+    """
+    if resol_params is not None:
+        return get_chisq_vels(
+            specdata,
+            vel_grid,
+            atm_params,
+            rot_params,
+            resol_params,
+            options=options,
+            config=config,
+            cache=cache)
+    npoly = options.get('npoly') or 5
+    vel_grid = np.asarray(vel_grid, dtype=float)
+    chisq = np.zeros(len(vel_grid))
+    badchi = 1e6
+    if rot_params is not None:
+        rot_params = tuple(rot_params)
+    atm_params = tuple(atm_params)
+
+    # iterate over multiple datasets
+    for curdata in specdata:
+        outside, templ_lam, curtemplI = get_templ_interpol(
+            curdata, atm_params, rot_params, config, cache=cache)
+
+        # if the current point is outside the template grid
+        # add bad value and bail out
+
+        if not np.isfinite(outside):
+            chisq += badchi
+            continue
+        else:
+            chisq += outside
+
+        curchisq = get_chisq_fft_arm(curdata, curtemplI, templ_lam, vel_grid,
+                                     npoly)
+        if curchisq is None:
+            curchisq = get_chisq0_many(
+                evalRVmany(curtemplI, vel_grid, curdata.lam),
+                *get_weighted_polys(curdata, npoly))
+        assert (np.isfinite(curchisq).all())
+        chisq += curchisq
+    return chisq
+
+
 def find_best(specdata,
               vel_grid,
               params_list,
               rot_params,
               resol_params,
               options=None,
-              config=None):
+              config=None,
+              fft=False,
+              cache=None):
     # find the best fit template and velocity from a grid
-    cache = LRUDict(100)
+    # if fft is True, the chi-square curves are computed using FFTs
+    # cache is the cache of template interpolators (see get_templ_interpol)
     chisq = np.zeros((len(vel_grid), len(params_list)))
+    if fft:
+        chisq_func = get_chisq_fft
+    else:
+        chisq_func = get_chisq_vels
     for j, curparam in enumerate(params_list):
-        for i, v in enumerate(vel_grid):
-            chisq[i, j] = get_chisq(
-                specdata,
-                v,
-                curparam,
-                rot_params,
-                resol_params,
-                options=options,
-                config=config,
-                cache=cache)
+        chisq[:, j] = chisq_func(
+            specdata,
+            vel_grid,
+            curparam,
+            rot_params,
+            resol_params,
+            options=options,
+            config=config,
+            cache=cache)
     xind = np.argmin(chisq)
     i1, i2 = np.unravel_index(xind, chisq.shape)
     probs = np.exp(-0.5 * (chisq[:, i2] - chisq[i1, i2]))
@@ -579,3 +1724,159 @@ def find_best(specdata,
         kurtosis=kurtosis,
         skewness=skewness,
         probs=probs)
+
+
+class VelPosterior:
+    """
+    The velocity posterior for given atmospheric, rotation and resolution
+    parameters, sampled adaptively. The chi-squares computed at different
+    velocities are kept in the sorted store and are never recomputed,
+    while the new velocities are only added where the posterior has
+    significant mass (see refine).
+    """
+    # the chi-square difference from the minimum beyond which
+    # the posterior is considered negligible
+    max_delta_chisq = 30
+
+    def __init__(self,
+                 specdata,
+                 atm_params,
+                 rot_params,
+                 resol_params,
+                 options=None,
+                 config=None,
+                 cache=None):
+        self.specdata = specdata
+        self.atm_params = atm_params
+        self.rot_params = rot_params
+        self.resol_params = resol_params
+        self.options = options
+        self.config = config
+        self.cache = cache
+        self.vels = np.zeros(0)
+        self.chisqs = np.zeros(0)
+        # the number of chi-square evaluations (the velocities evaluated
+        # with FFTs and then directly count twice)
+        self.nevals = 0
+        # the number of requested velocities that were already in the store
+        self.nskipped = 0
+
+    def _get_chisq(self, chisq_func, vels):
+        self.nevals += len(vels)
+        return chisq_func(
+            self.specdata,
+            vels,
+            self.atm_params,
+            self.rot_params,
+            self.resol_params,
+            options=self.options,
+            config=self.config,
+            cache=self.cache)
+
+    def add(self, vels, fft=False):
+        """
+        Evaluate the chi-squares at the velocities that are not yet in the
+        store. If fft is True, the vels must be a uniform grid that is
+        evaluated at once using FFTs (see get_chisq_fft). The FFT
+        chi-squares are then only used to locate the region where the
+        posterior has significant mass, and the velocities in that region
+        (and their neighbours) are evaluated directly, so that the moments
+        never mix the chi-squares computed by different methods.
+        """
+        vels = np.asarray(vels, dtype=float)
+        if not fft:
+            stored = np.isin(vels, self.vels)
+            self.nskipped += stored.sum()
+            vels = vels[~stored]
+        if len(vels) == 0:
+            return
+        if fft:
+            chisqs = self._get_chisq(get_chisq_fft, vels)
+            good = chisqs - chisqs.min() < self.max_delta_chisq
+            good = good | np.r_[good[1:], False] | np.r_[False, good[:-1]]
+            chisqs[good] = self._get_chisq(get_chisq_vels, vels[good])
+        else:
+            chisqs = self._get_chisq(get_chisq_vels, vels)
+        keep = ~np.isin(vels, self.vels)
+        vels = np.concatenate((self.vels, vels[keep]))
+        chisqs = np.concatenate((self.chisqs, chisqs[keep]))
+        xind = np.argsort(vels)
+        self.vels, self.chisqs = vels[xind], chisqs[xind]
+
+    def significant(self):
+        """ Return the mask of the intervals between the neighbouring
+        velocities in the store where the posterior has significant mass """
+        good = self.chisqs - self.chisqs.min() < self.max_delta_chisq
+        return good[1:] | good[:-1]
+
+    def refine(self, max_step):
+        """
+        Halve the intervals longer than max_step where the posterior
+        has significant mass
+
+        Returns:
+        --------
+        nadded: integer
+            The number of added velocities
+        """
+        steps = np.diff(self.vels)
+        sig = self.significant()
+        sel = sig & (steps > max_step)
+        newvels = 0.5 * (self.vels[1:] + self.vels[:-1])[sel]
+        self.add(newvels)
+        return len(newvels)
+
+    def moments(self, every=1):
+        """
+        Compute the best velocity and the moments of the posterior around it
+
+        Parameters:
+        -----------
+        every: integer, optional
+            If greater than 1, only every N-th sample (starting from the
+            one with the lowest chi-square) is used. The comparison with
+            the moments from all the samples shows if the posterior is
+            resolved.
+
+        Returns:
+        --------
+        ret: dict
+            The dictionary with best_vel, best_chi, vel_err, skewness
+            and kurtosis
+        """
+        imin = np.argmin(self.chisqs)
+        sub = slice(imin % every, None, every)
+        vels = self.vels[sub]
+        chisqs = self.chisqs[sub]
+        i1 = np.argmin(chisqs)
+        best_vel = vels[i1]
+        # the trapezoidal weights of the non-uniform grid
+        weights = np.zeros(len(vels))
+        if len(vels) > 1:
+            steps = np.diff(vels)
+            weights[1:] += 0.5 * steps
+            weights[:-1] += 0.5 * steps
+        else:
+            weights[:] = 1
+        probs = np.exp(-0.5 * (chisqs - chisqs[i1])) * weights
+        probs = probs / probs.sum()
+        best_err = np.sqrt((probs * (vels - best_vel)**2).sum())
+        if best_err < 1e-10:
+            kurtosis, skewness = 0, 0
+        else:
+            kurtosis = ((probs * (vels - best_vel)**4).sum()) / best_err**4
+            skewness = ((probs * (vels - best_vel)**3).sum()) / best_err**3
+        return dict(
+            best_vel=best_vel,
+            best_chi=chisqs[i1],
+            vel_err=best_err,
+            skewness=skewness,
+            kurtosis=kurtosis)
+
+    def max_significant_step(self):
+        """ Return the largest interval in the significant
+        part of the posterior """
+        steps = np.diff(self.vels)[self.significant()]
+        if len(steps) == 0:
+            return 0
+        return steps.max()
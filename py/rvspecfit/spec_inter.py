@@ -1,38 +1,522 @@
+import os
 import numpy as np
 import scipy.spatial
-import scipy.interpolate
 import pickle
 
 from rvspecfit import make_nd
+from rvspecfit import libfile
+from rvspecfit import lrucache
+from rvspecfit import shared_store
 
 
-def getInterp(triang, dats, exp=True):
-    # get Interpolation object from the Delaunay triangulation
-    # and array of vectors
-    def func(p):
+def getInterpFlag(triang, dats, extraflags, exp=True, basis=None):
+    # get the function evaluating both the spectrum and the outside flag
+    # at one point using a single point location in the triangulation
+    def func(p, spec=True):
         p = np.asarray(p)
         ndim = triang.ndim
         xid = triang.find_simplex(p)
         if xid == -1:
-            return np.nan
+            return np.nan, np.nan
         b = triang.transform[xid, :ndim, :].dot(p -
                                                 triang.transform[xid, ndim, :])
         b1 = np.r_[b, [1 - b.sum()]]
-        spec = (dats[triang.simplices[xid], :] * b1[:, None]).sum(axis=0)
+        verts = triang.simplices[xid]
+        flag = extraflags[verts, 0].dot(b1)
+        if not spec:
+            return None, flag
+        curspec = (dats[verts, :] * b1[:, None]).sum(axis=0)
+        if basis is not None:
+            curspec = curspec.dot(basis)
         if exp:
-            spec = np.exp(spec)
-        return spec
+            curspec = np.exp(curspec)
+        return curspec, flag
+
+    return func
+
+
+class Triangulation:
+    """
+    Delaunay triangulation that is stored as plain arrays (in the same
+    form as in scipy.spatial.Delaunay). The points are located by walking
+    from the simplex with the nearest centre towards the point, or from
+    the starting simplices given by the caller.
+    Single points without the starting simplex start from the simplex of
+    the previous single point. That state is shared by all the users of
+    the triangulation in the process, so the callers interleaving queries
+    in different parts of the grid should keep their own state instead,
+    by passing the previously returned simplex as the start argument.
+    """
+    eps = 100 * np.finfo(np.float64).eps
+    # the maximum length of the walk from the previous simplex before
+    # switching to the global search
+    maxwarm = 20
+
+    def __init__(self, points, simplices, transform, neighbors):
+        """
+        Parameters:
+        -----------
+        points: numpy array (Npoints, Ndim)
+            The vertices
+        simplices: numpy array (Nsimplex, Ndim+1)
+            The indices of vertices of the simplices
+        transform: numpy array (Nsimplex, Ndim+1, Ndim)
+            The affine transforms to the barycentric coordinates
+        neighbors: numpy array (Nsimplex, Ndim+1)
+            The neighbor simplices opposite to each vertex (-1 at the
+            boundary)
+        """
+        self.points = points
+        self.simplices = simplices
+        self.transform = transform
+        self.neighbors = neighbors
+        self.ndim = points.shape[1]
+        self.nsimplex = len(simplices)
+        self._tree = None
+        # the simplex of the last located single point without the start
+        self.last = None
+        self.stats = dict(nlocate=0, nsteps=0, nglobal=0, nbrute=0)
+
+    def _get_start(self, xi):
+        # the simplices with the centres nearest to the points
+        if self._tree is None:
+            self._tree = scipy.spatial.cKDTree(
+                self.points[self.simplices].mean(axis=1))
+        return self._tree.query(xi)[1]
+
+    def _barycentric(self, isimplex, xi):
+        transform = self.transform[isimplex]
+        b = np.einsum('nij,nj->ni', transform[:, :self.ndim, :],
+                      xi - transform[:, self.ndim, :])
+        return np.hstack((b, 1 - b.sum(axis=1)[:, None]))
+
+    def find_simplex(self, xi, maxiter=1000, start=None):
+        """
+        Find the simplices containing the points
+
+        Parameters:
+        -----------
+        xi: numpy array (Ndim) or (N, Ndim)
+            The points
+        maxiter: integer
+            The maximum number of steps of the walk. The points that are not
+            located by then are found by the brute force search
+        start: integer or numpy array (N) or None
+            The simplices to start the walks from, i.e. the simplices
+            returned for the previous nearby points (-1 means the global
+            search). If None, the single points start from the simplex of
+            the previous single point located without the start and the
+            arrays of points from the global search
+
+        Returns:
+        --------
+        ret: integer or numpy array (N)
+            The indices of simplices or -1 for the points outside the
+            triangulation
+        """
+        xi = np.asarray(xi, dtype=np.float64)
+        scalar = xi.ndim == 1
+        if scalar:
+            return self._find_one(xi, maxiter, start)
+        xi = np.atleast_2d(xi)
+        npt = len(xi)
+        ret = np.zeros(npt, dtype=int) - 1
+        good = np.all(np.isfinite(xi), axis=1)
+        active = np.nonzero(good)[0]
+        cur = np.zeros(npt, dtype=int) - 1
+        if start is not None:
+            cur[active] = np.broadcast_to(start, (npt, ))[active]
+        cold = active[cur[active] < 0]
+        if len(cold) > 0:
+            cur[cold] = self._get_start(xi[cold])
+        self.stats['nlocate'] += len(active)
+        self.stats['nglobal'] += len(cold)
+        for i in range(maxiter):
+            if len(active) == 0:
+                break
+            coords = self._barycentric(cur[active], xi[active])
+            # NaN coordinates correspond to the degenerate simplices
+            finite = np.all(np.isfinite(coords), axis=1)
+            inside = finite & (coords.min(axis=1) >= -self.eps)
+            ret[active[inside]] = cur[active[inside]]
+            # move across the facet opposite to the most negative coordinate
+            step = self.neighbors[cur[active], coords.argmin(axis=1)]
+            # if it is the boundary facet, the point is outside
+            outside = finite & (~inside) & (step == -1)
+            keep = finite & (~inside) & (~outside)
+            if not finite.all():
+                ret[active[~finite]] = self._brute_force(xi[active[~finite]])
+            cur[active[keep]] = step[keep]
+            active = active[keep]
+            self.stats['nsteps'] += len(active)
+        if len(active) > 0:
+            ret[active] = self._brute_force(xi[active])
+        return ret
+
+    def _walk(self, x, cur, maxiter):
+        # walk from the simplex cur towards the point
+        # it returns the simplex (-1 if the point is outside) or None if
+        # the walk failed and the number of steps
+        ndim = self.ndim
+        coords = np.zeros(ndim + 1)
+        for i in range(maxiter):
+            transform = self.transform[cur]
+            coords[:ndim] = transform[:ndim, :].dot(x - transform[ndim, :])
+            coords[ndim] = 1 - coords[:ndim].sum()
+            j = coords.argmin()
+            if coords[j] >= -self.eps:
+                return cur, i
+            if np.isnan(coords[j]):
+                # degenerate simplex
+                return None, i
+            cur = self.neighbors[cur, j]
+            if cur == -1:
+                return -1, i
+        return None, maxiter
+
+    def _find_one(self, x, maxiter, start=None):
+        # the same as find_simplex but for one point. Without the start
+        # the walk starts from the simplex found in the previous such call,
+        # as consecutive queries tend to be close to each other
+        if not np.all(np.isfinite(x)):
+            return -1
+        self.stats['nlocate'] += 1
+        ret = None
+        warm = self.last if start is None else start
+        if warm is not None and warm >= 0:
+            ret, nsteps = self._walk(x, warm, self.maxwarm)
+            self.stats['nsteps'] += nsteps
+        if ret is None:
+            self.stats['nglobal'] += 1
+            ret, nsteps = self._walk(x, self._get_start(x), maxiter)
+            self.stats['nsteps'] += nsteps
+        if ret is None:
+            ret = self._brute_force(x[None, :])[0]
+        if ret != -1 and start is None:
+            self.last = ret
+        return ret
+
+    def info(self):
+        """ Return the dictionary with the statistics of point location:
+        the number of located points, the total number of walk steps,
+        the number of walks started from the global search and
+        the number of brute force searches """
+        return dict(self.stats)
+
+    def _brute_force(self, xi):
+        self.stats['nbrute'] += len(xi)
+        ret = np.zeros(len(xi), dtype=int) - 1
+        allsimplex = np.arange(self.nsimplex)
+        for i, curx in enumerate(xi):
+            coords = self._barycentric(allsimplex,
+                                       np.tile(curx, (self.nsimplex, 1)))
+            xid = np.nonzero(np.all(coords >= -self.eps, axis=1))[0]
+            if len(xid) > 0:
+                ret[i] = xid[0]
+        return ret
+
+
+def mix_nodes(weights,
+              verts,
+              dats,
+              extraflags,
+              exp=True,
+              spec=True,
+              basis=None):
+    """
+    Compute the weighted sums of the grid spectra and of the outside flags
+
+    Parameters:
+    -----------
+    weights: numpy array (N, Nvert)
+        The weights of the nodes
+    verts: numpy array (N, Nvert)
+        The indices of the nodes
+    dats: numpy array (Nnodes, Npix) or (Nnodes, Ncoeff)
+        The (log) spectra of the nodes or their coefficients in the basis
+    extraflags: numpy array (Nnodes, 1)
+        The outside flags of the nodes
+    exp: bool
+        If true the spectra are exponentiated after mixing
+    spec: bool
+        If false only the flags are computed
+    basis: numpy array (Ncoeff, Npix) or None
+        The basis vectors if the nodes are stored as coefficients
+
+    Returns:
+    --------
+    specs: numpy array (N, Npix) or None
+    flags: numpy array (N)
+    """
+    npt, nvert = verts.shape
+    # read each of the nodes only once, as the neighbouring points
+    # tend to share them
+    if npt == 1:
+        nodes, mat = verts[0], weights
+    else:
+        nodes, inv = np.unique(verts, return_inverse=True)
+        mat = np.zeros((npt, len(nodes)))
+        np.add.at(mat, (np.repeat(np.arange(npt), nvert), inv.ravel()),
+                  weights.ravel())
+    flags = mat.dot(extraflags[nodes, 0])
+    if not spec:
+        return None, flags
+    specs = mat.dot(dats[nodes, :])
+    if basis is not None:
+        specs = specs.dot(basis)
+    if exp:
+        specs = np.exp(specs)
+    return specs, flags
+
+
+def getRectInterpMany(axes,
+                      node_index,
+                      dats,
+                      extraflags,
+                      exp=True,
+                      basis=None):
+    # get the function evaluating the multilinear interpolation on
+    # the rectilinear grid at many points at once
+    ndim = len(axes)
+    # the offsets of the corners of the grid cell
+    corners = (np.arange(2**ndim)[:, None] >> np.arange(ndim)[None, :]) & 1
+    npix = (dats if basis is None else basis).shape[1]
+
+    def func(p, spec=True):
+        p = np.atleast_2d(np.asarray(p, dtype=np.float64))
+        npt = len(p)
+        good = np.ones(npt, dtype=bool)
+        pos = np.zeros((npt, ndim), dtype=int)
+        frac = np.zeros((npt, ndim))
+        for i, axis in enumerate(axes):
+            x = p[:, i]
+            good &= (x >= axis[0]) & (x <= axis[-1])
+            curpos = np.clip(
+                np.searchsorted(axis, x, side='right') - 1, 0,
+                len(axis) - 2)
+            pos[:, i] = curpos
+            frac[:, i] = (x - axis[curpos]) / (axis[curpos + 1] -
+                                               axis[curpos])
+        flags = np.zeros(npt) + np.nan
+        specs = None
+        if spec:
+            specs = np.zeros((npt, npix)) + np.nan
+        if not good.any():
+            return specs, flags
+        pos, frac = pos[good], frac[good]
+        weights = np.where(corners[None, :, :] == 1, frac[:, None, :],
+                           1 - frac[:, None, :]).prod(axis=2)
+        verts = node_index[tuple(
+            np.moveaxis(pos[:, None, :] + corners[None, :, :], 2, 0))]
+        curspecs, flags[good] = mix_nodes(
+            weights, verts, dats, extraflags, exp=exp, spec=spec, basis=basis)
+        if spec:
+            specs[good] = curspecs
+        return specs, flags
+
+    return func
+
+
+def mix_nodes_grad(weights,
+                   dweights,
+                   verts,
+                   dats,
+                   extraflags,
+                   exp=True,
+                   basis=None):
+    """
+    Compute the weighted sum of the grid spectra and of the outside flags at
+    one point together with their derivatives with respect to the
+    coordinates of the point
+
+    Parameters:
+    -----------
+    weights: numpy array (Nvert)
+        The weights of the nodes
+    dweights: numpy array (Ndim, Nvert)
+        The derivatives of the weights with respect to the coordinates
+    verts: numpy array (Nvert)
+        The indices of the nodes
+    dats, extraflags, exp, basis:
+        See mix_nodes
+
+    Returns:
+    --------
+    spec: numpy array (Npix)
+    flag: float
+    dspec: numpy array (Ndim, Npix)
+    dflag: numpy array (Ndim)
+    """
+    mat = np.vstack((weights, dweights))
+    flags = mat.dot(extraflags[verts, 0])
+    specs = mat.dot(dats[verts, :])
+    if basis is not None:
+        specs = specs.dot(basis)
+    spec, dspec = specs[0], specs[1:]
+    if exp:
+        spec = np.exp(spec)
+        dspec = dspec * spec[None, :]
+    return spec, flags[0], dspec, flags[1:]
+
+
+def getRectInterpGrad(axes,
+                      node_index,
+                      dats,
+                      extraflags,
+                      exp=True,
+                      basis=None):
+    # get the function evaluating the multilinear interpolation on
+    # the rectilinear grid and its gradient at one point
+    ndim = len(axes)
+    corners = (np.arange(2**ndim)[:, None] >> np.arange(ndim)[None, :]) & 1
+
+    def func(p):
+        p = np.asarray(p, dtype=np.float64)
+        pos = np.zeros(ndim, dtype=int)
+        frac = np.zeros(ndim)
+        width = np.zeros(ndim)
+        for i, axis in enumerate(axes):
+            if not (axis[0] <= p[i] <= axis[-1]):
+                return np.nan, np.nan, None, None
+            pos[i] = np.clip(
+                np.searchsorted(axis, p[i], side='right') - 1, 0,
+                len(axis) - 2)
+            width[i] = axis[pos[i] + 1] - axis[pos[i]]
+            frac[i] = (p[i] - axis[pos[i]]) / width[i]
+        # the factors of the weights along each dimension and
+        # their derivatives
+        facs = np.where(corners == 1, frac[None, :], 1 - frac[None, :])
+        dfacs = np.where(corners == 1, 1., -1.) / width[None, :]
+        weights = facs.prod(axis=1)
+        dweights = np.array([
+            dfacs[:, i] * np.delete(facs, i, axis=1).prod(axis=1)
+            for i in range(ndim)
+        ])
+        verts = node_index[tuple((pos[None, :] + corners).T)]
+        return mix_nodes_grad(weights,
+                              dweights,
+                              verts,
+                              dats,
+                              extraflags,
+                              exp=exp,
+                              basis=basis)
+
+    return func
+
+
+def getInterpGrad(triang, dats, extraflags, exp=True, basis=None):
+    # get the function evaluating the interpolation on the triangulation
+    # and its gradient at one point. The barycentric coordinates are linear
+    # within the simplex, so their derivatives are the rows of the affine
+    # transform (and minus their sum for the last vertex)
+    def func(p):
+        p = np.asarray(p, dtype=np.float64)
+        ndim = triang.ndim
+        xid = triang.find_simplex(p)
+        if xid == -1:
+            return np.nan, np.nan, None, None
+        transform = triang.transform[xid]
+        b = transform[:ndim, :].dot(p - transform[ndim, :])
+        b1 = np.r_[b, [1 - b.sum()]]
+        db1 = np.vstack((transform[:ndim, :], -transform[:ndim, :].sum(
+            axis=0)[None, :]))
+        return mix_nodes_grad(b1,
+                              db1.T,
+                              triang.simplices[xid],
+                              dats,
+                              extraflags,
+                              exp=exp,
+                              basis=basis)
+
+    return func
+
+
+def getInterpMany(triang, dats, extraflags, exp=True, basis=None):
+    # get the function evaluating the interpolation at many points at once
+    # it returns both the spectra and the outside flags that are computed
+    # using the same barycentric weights
+    npix = (dats if basis is None else basis).shape[1]
+
+    def func(p, spec=True):
+        p = np.atleast_2d(np.asarray(p, dtype=np.float64))
+        ndim = triang.ndim
+        xid = triang.find_simplex(p)
+        good = xid != -1
+        npt = len(p)
+        flags = np.zeros(npt) + np.nan
+        specs = None
+        if spec:
+            specs = np.zeros((npt, npix)) + np.nan
+        if not good.any():
+            return specs, flags
+        xid = xid[good]
+        transform = triang.transform[xid]
+        b = np.einsum('nij,nj->ni', transform[:, :ndim, :],
+                      p[good] - transform[:, ndim, :])
+        b1 = np.hstack((b, 1 - b.sum(axis=1)[:, None]))
+        verts = triang.simplices[xid]
+        curspecs, flags[good] = mix_nodes(
+            b1, verts, dats, extraflags, exp=exp, spec=spec, basis=basis)
+        if spec:
+            specs[good] = curspecs
+        return specs, flags
+
+    return func
+
+
+def getSingle(interper_many):
+    # get the function evaluating the spectrum and the outside flag
+    # at one point from the function for many points
+    def func(p, spec=True):
+        specs, flags = interper_many(p, spec=spec)
+        if not np.isfinite(flags[0]):
+            return np.nan, np.nan
+        if not spec:
+            return None, flags[0]
+        return specs[0], flags[0]
 
     return func
 
 
+def getSeparate(interper_both):
+    # get the separate functions evaluating the spectrum and the outside
+    # flag from the function evaluating both
+    def interper(p):
+        return interper_both(p)[0]
+
+    def extraper(p):
+        return interper_both(p, spec=False)[1]
+
+    return interper, extraper
+
+
 class SpecInterpolator:
     # Spectrum interpolator object
-    def __init__(self, name, interper, extraper, lam, mapper, parnames):
+    def __init__(self,
+                 name,
+                 interper,
+                 extraper,
+                 lam,
+                 mapper,
+                 parnames,
+                 interper_many=None,
+                 interper_both=None,
+                 triang=None,
+                 interper_grad=None,
+                 box=None):
         """ Construct the interpolator object
         The arguments are the name of the instrument setup
         The interpolator object that returns the
         The extrapolation object,
+        The optional object that evaluates both the spectra and the
+        extrapolation flags for many points at once
+        The optional object that evaluates both the spectrum and the
+        extrapolation flag at one point
+        The optional triangulation used by the interpolator
+        The optional object that evaluates the spectrum, the extrapolation
+        flag and their gradients at one point
+        The optional tuple of the lower and upper corners of the box in the
+        transformed parameters that is covered by the interpolator
         """
 
         self.name = name
@@ -41,6 +525,11 @@ class SpecInterpolator:
         self.extraper = extraper
         self.mapper = mapper
         self.parnames = parnames
+        self.interper_many = interper_many
+        self.interper_both = interper_both
+        self.triang = triang
+        self.interper_grad = interper_grad
+        self.box = box
 
     def outsideFlag(self, param0):
         """Check if the point is outside the interpolation grid"""
@@ -54,40 +543,274 @@ class SpecInterpolator:
         param = self.mapper.forward(param0)
         return self.interper(param)
 
+    def eval_flag(self, param0):
+        """ Evaluate the spectrum and the outside flag at a given parameter.
+        The spectrum is NaN if the point is completely outside the grid
+
+        Returns:
+        --------
+        spec: numpy array
+            The spectrum
+        flag: float
+            The outside flag (see outsideFlag)
+        """
+        if isinstance(param0, dict):
+            param0 = [param0[_] for _ in self.parnames]
+        param = self.mapper.forward(param0)
+        if self.interper_both is not None:
+            spec, flag = self.interper_both(param)
+        else:
+            spec, flag = self.interper(param), self.extraper(param)
+        return spec, float(flag)
+
+    def eval_many(self, params0):
+        """ Evaluate the spectra and the outside flags at many parameters
+
+        Parameters:
+        -----------
+        params0: numpy array (N, Ndim) or list of dictionaries
+            The atmospheric parameters
+
+        Returns:
+        --------
+        specs: numpy array (N, Npix)
+            The spectra (NaNs for the points outside the triangulation)
+        flags: numpy array (N)
+            The outside flags (see outsideFlag)
+        """
+        if len(params0) > 0 and isinstance(params0[0], dict):
+            params0 = [[_[__] for __ in self.parnames] for _ in params0]
+        params0 = np.atleast_2d(np.asarray(params0, dtype=np.float64))
+        # the mapper works with the (Ndim, N) arrays
+        params = np.asarray(self.mapper.forward(params0.T)).T
+        if self.interper_many is not None:
+            return self.interper_many(params)
+        specs = np.array([self.interper(_) * np.ones(len(self.lam))
+                          for _ in params])
+        flags = np.array([float(self.extraper(_)) for _ in params])
+        return specs, flags
+
+    def eval_grad(self, param0):
+        """ Evaluate the spectrum, the outside flag and their derivatives
+        with respect to the atmospheric parameters. The interpolation is
+        linear within each simplex (or multilinear within each cell of the
+        rectilinear grid), so the derivatives are exact (and one-sided at
+        the faces between the simplices)
+
+        Returns:
+        --------
+        spec: numpy array
+            The spectrum (NaN if the point is outside the grid)
+        flag: float
+            The outside flag (see outsideFlag)
+        dspec: numpy array (Ndim, Npix)
+            The derivatives of the spectrum (None if the point is outside
+            the grid)
+        dflag: numpy array (Ndim)
+            The derivatives of the outside flag
+        """
+        if isinstance(param0, dict):
+            param0 = [param0[_] for _ in self.parnames]
+        param0 = np.asarray(param0, dtype=np.float64)
+        spec, flag, dspec, dflag = self.interper_grad(
+            self.mapper.forward(param0))
+        if not np.isfinite(flag):
+            return spec, flag, None, None
+        # the chain rule for the parameter transformation
+        jac = self._mapper_jacobian(param0)
+        return spec, float(flag), jac.T.dot(dspec), jac.T.dot(dflag)
+
+    def _mapper_jacobian(self, param0):
+        # the derivatives of the transformed parameters (rows) with respect
+        # to the original ones (columns) by central differences, as the
+        # mapper is a cheap smooth function
+        steps = 1e-6 * np.maximum(np.abs(param0), 1)
+        plus = param0[:, None] + np.diag(steps)
+        minus = param0[:, None] - np.diag(steps)
+        return (np.asarray(self.mapper.forward(plus)) - np.asarray(
+            self.mapper.forward(minus))) / (2 * steps[None, :])
+
+    def param_bounds(self):
+        """ Return the list of (min, max) ranges of the atmospheric
+        parameters covered by the interpolator (or None if unknown).
+        The edges are moved inside by a tiny fraction of the range, so
+        that the parameters at the bounds are always inside """
+        if self.box is None:
+            return None
+        lo, hi = [np.asarray(_, dtype=np.float64) for _ in self.box]
+        eps = 1e-9 * (hi - lo)
+        lo, hi = [
+            np.asarray(self.mapper.inverse(_), dtype=np.float64)
+            for _ in [lo + eps, hi - eps]
+        ]
+        return list(zip(np.minimum(lo, hi), np.maximum(lo, hi)))
+
+    def locate_info(self):
+        """ Return the statistics of point location in the triangulation
+        (see Triangulation.info) or None if there is no triangulation"""
+        if self.triang is None:
+            return None
+        return self.triang.info()
+
 
 class interp_cache:
-    interps = {}
+    interps = lrucache.Cache('interpolators')
+
+
+def read_library(HR, config, warmup_cache=None):
+    """ Read the interpolation library for a given instrument setup HR.
+    It reads the library container if it exists and the legacy pickle and
+    npy files otherwise.
+
+    Parameters:
+    -----------
+    HR: string
+        The spectroscopic setup
+    config: dict
+        The configuration dictionary
+    warmup_cache: bool or None
+        If true all the templates are read to put them in the memory cache.
+        If None (default) that is only done for the legacy npy files, while
+        the pages of the library files are read on demand
+
+    Returns:
+    --------
+    ret: dict
+        The dictionary with the wavelength (lam), the grid (vec),
+        the outside flags (extraflags), the parameter mapper (mapper),
+        the parameter names (parnames), the interpolation type (interp_type),
+        the spectra or their PCA coefficients (dats), the PCA basis (basis)
+        and either the triangulation (triang) or the rectilinear grid
+        (axes, node_index)
+    """
+    prefix = config['template_lib']
+    fname = prefix + make_nd.INTERPOL_LIB_NAME % HR
+    legacy = not os.path.exists(fname)
+    if not legacy:
+        arrays0, meta = libfile.read(fname)
+        arrays = shared_store.get_library_arrays(fname, arrays0)
+        shared = arrays['dats'] is not arrays0['dats']
+        ret = dict(lam=arrays['lam'],
+                   vec=arrays['vec'],
+                   extraflags=arrays['extraflags'],
+                   mapper=libfile.mapper_from_meta(meta['mapper']),
+                   parnames=tuple(meta['parnames']),
+                   interp_type=meta['interp_type'],
+                   dats=arrays['dats'],
+                   basis=arrays.get('basis'))
+        if ret['interp_type'] == 'delaunay':
+            ret['triang'] = Triangulation(arrays['points'],
+                                          arrays['simplices'],
+                                          arrays['transform'],
+                                          arrays['neighbors'])
+        else:
+            ret['axes'] = [arrays['axis%d' % _] for _ in range(meta['ndim'])]
+            ret['node_index'] = arrays['node_index']
+    else:
+        # the legacy pickle and npy files
+        with open(prefix + make_nd.INTERPOL_PKL_NAME % HR, 'rb') as fd0:
+            fd = pickle.load(fd0)
+        ret = dict(lam=fd['lam'],
+                   vec=fd['vec'],
+                   extraflags=fd['extraflags'],
+                   mapper=fd['mapper'],
+                   parnames=fd['parnames'],
+                   interp_type=fd.get('interp_type', 'delaunay'),
+                   axes=fd.get('axes'),
+                   node_index=fd.get('node_index'))
+        if ret['interp_type'] == 'delaunay':
+            triang = fd['triang']
+            ret['triang'] = Triangulation(triang.points, triang.simplices,
+                                          triang.transform, triang.neighbors)
+        dat_fname = prefix + make_nd.INTERPOL_DAT_NAME % HR
+        ret['dats'] = shared_store.get_library_array(dat_fname)
+        shared = ret['dats'] is not None
+        if not shared:
+            ret['dats'] = np.load(dat_fname, mmap_mode='r')
+        ret['basis'] = None
+        if fd.get('npca') is not None:
+            # the library is stored as the coefficients of the PCA basis
+            basis_fname = prefix + make_nd.INTERPOL_BASIS_NAME % HR
+            ret['basis'] = shared_store.get_library_array(basis_fname)
+            if ret['basis'] is None:
+                ret['basis'] = np.load(basis_fname)
+    if warmup_cache is None:
+        warmup_cache = legacy
+    if warmup_cache and not shared:
+        # we read all the templates to put them in the memory cache
+        ret['dats'].sum()
+    return ret
 
 
-def getInterpolator(HR, config, warmup_cache=True):
+def getInterpolator(HR, config, warmup_cache=None):
     """ return the spectrum interpolation object for a given instrument
     setup HR and config
     """
-    if HR not in interp_cache.interps:
-        savefile = config['template_lib'] + make_nd.INTERPOL_PKL_NAME % HR
-        with open(savefile, 'rb') as fd0:
-            fd = pickle.load(fd0)
-            (triang, templ_lam, vecs, extraflags, mapper,
-             parnames) = (fd['triang'], fd['lam'], fd['vec'], fd['extraflags'],
-                          fd['mapper'], fd['parnames'])
+    interpObj = interp_cache.interps.get(HR)
+    if interpObj is None:
+        lib = read_library(HR, config, warmup_cache=warmup_cache)
         expFlag = True
-        dats = np.load(
-            config['template_lib'] + make_nd.INTERPOL_DAT_NAME % HR,
-            mmap_mode='r')
-        if warmup_cache:
-            # we read all the templates to put them in the memory cache
-            dats.sum()
-        interper, extraper = (getInterp(triang, dats, exp=expFlag),
-                              scipy.interpolate.LinearNDInterpolator(
-                                  triang, extraflags))
-        interpObj = SpecInterpolator(HR, interper, extraper, templ_lam, mapper,
-                                     parnames)
+        dats, extraflags, basis = lib['dats'], lib['extraflags'], lib['basis']
+        interp_type = lib['interp_type']
+        triang = None
+        if interp_type == 'rect':
+            interper_many = getRectInterpMany(lib['axes'],
+                                              lib['node_index'],
+                                              dats,
+                                              extraflags,
+                                              exp=expFlag,
+                                              basis=basis)
+            interper_both = getSingle(interper_many)
+            interper_grad = getRectInterpGrad(lib['axes'],
+                                              lib['node_index'],
+                                              dats,
+                                              extraflags,
+                                              exp=expFlag,
+                                              basis=basis)
+            box = ([_[0] for _ in lib['axes']], [_[-1] for _ in lib['axes']])
+        elif interp_type == 'delaunay':
+            triang = lib['triang']
+            interper_many = getInterpMany(triang,
+                                          dats,
+                                          extraflags,
+                                          exp=expFlag,
+                                          basis=basis)
+            interper_both = getInterpFlag(triang,
+                                          dats,
+                                          extraflags,
+                                          exp=expFlag,
+                                          basis=basis)
+            interper_grad = getInterpGrad(triang,
+                                          dats,
+                                          extraflags,
+                                          exp=expFlag,
+                                          basis=basis)
+            box = (triang.points.min(axis=0), triang.points.max(axis=0))
+        else:
+            raise ValueError('Unknown interpolation type %s' % interp_type)
+        interper, extraper = getSeparate(interper_both)
+        interpObj = SpecInterpolator(HR,
+                                     interper,
+                                     extraper,
+                                     lib['lam'],
+                                     lib['mapper'],
+                                     lib['parnames'],
+                                     interper_many=interper_many,
+                                     interper_both=interper_both,
+                                     triang=triang,
+                                     interper_grad=interper_grad,
+                                     box=box)
         interp_cache.interps[HR] = interpObj
-    else:
-        interpObj = interp_cache.interps[HR]
     return interpObj
 
 
+def locate_info():
+    """ Return the dictionary with the point location statistics of all
+    the interpolators in the cache """
+    return dict([(k, v[0].locate_info())
+                 for k, v in interp_cache.interps.D.items()])
+
+
 def getSpecParams(setup, config):
     ''' Return the ordered list of spectral parameters
     of a given spectroscopic setup'''
@@ -44,15 +44,165 @@ def firstguess(specdata, options=None, config=None, resolParams=None):
             options=options)
 
 
+def polish_candidates(specdata,
+                      candidates,
+                      options=None,
+                      config=None,
+                      resolParams=None):
+    """
+    Run short chi-square minimizations starting from each of the candidate
+    templates returned by the CCF (see fitter_ccf.fit) and return the
+    best starting point for process. The velocity and the atmospheric
+    parameters are optimized, while the vsini is kept fixed.
+    The number of chi-square evaluations per candidate is given by the
+    polish_maxfev option.
+
+    Parameters:
+    -----------
+    specdata: list of SpecData
+        The spectroscopic datasets
+    candidates: list of dicts
+        The candidates (the candidates item of the result of fitter_ccf.fit)
+    options: dict
+        Dictionary of options
+    config: dict
+        The configuration dictionary
+    resolParams: dict
+        The resolution matrices (could be None)
+
+    Returns:
+    --------
+    paramDict: dict
+        The dictionary with the best atmospheric parameters (and vsini if
+        the candidate has it)
+    vel: float
+        The best velocity
+    nfev: integer
+        The total number of chi-square evaluations
+    """
+    maxfev = options.get('polish_maxfev') or 30
+    specParams = spec_inter.getSpecParams(specdata[0].name, config)
+    if config.get('rv_interp_cache_scope') == 'star':
+        rv_cache = spec_fit.make_rv_interpol_cache(config)
+    else:
+        rv_cache = None
+    best = None
+    nfev = 0
+    for cand in candidates:
+        vsini = cand['best_vsini']
+        if vsini is not None and vsini > 0:
+            rot_params = (vsini, )
+        else:
+            rot_params = None
+
+        def func(p):
+            return spec_fit.get_chisq(
+                specdata,
+                p[0],
+                p[1:],
+                rot_params,
+                resolParams,
+                options=options,
+                config=config,
+                cache=rv_cache)
+
+        startParam = [cand['best_vel']] + [
+            cand['best_par'][_] for _ in specParams
+        ]
+        res = scipy.optimize.minimize(
+            func,
+            startParam,
+            method='Nelder-Mead',
+            options={
+                'maxfev': maxfev,
+                'fatol': 1e-3,
+                'xatol': 1e-2
+            })
+        nfev += res['nfev']
+        if best is None or res['fun'] < best[0]:
+            paramDict = dict(zip(specParams, res['x'][1:]))
+            if vsini is not None:
+                paramDict['vsini'] = vsini
+            best = res['fun'], paramDict, res['x'][0]
+    return best[1], best[2], nfev
+
+
+def get_regrid_nevals(best_vel,
+                      vel_err0,
+                      vel_err,
+                      min_vel,
+                      max_vel,
+                      vel_step0,
+                      min_vel_step,
+                      crit_ratio=5):
+    """
+    Return the number of chi-square evaluations needed to determine the
+    velocity uncertainty by evaluating the whole velocity grids around
+    best_vel, with the step crit_ratio times smaller than the uncertainty
+    (or min_vel_step) and the width 10 times the uncertainty.
+    That is how the uncertainty was determined before VelPosterior.
+
+    Parameters:
+    -----------
+    best_vel: float
+        The best velocity
+    vel_err0: float
+        The velocity uncertainty from the coarse grid with the step vel_step0
+    vel_err: float
+        The velocity uncertainty from the finer grids
+    min_vel: float
+        The minimum velocity
+    max_vel: float
+        The maximum velocity
+    vel_step0: float
+        The step of the coarse grid
+    min_vel_step: float
+        The minimum step
+    crit_ratio: float, optional
+        The ratio of the uncertainty and the step
+
+    Returns:
+    --------
+    nevals: integer
+        The number of evaluations
+    """
+    nevals = 0
+    vel_step = vel_step0
+    curerr = vel_err0
+    while True:
+        nevals += len(np.arange(best_vel, min_vel, -vel_step)) + len(
+            np.arange(best_vel + vel_step, max_vel, vel_step))
+        if vel_step < curerr / crit_ratio or vel_step < min_vel_step:
+            break
+        vel_step = max(curerr, vel_step) / crit_ratio * 0.8
+        new_width = max(curerr, vel_step) * 10
+        min_vel = max(best_vel - new_width, min_vel)
+        max_vel = min(best_vel + new_width, max_vel)
+        curerr = vel_err
+    return nevals
+
+
 def process(specdata,
             paramDict0,
             fixParam=None,
             options=None,
             config=None,
-            resolParams=None):
+            resolParams=None,
+            vel0=None):
     """
 process(specdata, {'logg':10, 'teff':30, 'alpha':0, 'feh':-1,'vsini':0}, fixParam = ('feh','vsini'),
                 config =config, resolParam = None)
+
+    The optimizer is selected by the method option: 'Nelder-Mead'
+    (default) or 'L-BFGS-B', that uses the gradient of the chi-square
+    (see spec_fit.get_chisq_grad). The number of chi-square evaluations
+    is returned as nfev.
+    If vel0 is given, it is used as the starting velocity, otherwise the
+    starting velocity is found by scanning the whole velocity range.
+    The uncertainties of the atmospheric parameters are computed from the
+    Fisher matrix (see spec_fit.get_fisher_matrix) or, if the
+    param_err_method option is 'hessian', from the numerical Hessian
+    of the chi-square.
     """
 
     # Configuration parameters, should be moved to the yaml file
@@ -62,6 +212,14 @@ process(specdata, {'logg':10, 'teff':30, 'alpha':0, 'feh':-1,'vsini':0}, fixPara
     max_vsini = config.get('max_vsini') or 500
     min_vsini = config.get('min_vsini') or 1e-2
     min_vel_step = config.get('min_vel_step') or 0.2
+    # use FFTs to compute the chi-square as a function of velocity
+    fft = config.get('vel_scan_fft', False)
+    # the template interpolators can be cached for this star only
+    # or for all the stars processed by this process
+    if config.get('rv_interp_cache_scope') == 'star':
+        rv_cache = spec_fit.make_rv_interpol_cache(config)
+    else:
+        rv_cache = None
 
     if config is None:
         raise Exception('Config must be provided')
@@ -91,14 +249,19 @@ process(specdata, {'logg':10, 'teff':30, 'alpha':0, 'feh':-1,'vsini':0}, fixPara
         else:
             fitVsini = True
 
-    res = spec_fit.find_best(
-        specdata,
-        vels_grid, [curparam],
-        rot_params,
-        resolParams,
-        config=config,
-        options=options)
-    best_vel = res['best_vel']
+    if vel0 is None:
+        res = spec_fit.find_best(
+            specdata,
+            vels_grid, [curparam],
+            rot_params,
+            resolParams,
+            config=config,
+            options=options,
+            fft=fft,
+            cache=rv_cache)
+        best_vel = res['best_vel']
+    else:
+        best_vel = vel0
 
     def paramMapper(p0):
         # construct relevant objects for fitting from a numpy array vectors
@@ -147,21 +310,98 @@ process(specdata, {'logg':10, 'teff':30, 'alpha':0, 'feh':-1,'vsini':0}, fixPara
             pdict['rot_params'],
             resolParams,
             options=options,
-            config=config)
+            config=config,
+            cache=rv_cache)
         return chisq
 
-    method = 'Nelder-Mead'
+    def func_grad(p):
+        # the chi-square and its gradient with respect to
+        # the vector of fitted parameters
+        pdict = paramMapper(p)
+        chisq, grad = spec_fit.get_chisq_grad(
+            specdata,
+            pdict['vel'],
+            pdict['params'],
+            pdict['rot_params'],
+            resolParams,
+            options=options,
+            config=config,
+            cache=rv_cache,
+            atm_free=atm_free,
+            rot_free=fitVsini)
+        if fitVsini:
+            # we fit the logarithm of vsini
+            grad[1] *= pdict['vsini']
+        return chisq, grad
+
+    atm_free = [i for i, x in enumerate(specParams) if x not in fixParam]
+    method = options.get('method') or 'Nelder-Mead'
     t1 = time.time()
-    res = scipy.optimize.minimize(
-        func,
-        startParam,
-        method=method,
-        options={
-            'fatol': 1e-3,
-            'xatol': 1e-2
-        })
+    if method == 'Nelder-Mead':
+        res = scipy.optimize.minimize(
+            func,
+            startParam,
+            method=method,
+            options={
+                'fatol': 1e-3,
+                'xatol': 1e-2
+            })
+    elif method == 'L-BFGS-B':
+        # the parameters are scaled to have similar effect on the chi-square
+        # (1 km/s in velocity, 10% in vsini and 1% in other parameters)
+        scales = [1]
+        bounds = [(min_vel, max_vel)]
+        if fitVsini:
+            scales.append(0.1)
+            bounds.append((mapVsini(min_vsini), mapVsini(max_vsini)))
+        # the atmospheric parameters are kept within the template grids
+        # of all the datasets, as the gradient is not defined outside
+        atm_bounds = [(None, None)] * len(specParams)
+        for curdata in specdata:
+            curbounds = spec_inter.getInterpolator(curdata.name,
+                                                   config).param_bounds()
+            if curbounds is None:
+                continue
+            atm_bounds = [
+                (b1 if b0 is None else max(b0, b1),
+                 c1 if c0 is None else min(c0, c1))
+                for (b0, c0), (b1, c1) in zip(atm_bounds, curbounds)
+            ]
+        for i in atm_free:
+            scales.append(0.01 * max(abs(curparam[i]), 1))
+            bounds.append(atm_bounds[i])
+        scales = np.array(scales)
+        startParam = [
+            _ if None in b else np.clip(_, b[0], b[1])
+            for _, b in zip(startParam, bounds)
+        ]
+        bounds = [(_[0] if _[0] is None else _[0] / s1,
+                   _[1] if _[1] is None else _[1] / s1)
+                  for _, s1 in zip(bounds, scales)]
+
+        def func_grad_scaled(x):
+            chisq, grad = func_grad(x * scales)
+            return chisq, grad * scales
+
+        # the chi-square values are large, so the relative tolerance
+        # is chosen to match the absolute tolerance of Nelder-Mead
+        ftol = 1e-3 / max(abs(func(startParam)), 1)
+        res = scipy.optimize.minimize(
+            func_grad_scaled,
+            np.array(startParam) / scales,
+            jac=True,
+            method=method,
+            bounds=bounds,
+            options={
+                'ftol': ftol,
+                'gtol': 1e-3
+            })
+        res['x'] = res['x'] * scales
+    else:
+        raise ValueError('Unknown optimization method %s' % method)
     best_param = paramMapper(res['x'])
     ret = {}
+    ret['nfev'] = res['nfev']
     ret['param'] = dict(zip(specParams, best_param['params']))
     if fitVsini:
         ret['vsini'] = best_param['vsini']
@@ -182,33 +422,49 @@ process(specdata, {'logg':10, 'teff':30, 'alpha':0, 'feh':-1,'vsini':0}, fixPara
         else:
             best_vel = min_vel
 
-    crit_ratio = 5  # we want the step size to be at least crit_ratio times smaller than the uncertainty
-
-    # Here we are evaluating the chi-quares on the grid of
-    # velocities to get the uncertainty
-    vel_step = vel_step0
+    # Here we are sampling the chi-squares as a function of velocity
+    # to get the uncertainty. We start from the coarse grid and then
+    # halve the intervals where the posterior has significant mass
+    # (down to min_vel_step) until its moments stop changing.
+    # The moments from the coarse grid are compared with the ones from
+    # every second velocity of it, so the resolved posterior
+    # is not refined at all
+    vel_err_tol = config.get('vel_err_tol') or 1e-2
+    posterior = spec_fit.VelPosterior(
+        specdata, [ret['param'][_] for _ in specParams],
+        best_param['rot_params'],
+        resolParams,
+        options=options,
+        config=config,
+        cache=rv_cache)
+    vels_grid = np.concatenate(
+        (np.arange(best_vel, min_vel, -vel_step0)[::-1],
+         np.arange(best_vel + vel_step0, max_vel, vel_step0)))
+    posterior.add(vels_grid, fft=fft)
+    res0, res1 = posterior.moments(every=2), posterior.moments()
+    vel_err_coarse = res1['vel_err']
     while True:
-        vels_grid = np.concatenate(
-            (np.arange(best_vel, min_vel, -vel_step)[::-1],
-             np.arange(best_vel + vel_step, max_vel, vel_step)))
-        res1 = spec_fit.find_best(
-            specdata,
-            vels_grid, [[ret['param'][_] for _ in specParams]],
-            best_param['rot_params'],
-            resolParams,
-            config=config,
-            options=options)
-        if vel_step < res1['vel_err'] / crit_ratio or vel_step < min_vel_step:
+        converged = all([
+            abs(res1[_] - res0[_]) <= vel_err_tol * max(abs(res1[_]), 1)
+            for _ in ['skewness', 'kurtosis']
+        ]) and (abs(res1['vel_err'] - res0['vel_err']) <=
+                vel_err_tol * res1['vel_err'])
+        # the moments are only trusted if the posterior is resolved
+        if converged and posterior.max_significant_step() < res1['vel_err']:
             break
-        else:
-            vel_step = max(res1['vel_err'], vel_step) / crit_ratio * 0.8
-            new_width = max(res1['vel_err'], vel_step) * 10
-            min_vel = max(best_vel - new_width, min_vel)
-            max_vel = min(best_vel + new_width, max_vel)
+        if posterior.refine(min_vel_step) == 0:
+            break
+        res0, res1 = res1, posterior.moments()
     t3 = time.time()
     ret['vel_err'] = res1['vel_err']
     ret['skewness'] = res1['skewness']
     ret['kurtosis'] = res1['kurtosis']
+    ret['vel_nevals'] = posterior.nevals
+    # the evaluations saved by reusing the stored chi-squares and compared
+    # to rescanning the whole grids
+    ret['vel_nevals_saved'] = int(posterior.nskipped) + get_regrid_nevals(
+        best_vel, vel_err_coarse, res1['vel_err'], min_vel, max_vel,
+        vel_step0, min_vel_step) - posterior.nevals
     outp = spec_fit.get_chisq(
         specdata,
         best_vel, [ret['param'][_] for _ in specParams],
@@ -216,24 +472,32 @@ process(specdata, {'logg':10, 'teff':30, 'alpha':0, 'feh':-1,'vsini':0}, fixPara
         resolParams,
         options=options,
         config=config,
+        cache=rv_cache,
         full_output=True)
 
     # compute the uncertainty of stellar params
-    def hess_func(p):
-        outp = spec_fit.get_chisq(
+    param_err_method = options.get('param_err_method') or 'fisher'
+    if param_err_method == 'fisher':
+        hessian = spec_fit.get_fisher_matrix(
             specdata,
-            best_vel,
-            p,
+            best_vel, [ret['param'][_] for _ in specParams],
             best_param['rot_params'],
             resolParams,
             options=options,
             config=config,
-            full_output=True)
-        return 0.5 * outp['chisq']
-    hess_step = np.maximum(1e-4*np.abs(np.array([ret['param'][_] for _ in \
-                                                 specParams])), 1e-4)
-    hessian = ndf.Hessian(
-        hess_func, step=hess_step)([ret['param'][_] for _ in specParams])
+            cache=rv_cache)
+    elif param_err_method == 'hessian':
+        hessian = get_numerical_hessian(
+            specdata,
+            best_vel, [ret['param'][_] for _ in specParams],
+            best_param['rot_params'],
+            resolParams,
+            options=options,
+            config=config,
+            cache=rv_cache)
+    else:
+        raise ValueError('Unknown parameter uncertainty method %s' %
+                         param_err_method)
     hessian_inv = scipy.linalg.inv(hessian)
     ret['param_err'] = dict(zip(specParams, np.sqrt(np.diag(hessian_inv))))
 
@@ -241,3 +505,34 @@ process(specdata, {'logg':10, 'teff':30, 'alpha':0, 'feh':-1,'vsini':0}, fixPara
     ret['chisq'] = outp['chisq']
     ret['chisq_array'] = outp['chisq_array']
     return ret
+
+
+def get_numerical_hessian(specdata,
+                          vel,
+                          atm_params,
+                          rot_params,
+                          resolParams,
+                          options=None,
+                          config=None,
+                          cache=None):
+    """
+    Compute the Hessian of 0.5 * chi-square with respect to the atmospheric
+    parameters by numerical differentiation (this is slow and is mainly
+    useful to validate spec_fit.get_fisher_matrix)
+    """
+
+    def hess_func(p):
+        outp = spec_fit.get_chisq(
+            specdata,
+            vel,
+            p,
+            rot_params,
+            resolParams,
+            options=options,
+            config=config,
+            cache=cache,
+            full_output=True)
+        return 0.5 * outp['chisq']
+
+    hess_step = np.maximum(1e-4 * np.abs(np.array(atm_params)), 1e-4)
+    return ndf.Hessian(hess_func, step=hess_step)(atm_params)
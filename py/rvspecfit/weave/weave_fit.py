@@ -17,6 +17,7 @@ import matplotlib.pyplot as plt
 import astropy.table as atpy
 
 from rvspecfit import fitter_ccf, vel_fit, spec_fit, utils
+from rvspecfit import shared_store
 
 
 def make_plot(specdata, res_dict, title, fig_fname):
@@ -194,13 +195,11 @@ def proc_weave(fnames, fig_prefix, config, threadid, nthreads):
 
     outdict = pandas.DataFrame()
     large_error = 1e9
+    specdatas = []
+    allsns = []
     for curid in xids:
         specdata = []
-        curbrick = brick_name
-        curtargetid = targetid[curid].replace('"', '')
-        fig_fname = fig_prefix + '_%s_%s.png' % (curbrick, curtargetid)
         sns = {}
-        chisqs = {}
         for s in setups:
             spec = fluxes[s][curid]
             curivars = ivars[s][curid]
@@ -211,19 +210,34 @@ def proc_weave(fnames, fig_prefix, config, threadid, nthreads):
             specdata.append(
                 spec_fit.SpecData(
                     'weave_%s' % s, waves[s], spec, espec, badmask=badmask))
-        t1 = time.time()
-        res = fitter_ccf.fit(specdata, config)
+        specdatas.append(specdata)
+        allsns.append(sns)
+    # the cross-correlations of all the fibers are done at once
+    ccf_results = []
+    if len(specdatas) > 0:
+        ccf_results = fitter_ccf.fit_many(specdatas, config)
+    for curid, specdata, sns, res in zip(xids, specdatas, allsns,
+                                         ccf_results):
+        curbrick = brick_name
+        curtargetid = targetid[curid].replace('"', '')
+        fig_fname = fig_prefix + '_%s_%s.png' % (curbrick, curtargetid)
         t2 = time.time()
         paramDict0 = res['best_par']
         fixParam = []
         if res['best_vsini'] is not None:
             paramDict0['vsini'] = res['best_vsini']
+        vel0 = None
+        if config.get('ccf_polish'):
+            # start from the best of the polished CCF candidates
+            paramDict0, vel0, _ = vel_fit.polish_candidates(
+                specdata, res['candidates'], options=options, config=config)
         res1 = vel_fit.process(
             specdata,
             paramDict0,
             fixParam=fixParam,
             config=config,
-            options=options)
+            options=options,
+            vel0=vel0)
         t3 = time.time()
         chisq_cont_array = spec_fit.get_chisq_continuum(
             specdata, options=options)
@@ -295,6 +309,9 @@ def proc_many(files,
         parallel = False
 
     if parallel:
+        # the workers share the segments of the template store through
+        # the token of this run (see shared_store.run_token)
+        shared_store.run_token()
         pool = mp.Pool(nthreads)
     for f in files:
         res = []
@@ -0,0 +1,68 @@
+import os
+os.environ['OMP_NUM_THREADS'] = '1'
+import time
+import astropy.io.fits as pyfits
+import numpy as np
+import scipy.signal
+from rvspecfit import make_ccf
+from rvspecfit import fitter_ccf
+from rvspecfit import utils
+
+# compare the continuum fitted by IRLS with the one fitted by BFGS
+# and check that the batched fit gives the same continua as the
+# individual fits
+
+config = utils.read_config()
+ccfconf = fitter_ccf.get_ccf_info('sdss1', config)[2]['ccfconf']
+
+# read data
+dat = pyfits.getdata('./spec-0266-51602-0031.fits')
+lam = 10**dat['loglam']
+spec = dat['flux'].astype(np.float64)
+err = dat['ivar']
+err = 1. / err**.5
+err[~np.isfinite(err)] = 1e40
+
+# the spectrum and the spectrum with the distorted continuum
+specs = np.array([spec, spec * (1 + 0.3 * np.sin(lam / 500.))])
+especs = np.array([err, err])
+binning = 11
+
+
+def get_loss(curspec, curespec, cont):
+    # the L1 norm of the residuals of the binned spectrum minimized by the
+    # continuum fit
+    curspec = scipy.signal.medfilt(curspec, binning)[::binning]
+    curespec = scipy.signal.medfilt(curespec, binning)[::binning]
+    return np.abs((curspec - cont[::binning]) / curespec).sum()
+
+
+conts = {}
+for method in ['irls', 'bfgs']:
+    t1 = time.time()
+    conts[method] = np.array([
+        make_ccf.get_continuum(lam,
+                               curspec,
+                               curespec,
+                               ccfconf=ccfconf,
+                               bin=binning,
+                               method=method)
+        for curspec, curespec in zip(specs, especs)
+    ])
+    t2 = time.time()
+    print('%s: time=%.2f' % (method, t2 - t1))
+
+for i in range(len(specs)):
+    loss_irls = get_loss(specs[i], especs[i], conts['irls'][i])
+    loss_bfgs = get_loss(specs[i], especs[i], conts['bfgs'][i])
+    reldiff = np.abs(conts['irls'][i] / conts['bfgs'][i] - 1)
+    print(loss_irls, loss_bfgs, np.median(reldiff))
+    assert loss_irls <= loss_bfgs * (1 + 1e-3), (loss_irls, loss_bfgs)
+    assert np.median(reldiff) < 0.01
+
+cont_many = make_ccf.get_continuum(lam,
+                                   specs,
+                                   especs,
+                                   ccfconf=ccfconf,
+                                   bin=binning)
+assert np.allclose(cont_many, conts['irls'], rtol=1e-8)
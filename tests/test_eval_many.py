@@ -0,0 +1,53 @@
+import os
+os.environ['OMP_NUM_THREADS'] = '1'
+import numpy as np
+from rvspecfit import spec_inter
+from rvspecfit import utils
+
+# check that the batched evaluation of the templates gives the same
+# spectra and outside flags as the evaluation one point at a time
+
+config = utils.read_config()
+
+interp = spec_inter.getInterpolator('sdss1', config)
+bounds = np.array(interp.param_bounds())
+rng = np.random.RandomState(1)
+npoints = 50
+params = bounds[:, 0] + rng.uniform(size=(npoints, len(bounds))) * (
+    bounds[:, 1] - bounds[:, 0])
+# the points outside the grid
+params[:3] = bounds[:, 1] + 1
+
+specs, flags = interp.eval_many(params)
+assert specs.shape == (npoints, len(interp.lam))
+for curparam, curspec, curflag in zip(params, specs, flags):
+    paramdict = dict(zip(interp.parnames, curparam))
+    spec = interp.eval(paramdict)
+    assert np.all(np.isnan(spec) == np.isnan(curspec))
+    assert np.allclose(spec, curspec, rtol=1e-10, equal_nan=True)
+    spec, flag = interp.eval_flag(paramdict)
+    assert np.allclose(spec, curspec, rtol=1e-10, equal_nan=True)
+    assert np.isnan(flag) == np.isnan(curflag)
+    assert np.allclose(flag, curflag, rtol=1e-10, equal_nan=True)
+assert np.isnan(specs[:3]).all()
+assert np.isfinite(specs[3:]).all()
+
+# the list of dictionaries is accepted as well
+specs1, flags1 = interp.eval_many(
+    [dict(zip(interp.parnames, _)) for _ in params])
+assert np.allclose(specs, specs1, equal_nan=True)
+assert np.allclose(flags, flags1, equal_nan=True)
+
+# the walks from the caller-held starting simplices find the same simplices
+# and leave the state of the triangulation alone
+triang = interp.triang
+if triang is not None:
+    pts = np.asarray(interp.mapper.forward(params.T)).T
+    xids = triang.find_simplex(pts)
+    assert np.all(triang.find_simplex(pts, start=np.roll(xids, 1)) == xids)
+    last = triang.last
+    prev = -1
+    for curpt, curxid in zip(pts, xids):
+        prev = triang.find_simplex(curpt, start=prev)
+        assert prev == curxid
+    assert triang.last == last
@@ -0,0 +1,56 @@
+import os
+os.environ['OMP_NUM_THREADS'] = '1'
+import time
+import astropy.io.fits as pyfits
+import numpy as np
+from rvspecfit import vel_fit
+from rvspecfit import spec_fit
+from rvspecfit import utils
+from rvspecfit import lrucache
+
+# compare the number of chi-square evaluations and of template
+# evaluations of the Nelder-Mead and gradient based fits
+
+config = utils.read_config()
+
+# read data
+dat = pyfits.getdata('./spec-0266-51602-0031.fits')
+err = dat['ivar']
+err = 1. / err**.5
+err[~np.isfinite(err)] = 1e40
+
+# construct specdata object
+specdata = [spec_fit.SpecData('sdss1', 10**dat['loglam'], dat['flux'], err)]
+paramDict0 = {'logg': 2, 'teff': 5000, 'feh': -1, 'alpha': 0.2, 'vsini': 19}
+fixParam = ['vsini']
+
+results = {}
+ntempls = {}
+for method in ['Nelder-Mead', 'L-BFGS-B']:
+    options = {'npoly': 15, 'method': method}
+    # start from empty caches, so that the misses count the templates
+    # evaluated by this fit
+    templ_cache = lrucache.get_cache('templates')
+    templ_cache.clear()
+    lrucache.get_cache('rv_interpol').clear()
+    misses0 = templ_cache.info()['misses']
+    t1 = time.time()
+    res = vel_fit.process(
+        specdata,
+        paramDict0,
+        fixParam=fixParam,
+        config=config,
+        options=options)
+    t2 = time.time()
+    ntempl = templ_cache.info()['misses'] - misses0
+    print('%s: nfev=%d templates=%d time=%.2f vel=%.3f chisq=%.3f' %
+          (method, res['nfev'], ntempl, t2 - t1, res['vel'], res['chisq']),
+          res['param'])
+    results[method] = res
+    ntempls[method] = ntempl
+
+assert (abs(results['Nelder-Mead']['vel'] - results['L-BFGS-B']['vel']) <
+        results['Nelder-Mead']['vel_err'])
+# the gradient needs only one template per evaluation
+assert ntempls['L-BFGS-B'] <= results['L-BFGS-B']['nfev'] + 1
+assert ntempls['L-BFGS-B'] < ntempls['Nelder-Mead']
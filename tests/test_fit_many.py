@@ -0,0 +1,62 @@
+import os
+os.environ['OMP_NUM_THREADS'] = '1'
+import time
+import astropy.io.fits as pyfits
+import numpy as np
+from rvspecfit import fitter_ccf
+from rvspecfit import spec_fit
+from rvspecfit import utils
+
+# check that the cross-correlation of many spectra at once gives the same
+# results as the cross-correlation of each spectrum separately
+
+config = utils.read_config()
+
+# read data
+dat = pyfits.getdata('./spec-0266-51602-0031.fits')
+lam = 10**dat['loglam']
+err = dat['ivar']
+err = 1. / err**.5
+err[~np.isfinite(err)] = 1e40
+
+rng = np.random.RandomState(1)
+specdatas = []
+for i in range(6):
+    # the spectrum shifted in velocity with added noise
+    vel = rng.uniform(-300, 300)
+    spec = np.interp(lam, lam * (1 + vel / 3e5), dat['flux'])
+    spec = spec + rng.normal(size=len(lam)) * np.where(err < 1e30, err, 0)
+    sl = slice(None)
+    if i % 3 == 2:
+        # the spectra on a different wavelength grid
+        sl = slice(100, -100)
+    specdatas.append(
+        [spec_fit.SpecData('sdss1', lam[sl], spec[sl], err[sl])])
+
+t1 = time.time()
+results_many = fitter_ccf.fit_many(specdatas, config)
+t2 = time.time()
+results = [fitter_ccf.fit(_, config) for _ in specdatas]
+t3 = time.time()
+print('fit_many: time=%.2f, fit: time=%.2f' % (t2 - t1, t3 - t2))
+
+# the small blocks of spectra and templates
+results_blocks = fitter_ccf.fit_many(specdatas,
+                                     dict(config, ccf_block_size=4))
+
+assert len(results_many) == len(specdatas)
+for res_many, res_blocks, res in zip(results_many, results_blocks,
+                                     results):
+    assert res_blocks['best_par'] == res['best_par']
+    assert np.allclose(res_blocks['best_vel'], res['best_vel'], atol=1e-6)
+    print(res['best_vel'], res['best_par'])
+    assert res_many['best_par'] == res['best_par']
+    assert res_many['best_vsini'] == res['best_vsini']
+    assert np.allclose(res_many['best_vel'], res['best_vel'], atol=1e-6)
+    assert len(res_many['candidates']) == len(res['candidates'])
+    for cand_many, cand in zip(res_many['candidates'], res['candidates']):
+        assert cand_many['best_par'] == cand['best_par']
+        assert np.allclose(cand_many['best_vel'], cand['best_vel'], atol=1e-6)
+        assert np.allclose(cand_many['ccf_height'],
+                           cand['ccf_height'],
+                           rtol=1e-6)
@@ -0,0 +1,76 @@
+import os
+import tempfile
+import numpy as np
+from rvspecfit import libfile
+from rvspecfit import read_grid
+
+# write the arrays and the metadata into the library file and check
+# that they are read back unchanged
+
+rng = np.random.RandomState(1)
+arrays = {
+    'specs': rng.normal(size=(13, 101)).astype(np.float32),
+    'ffts': (rng.normal(size=(7, 33)) +
+             1j * rng.normal(size=(7, 33))).astype(np.complex64),
+    'vec': np.asfortranarray(rng.normal(size=(4, 29))),
+    'lam': np.linspace(4000, 5000, 101),
+    'simplices': rng.randint(100, size=(11, 5)),
+    'strided': rng.normal(size=(10, 10))[::2, ::3],
+    'scalar': np.array(3.5),
+    'empty': np.zeros((0, 4))
+}
+meta = {
+    'parnames': ['teff', 'logg', 'feh', 'alpha'],
+    'nfft': 1024,
+    'ccfconf': {
+        'logl0': 8.2,
+        'splinestep': 1000
+    },
+    'log_spec': True,
+    'mapper': libfile.mapper_to_meta(read_grid.ParamMapper())
+}
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    fname = tmpdir + '/test.rvslib'
+    libfile.write(fname, arrays, meta)
+    assert not os.path.exists(fname + '.tmp')
+    arrays1, meta1 = libfile.read(fname)
+    assert meta1 == meta
+    assert sorted(arrays1.keys()) == sorted(arrays.keys())
+    for k, v in arrays.items():
+        assert arrays1[k].dtype == v.dtype, k
+        assert arrays1[k].shape == v.shape, k
+        assert np.all(arrays1[k] == v), k
+        # the arrays are memory-mapped read-only
+        assert not arrays1[k].flags.writeable, k
+    assert arrays1['vec'].flags.f_contiguous
+
+    mapper = libfile.mapper_from_meta(meta1['mapper'])
+    vec = np.array([[5000, 2, -1, 0.2], [6000, 4, 0, 0]]).T
+    assert np.allclose(mapper.forward(vec),
+                       read_grid.ParamMapper().forward(vec))
+
+    # the mappers from outside of rvspecfit are rejected
+    for cls in ['os.system', 'subprocess.Popen', 'rvspecfit.libfile.os']:
+        try:
+            libfile.mapper_from_meta(dict(cls=cls, state={}))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('The mapper %s was accepted' % cls)
+
+    # overwriting the file with the same name replaces it
+    libfile.write(fname, {'lam': arrays['lam']}, {})
+    arrays1, meta1 = libfile.read(fname)
+    assert list(arrays1.keys()) == ['lam'] and meta1 == {}
+    assert np.all(arrays1['lam'] == arrays['lam'])
+
+    # the files of other formats are rejected
+    with open(fname, 'wb') as fp:
+        fp.write(b'not a library file')
+    try:
+        libfile.read(fname)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('The invalid file was accepted')
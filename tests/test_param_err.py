@@ -0,0 +1,42 @@
+import os
+os.environ['OMP_NUM_THREADS'] = '1'
+import time
+import astropy.io.fits as pyfits
+import numpy as np
+from rvspecfit import vel_fit
+from rvspecfit import spec_fit
+from rvspecfit import utils
+
+# compare the parameter uncertainties from the Fisher matrix
+# with the ones from the numerical Hessian
+
+config = utils.read_config()
+
+# read data
+dat = pyfits.getdata('./spec-0266-51602-0031.fits')
+err = dat['ivar']
+err = 1. / err**.5
+err[~np.isfinite(err)] = 1e40
+
+# construct specdata object
+specdata = [spec_fit.SpecData('sdss1', 10**dat['loglam'], dat['flux'], err)]
+paramDict0 = {'logg': 2, 'teff': 5000, 'feh': -1, 'alpha': 0.2, 'vsini': 19}
+fixParam = ['vsini']
+
+results = {}
+for method in ['hessian', 'fisher']:
+    options = {'npoly': 15, 'param_err_method': method}
+    t1 = time.time()
+    res = vel_fit.process(
+        specdata,
+        paramDict0,
+        fixParam=fixParam,
+        config=config,
+        options=options)
+    t2 = time.time()
+    print('%s: time=%.2f' % (method, t2 - t1), res['param_err'])
+    results[method] = res['param_err']
+
+for k in results['hessian'].keys():
+    ratio = results['fisher'][k] / results['hessian'][k]
+    assert (abs(ratio - 1) < 0.1), (k, ratio)
@@ -0,0 +1,81 @@
+import os
+import sys
+import subprocess
+import numpy as np
+from rvspecfit import shared_store
+
+# store more entries than the byte budget allows and check that
+# the store neither keeps file descriptors open nor grows beyond the budget
+
+
+if shared_store.shared_memory is None:
+    print('The shared memory store requires python>=3.8, skipping')
+    sys.exit(0)
+
+
+def nfds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+prefix = 'rvstest%d_' % os.getpid()
+nentries = 200
+arr_size = 1000
+# each entry takes 8000 bytes plus the header rounded up to whole pages,
+# so a few dozen entries fit
+maxbytes = 25 * (arr_size * 8 + 4096)
+store = shared_store.SharedStore(prefix, maxbytes=maxbytes)
+
+store.put(('templ', 0), (np.array(0), np.arange(arr_size) * 1.))
+# the first segment also starts the resource tracker
+nfds0 = nfds()
+for i in range(1, nentries):
+    store.put(('templ', i), (np.array(i), np.arange(arr_size) * 1. + i))
+    assert store.nbytes <= maxbytes
+assert nfds() == nfds0, (nfds0, nfds())
+
+info = store.info()
+print(info)
+assert info['evictions'] > 0
+assert info['segments'] < nentries
+assert info['segments'] + info['evictions'] == nentries
+nsegm = len([_ for _ in os.listdir('/dev/shm') if _.startswith(prefix)])
+assert nsegm == info['segments'], (nsegm, info['segments'])
+
+# the oldest entries are gone, the newest ones are intact
+assert store.get(('templ', 0)) is None
+flag, spec = store.get(('templ', nentries - 1))
+assert int(flag) == nentries - 1
+assert np.all(spec == np.arange(arr_size) + nentries - 1.)
+
+# the recently read entry survives the following evictions
+oldest = info['evictions']
+store.get(('templ', oldest))
+store.put(('templ', nentries), (np.array(0), np.zeros(arr_size)))
+assert store.get(('templ', oldest)) is not None
+assert store.get(('templ', oldest + 1)) is None
+
+# the segment with the malformed header is ignored
+shm = shared_store.shared_memory.SharedMemory(name=store._segname('bad'),
+                                              create=True,
+                                              size=4096)
+hdr = b'not json'
+shm.buf[1:9] = len(hdr).to_bytes(8, 'little')
+shm.buf[9:9 + len(hdr)] = hdr
+shm.buf[0] = 1
+assert store.get('bad') is None
+shm.close()
+shared_store._unlink(shm.name)
+
+store.cleanup()
+assert len([_ for _ in os.listdir('/dev/shm') if _.startswith(prefix)]) == 0
+assert nfds() == nfds0
+
+# the child processes inherit the random token of the run
+os.environ.pop(shared_store.RUN_TOKEN_ENV, None)
+prefix = shared_store.default_prefix()
+assert prefix == shared_store.default_prefix()
+child = subprocess.check_output([
+    sys.executable, '-c',
+    'from rvspecfit import shared_store; print(shared_store.default_prefix())'
+]).decode().strip()
+assert child == prefix, (child, prefix)